@@ -0,0 +1,298 @@
+"""Static frontend assets, indexed once at startup and served from memory.
+
+Every file under the frontend directories (plus index.html) is read and
+hashed when the server starts. The hash is the asset's version: a strong
+ETag, and the `?v=` fingerprint that index.html and the stylesheets are
+rewritten to use (`vendor/tailwind.css?v=3f2a…`, `url(../webfonts/…?v=…)`).
+A request carrying the current fingerprint is answered with a one-year
+`immutable` Cache-Control, so Chromium reuses it on `location.reload()`
+without even asking; anything else (ES module imports, a stale
+fingerprint) gets `no-cache` and revalidates with If-None-Match, which is a
+bodiless 304 when nothing changed.
+
+Text-like files are also precompressed — gzip always, brotli when the
+optional `brotli` package is installed — and the variant the client
+accepts is sent as-is, with no per-request compression. Compressed
+outputs are cached on disk by content hash (ASSET_CACHE_DIR), so only the
+first boot after a change pays for them. Small files are kept in memory;
+large ones (the wallpaper) are streamed from disk.
+
+bundle.py adds generated assets on top (the JS/CSS bundles, the icon font
+subset, the resized wallpaper, a rewritten index.html) with add_generated;
+they are versioned and precompressed the same way, and built_once caches
+their expensive steps on disk next to the compressed variants.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import threading
+
+from flask import Response, send_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Files bigger than this are streamed from disk instead of kept in memory.
+MEMORY_FILE_LIMIT = 512 * 1024
+# Compressing tiny files saves less than the headers cost.
+MIN_COMPRESS_BYTES = 1024
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/javascript', 'application/json', 'image/svg+xml',
+    'font/ttf', 'font/otf', 'application/x-font-ttf',
+)
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE = 'no-cache'
+
+_CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+_HTML_REF = re.compile(r'(\s(?:href|src)=")([^"]+)(")')
+
+mimetypes.add_type('application/javascript', '.js')
+mimetypes.add_type('font/woff2', '.woff2')
+mimetypes.add_type('font/ttf', '.ttf')
+mimetypes.add_type('image/webp', '.webp')
+
+
+class Asset:
+    __slots__ = ('name', 'path', 'mtime', 'content_type', 'version', 'size', 'body', 'variants')
+
+    def __init__(self, name, path, mtime, content_type, version, size, body, variants):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.content_type = content_type
+        self.version = version
+        self.size = size
+        self.body = body  # None → stream from path
+        self.variants = variants  # {'br': bytes, 'gzip': bytes}
+
+
+class AssetStore:
+    def __init__(self, root, dirs, cache_dir=None, watch=False):
+        self.root = str(root)
+        self.dirs = tuple(dirs)
+        self.cache_dir = cache_dir
+        # watch=True (development): re-stat on every request and re-index a
+        # file whose mtime changed, so edits show up without a restart.
+        self.watch = watch
+        self._assets = {}
+        self._lock = threading.Lock()
+
+    def load(self, entrypoints=('index.html',)):
+        """Indexes every asset. Stylesheets and HTML entrypoints are loaded
+        last, since their rewritten references need the versions of the
+        files they point to."""
+        names = []
+        for directory in self.dirs:
+            for dirpath, _, filenames in os.walk(os.path.join(self.root, directory)):
+                for filename in filenames:
+                    full = os.path.join(dirpath, filename)
+                    names.append(os.path.relpath(full, self.root).replace(os.sep, '/'))
+        names.sort(key=lambda name: name.endswith('.css'))
+        for name in names + list(entrypoints):
+            self._add(name)
+        return self
+
+    def get(self, name):
+        """The asset for a relative path, or None. A file that appeared
+        after startup (e.g. a new logo in branding/) is indexed on first
+        request."""
+        name = posixpath.normpath(name)
+        asset = self._assets.get(name)
+        if asset is not None:
+            if self.watch and asset.path and _mtime(asset.path) != asset.mtime:
+                return self._add(name)
+            return asset
+        if name.split('/')[0] not in self.dirs:
+            return None
+        path = self._path(name)
+        if path is None or not os.path.isfile(path):
+            return None
+        return self._add(name)
+
+    def add_generated(self, name, data, content_type=None):
+        """Registers an asset built in memory under `name` (replacing a
+        file of that name, e.g. index.html) and returns it."""
+        content_type = content_type or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        asset = self._make(name, None, None, content_type, data, keep_in_memory=True)
+        with self._lock:
+            self._assets[name] = asset
+        return asset
+
+    def built_once(self, key, kind, build):
+        """build()'s bytes, cached on disk under `key` (a hash of whatever
+        the build depends on), so a restart doesn't redo it."""
+        data = self._cached(key, kind)
+        if data is None:
+            data = build()
+            self._store_cached(key, kind, data)
+        return data
+
+    def versioned_url(self, name):
+        asset = self.get(name)
+        return f"{name}?v={asset.version}" if asset else name
+
+    def __len__(self):
+        return len(self._assets)
+
+    def _path(self, name):
+        """Absolute path for a relative asset name, or None if it resolves
+        outside the served directories (`js/../config.py`)."""
+        root = os.path.realpath(self.root)
+        path = os.path.realpath(os.path.join(root, name))
+        allowed = [os.path.join(root, directory) + os.sep for directory in self.dirs]
+        if path == os.path.join(root, 'index.html') or path.startswith(tuple(allowed)):
+            return path
+        return None
+
+    def _add(self, name):
+        path = self._path(name)
+        if path is None or not os.path.isfile(path):
+            return None
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        mtime = _mtime(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        if name.endswith('.css'):
+            data = self._rewrite(data, _CSS_URL, name, group=2)
+        elif name.endswith('.html'):
+            data = self._rewrite(data, _HTML_REF, name, group=2)
+        rewritten = name.endswith(('.css', '.html'))
+        asset = self._make(name, path, mtime, content_type, data, keep_in_memory=rewritten)
+        with self._lock:
+            self._assets[name] = asset
+        return asset
+
+    def _make(self, name, path, mtime, content_type, data, keep_in_memory):
+        version = hashlib.sha256(data).hexdigest()[:16]
+        variants = {}
+        if len(data) >= MIN_COMPRESS_BYTES and content_type.startswith(COMPRESSIBLE_TYPES):
+            variants = self._compressed(data, version)
+        if content_type.startswith('text/') or content_type == 'application/javascript':
+            content_type += '; charset=utf-8'
+        body = data if keep_in_memory or len(data) <= MEMORY_FILE_LIMIT else None
+        return Asset(name, path, mtime, content_type, version, len(data), body, variants)
+
+    def _rewrite(self, data, pattern, name, group):
+        """Appends ?v=<version> to every local reference in a CSS/HTML file
+        whose target is a known asset."""
+        base = posixpath.dirname(name)
+        text = data.decode('utf-8')
+
+        def replace(match):
+            ref = match.group(group)
+            if ref.startswith(('data:', 'http:', 'https:', '//', '#')) or '?' in ref:
+                return match.group(0)
+            target = ref.lstrip('/') if ref.startswith('/') else posixpath.normpath(posixpath.join(base, ref))
+            asset = self._assets.get(target)
+            if asset is None:
+                return match.group(0)
+            start, end = match.span(group)
+            offset = match.start(0)
+            whole = match.group(0)
+            return whole[:start - offset] + f"{ref}?v={asset.version}" + whole[end - offset:]
+
+        return pattern.sub(replace, text).encode('utf-8')
+
+    def _compressed(self, data, version):
+        variants = {}
+        encoders = [('gzip', lambda raw: gzip.compress(raw, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            encoders.insert(0, ('br', lambda raw: brotli.compress(raw, quality=11)))
+        for encoding, encode in encoders:
+            compressed = self._cached(version, encoding)
+            if compressed is None:
+                compressed = encode(data)
+                self._store_cached(version, encoding, compressed)
+            # Not worth a separate representation if it barely shrinks.
+            if len(compressed) < len(data) * 0.9:
+                variants[encoding] = compressed
+        return variants
+
+    def _cache_path(self, version, encoding):
+        return os.path.join(self.cache_dir, f"{version}.{encoding}")
+
+    def _cached(self, version, encoding):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_path(version, encoding), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _store_cached(self, version, encoding, data):
+        if not self.cache_dir:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = self._cache_path(version, encoding) + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._cache_path(version, encoding))
+        except OSError as e:
+            print(f"ASSETS WARNING: no se pudo guardar la caché comprimida: {e}")
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _etag_matches(header, version):
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag.strip('"').split('-')[0] == version:
+            return True
+    return False
+
+
+def _accepted(header, encoding):
+    for part in header.split(','):
+        token, _, params = part.strip().partition(';')
+        if token.strip().lower() == encoding:
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+def response(asset, request, immutable=None):
+    """Builds the response for an asset: 304 if the client's copy is
+    current, else the best precompressed variant it accepts. With
+    immutable=None the cache policy follows the request's ?v=."""
+    if immutable is None:
+        immutable = request.args.get('v') == asset.version
+    encoding = None
+    accept = request.headers.get('Accept-Encoding', '')
+    for candidate in ('br', 'gzip'):
+        if candidate in asset.variants and _accepted(accept, candidate):
+            encoding = candidate
+            break
+    etag = f'"{asset.version}-{encoding}"' if encoding else f'"{asset.version}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': IMMUTABLE_CACHE if immutable else REVALIDATE_CACHE,
+    }
+    if asset.variants:
+        headers['Vary'] = 'Accept-Encoding'
+
+    if _etag_matches(request.headers.get('If-None-Match', ''), asset.version):
+        return Response(status=304, headers=headers)
+
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        return Response(asset.variants[encoding], content_type=asset.content_type, headers=headers)
+    if asset.body is not None:
+        return Response(asset.body, content_type=asset.content_type, headers=headers)
+    resp = send_file(asset.path, mimetype=asset.content_type, conditional=False, etag=False, max_age=None)
+    resp.headers.update(headers)
+    return resp
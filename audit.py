@@ -0,0 +1,113 @@
+"""Background, batched writer for the audit log (events table).
+
+server.log() used to INSERT + commit inside the request thread, so a burst
+of FRONTEND log calls or failed pickup attempts paid SQLite's commit latency
+on customer-facing requests. Now the request only enqueues; one thread
+drains the queue and group-commits everything that arrives within
+AUDIT_FLUSH_SECONDS of the first pending event (up to AUDIT_BATCH_SIZE) in a
+single transaction.
+
+Loss policy: the queue is bounded. If it's full (the SD card stalls, a
+flood of events) new events are dropped and counted, and the next batch
+that does get written records how many were lost — the audit trail says
+where it has a gap instead of silently missing lines. Pending events are
+flushed at interpreter exit.
+"""
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+import config
+import db
+
+
+class AuditWriter:
+    def __init__(self, max_pending, batch_size, flush_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+            self._thread.start()
+
+    def enqueue(self, level, message, bay_id=None):
+        """Never blocks. Returns False if the event had to be dropped."""
+        item = (datetime.now(timezone.utc).isoformat(), level, message, bay_id)
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            with self._dropped_lock:
+                self._dropped += 1
+            return False
+
+    def stop(self, timeout=5.0):
+        """Writes everything still queued, then stops the worker."""
+        if not self._thread or not self._thread.is_alive():
+            self._write(self._drain())
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                batch = [self._queue.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and not self._stopping.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+        self._write(self._drain())
+
+    def _drain(self, limit=None):
+        items = []
+        while limit is None or len(items) < limit:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _write(self, items):
+        with self._dropped_lock:
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            items.append((
+                datetime.now(timezone.utc).isoformat(), 'WARNING',
+                f"{dropped} evento(s) de auditoría descartados: la cola de escritura estaba llena",
+                None,
+            ))
+        if not items:
+            return
+        try:
+            db.log_events(items)
+        except Exception as e:
+            print(f"AUDIT ERROR: no se pudieron escribir {len(items)} evento(s): {e}")
+
+
+writer = AuditWriter(
+    max_pending=config.AUDIT_QUEUE_SIZE,
+    batch_size=config.AUDIT_BATCH_SIZE,
+    flush_interval=config.AUDIT_FLUSH_SECONDS,
+)
+atexit.register(writer.stop)
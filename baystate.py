@@ -0,0 +1,250 @@
+"""Server-side deposit/pickup state machine for each bay.
+
+    IDLE ──deposit opened──▶ STAGED ──door closed──▶ OCCUPIED
+      ▲                        │                        │
+      │◀───close timeout───────┘                 pickup opened
+      │                                                 ▼
+      └────────────door closed / close timeout──── PICKING_UP
+
+Deposits and pickups used to be finished by the browser: it polled the
+door until LOCKED and then called a confirm endpoint, so a kiosk reload in
+the middle left the bay half-staged until someone noticed. Now the
+endpoint that opens a door hands the bay to this machine, and its thread
+finishes the flow on its own:
+
+- STAGED: the door closing confirms the deposit (OCCUPIED). A door still
+  open after the close timeout rolls the deposit back (IDLE, the code is
+  dead), so a bay is never left blocked by a deposit nobody finished.
+- PICKING_UP: the door closing clears the bay (IDLE). So does the close
+  timeout — the door was opened with the right code, the package is gone.
+
+Only in-flight bays are watched. The poller already polls open doors at
+the hot rate; its listener just wakes this thread, which reads the door
+from the poller's snapshot — no extra serial traffic. The confirm
+endpoints still work (they settle the bay right away), but the frontend no
+longer has to call them.
+
+IDLE/STAGED/OCCUPIED follow from the bays table; PICKING_UP and the
+timers live in memory. On start, deposits left STAGED by a previous run
+are adopted: one whose door is still open is finished the same way. One
+already closed (or never read before the close timeout) is left STAGED
+and flagged for review: nothing says whether a package went in (a batch
+may have staged the bay and never opened it), and clearing it would free
+a bay that may hold a package and kill its code. The admin confirms it
+(/api/admin/deposit/confirm) or clears it.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+import config
+import db
+from poller import poller
+
+IDLE = 'IDLE'
+STAGED = 'STAGED'
+OCCUPIED = 'OCCUPIED'
+PICKING_UP = 'PICKING_UP'
+
+# Why a bay left STAGED/PICKING_UP, passed to on_transition and on_settled.
+REASON_CLOSED = 'closed'
+REASON_TIMEOUT = 'timeout'
+REASON_CLIENT = 'client'
+REASON_RESTART = 'restart'
+REASON_CLEARED = 'cleared'
+
+# Upper bound on how long a deadline can go unnoticed if no door event
+# wakes the thread first.
+TICK_SECONDS = 1.0
+
+
+class _Flight:
+    def __init__(self, bay_id, address, state, deadline, on_settled, seen_open=True):
+        self.bay_id = bay_id
+        self.address = address
+        self.state = state
+        self.deadline = deadline
+        self.on_settled = on_settled
+        # False for deposits adopted on start until the door reads UNLOCKED;
+        # only readings taken after `since` count for those.
+        self.seen_open = seen_open
+        self.since = datetime.now(timezone.utc).isoformat()
+
+
+class BayStateMachine:
+    def __init__(self, deposit_timeout, pickup_timeout, on_transition=None):
+        self.deposit_timeout = deposit_timeout
+        self.pickup_timeout = pickup_timeout
+        # on_transition(bay_id, state, reason, bay): runs after the database
+        # change, with the bay's row as it was before it. server.py logs and
+        # publishes it. An adopted deposit flagged for review is reported as
+        # (STAGED, REASON_RESTART) with no change to the database.
+        self.on_transition = on_transition
+        self._flights = {}  # bay_id → _Flight
+        self._review = set()  # adopted STAGED bays waiting for the admin
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        poller.add_listener(self._on_status)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        for bay in db.get_all_bays():
+            if bay['pickup_code'] and not bay['occupied'] and bay['id'] <= config.NUM_LOCKERS:
+                address = config.address_for(bay['id'])
+                self._watch(bay['id'], address, STAGED, self.deposit_timeout, None, seen_open=False)
+                poller.mark_hot(address)
+        self._thread = threading.Thread(target=self._run, name='bay-state', daemon=True)
+        self._thread.start()
+
+    def deposit_opened(self, bay_id, address, timeout=None, on_settled=None):
+        """The door of a staged deposit was opened. on_settled(bay_id,
+        state, reason) runs once the deposit is confirmed (OCCUPIED) or
+        rolled back (IDLE) — also, with REASON_CLEARED, when the bay stops
+        being watched some other way (admin clear, a new flow on it)."""
+        self._watch(bay_id, address, STAGED, timeout or self.deposit_timeout, on_settled)
+
+    def pickup_opened(self, bay_id, address):
+        self._watch(bay_id, address, PICKING_UP, self.pickup_timeout, None)
+
+    def settle(self, bay_id, expected):
+        """Finishes a flow now (the client saw the door close). Returns
+        False if the bay wasn't in `expected` — already settled by the
+        door, or never started."""
+        return self._settle(bay_id, expected, REASON_CLIENT)
+
+    def forget(self, bay_id):
+        """Stops watching a bay that was changed by hand (admin clear)."""
+        with self._lock:
+            flight = self._flights.pop(bay_id, None)
+            self._review.discard(bay_id)
+        self._settled(flight, IDLE, REASON_CLEARED)
+
+    def needs_review(self, bay_id):
+        """True for an adopted deposit whose door was already closed: the
+        admin has to confirm or clear it."""
+        with self._lock:
+            return bay_id in self._review
+
+    def state_of(self, bay):
+        """Current state of a bay, given its row from the bays table."""
+        with self._lock:
+            flight = self._flights.get(bay['id'])
+        if flight is not None:
+            return flight.state
+        if bay['occupied']:
+            return OCCUPIED
+        return STAGED if bay['pickup_code'] else IDLE
+
+    def _watch(self, bay_id, address, state, timeout, on_settled, seen_open=True):
+        with self._lock:
+            replaced = self._flights.get(bay_id)
+            self._flights[bay_id] = _Flight(
+                bay_id, address, state, time.monotonic() + timeout, on_settled, seen_open,
+            )
+            self._review.discard(bay_id)
+        self._settled(replaced, IDLE, REASON_CLEARED)
+        # Wake the thread even if the door closes before the next status
+        # change is seen (or already did).
+        self._wake.set()
+
+    def _on_status(self, address, status):
+        if status["status"] not in ("LOCKED", "UNLOCKED"):
+            return
+        with self._lock:
+            watched = any(flight.address == address for flight in self._flights.values())
+        if watched:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            with self._lock:
+                flights = list(self._flights.values())
+            for flight in flights:
+                try:
+                    hw = poller.get(flight.address)
+                    status = hw["status"]
+                    if not flight.seen_open and (hw["checkedAt"] or '') < flight.since:
+                        status = "UNKNOWN"
+                    if status == "UNLOCKED":
+                        flight.seen_open = True
+                    if not flight.seen_open and (status == "LOCKED" or now >= flight.deadline):
+                        self._hold(flight)
+                    elif status == "LOCKED":
+                        self._settle(flight.bay_id, flight.state, REASON_CLOSED)
+                    elif now >= flight.deadline:
+                        self._settle(flight.bay_id, flight.state, REASON_TIMEOUT)
+                except Exception as e:
+                    print(f"BAY STATE ERROR: casillero {flight.bay_id}: {e}")
+            with self._lock:
+                deadlines = [flight.deadline for flight in self._flights.values()]
+            timeout = min([TICK_SECONDS] + [max(0.0, d - time.monotonic()) for d in deadlines])
+            self._wake.wait(timeout)
+
+    def _hold(self, flight):
+        """An adopted deposit never seen open: stop watching it and leave
+        it STAGED for the admin."""
+        with self._lock:
+            if self._flights.get(flight.bay_id) is not flight:
+                return
+            del self._flights[flight.bay_id]
+            self._review.add(flight.bay_id)
+        self._notify(flight.bay_id, STAGED, REASON_RESTART, db.get_bay(flight.bay_id))
+
+    def _settle(self, bay_id, expected, reason):
+        with self._lock:
+            flight = self._flights.get(bay_id)
+            if flight is not None:
+                if flight.state != expected:
+                    return False
+                del self._flights[bay_id]
+            self._review.discard(bay_id)
+        bay = db.get_bay(bay_id)
+        if flight is None and not self._untracked_in(bay, expected):
+            return False
+
+        if expected == STAGED and reason in (REASON_CLOSED, REASON_CLIENT):
+            db.confirm_deposit(bay_id)
+            state = OCCUPIED
+        else:
+            # A deposit whose door was left open is rolled back; a pickup
+            # is done whether the door closed or was left open.
+            db.clear_bay(bay_id)
+            state = IDLE
+        self._notify(bay_id, state, reason, bay)
+        self._settled(flight, state, reason)
+        return True
+
+    def _settled(self, flight, state, reason):
+        # Whoever is waiting on a flight (a deposit batch) hears how it
+        # ended, however it ended — otherwise it would wait forever.
+        if flight is None or not flight.on_settled:
+            return
+        try:
+            flight.on_settled(flight.bay_id, state, reason)
+        except Exception as e:
+            print(f"BAY STATE ERROR: {e}")
+
+    def _untracked_in(self, bay, expected):
+        # settle() on a bay this machine isn't watching (e.g. a pickup that
+        # was in flight when the server restarted): the caller has checked
+        # the code, the bay only has to be in the matching state.
+        if bay is None or not bay['pickup_code']:
+            return False
+        return bool(bay['occupied']) == (expected == PICKING_UP)
+
+    def _notify(self, bay_id, state, reason, bay):
+        if self.on_transition:
+            try:
+                self.on_transition(bay_id, state, reason, bay)
+            except Exception as e:
+                print(f"BAY STATE ERROR: {e}")
+
+
+machine = BayStateMachine(
+    deposit_timeout=config.DEPOSIT_CLOSE_TIMEOUT_SECONDS,
+    pickup_timeout=config.PICKUP_CLOSE_TIMEOUT_SECONDS,
+)
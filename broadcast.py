@@ -0,0 +1,44 @@
+"""In-process fan-out of locker events to Server-Sent Events subscribers.
+
+Each /api/events/stream connection gets its own bounded queue. Publishing
+never blocks: a subscriber that falls too far behind is flagged, and the
+stream tells its client to resync with a full /api/lockers fetch instead
+of silently dropping events.
+"""
+import queue
+import threading
+
+
+class Subscription:
+    def __init__(self, max_pending):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.overflowed = False
+
+
+class Broadcaster:
+    def __init__(self, max_pending=256):
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def subscribe(self):
+        sub = Subscription(self.max_pending)
+        with self._lock:
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def publish(self, event_type, data):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            try:
+                sub.queue.put_nowait((event_type, data))
+            except queue.Full:
+                sub.overflowed = True
+
+
+broadcaster = Broadcaster()
@@ -0,0 +1,369 @@
+"""Production build of the frontend, done at startup.
+
+index.html as written loads eight ES modules as a request chain (main.js →
+utils/*.js → widgets/*.js, each found only once the one before arrives),
+four stylesheets — one of them all of Font Awesome for ten icons — and a
+1 MB wallpaper JPEG. build() turns that into a few assets registered in the
+AssetStore, all fingerprinted (`?v=`) and precompressed like any other:
+
+- bundle/app.js: every module reachable from js/main.js, concatenated in
+  dependency order into one ES module. Imports and `export` keywords are
+  dropped (scope hoisting), so bindings stay live: config.js's `export let`
+  values still update after loadRemoteConfig. Only `import { a, b } from`
+  and exported declarations are supported; anything else, or two modules
+  declaring the same top-level name, fails the build;
+- bundle/vendor.js: the classic <script> files, concatenated;
+- bundle/app.css: the stylesheets in index.html order, url()s made
+  absolute, with Font Awesome's icon rules cut down to the `fa-*` names the
+  HTML and JS mention;
+- bundle/icons.woff2 (.ttf without brotli): the solid icon font, subset
+  to those glyphs;
+- bundle/<name>.webp: large JPEG/PNG backgrounds referenced from the CSS,
+  resized to at most WALLPAPER_MAX_WIDTH;
+- index.html rewritten to load just those, and the service worker
+  (js/sw.js) filled in with their URLs so it can serve the shell offline.
+
+Minifying uses the optional rjsmin/rcssmin packages and the font subset the
+optional fontTools; Pillow (already installed for the QR codes) does the
+wallpaper. Without one of them that step is skipped and the source is used
+as is. Expensive steps are cached on disk by a hash of their inputs
+(AssetStore.built_once), so after the first boot a restart only reads and
+hashes the sources. A failed build is reported and the original files are
+served instead.
+"""
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import posixpath
+import re
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+# Part of every cache key: bump when a build step's output changes.
+BUILD_REVISION = '1'
+ENTRY_MODULE = 'js/main.js'
+SERVICE_WORKER_TEMPLATE = 'js/sw.js'
+ICON_FONT = 'vendor/fontawesome/webfonts/fa-solid-900'
+ICON_FONT_FAMILY = 'Font Awesome 6 Free'
+# Backgrounds smaller than this aren't worth re-encoding.
+IMAGE_MIN_BYTES = 100 * 1024
+WEBP_QUALITY = 80
+
+_IMPORT = re.compile(r'^import\s+\{([^}]*)\}\s+from\s+([\'"])([^\'"]+)\2;?[ \t]*\n?', re.M)
+_ANY_IMPORT = re.compile(r'^\s*import\b', re.M)
+_EXPORT = re.compile(r'^export\s+', re.M)
+_EXPORT_DECL = re.compile(r'^export\s+(?=(?:async\s+)?function\b|const\b|let\b|var\b|class\b)', re.M)
+_TOP_LEVEL_DECL = re.compile(
+    r'^(?:export\s+)?(?:async\s+)?(?:function\*?|const|let|var|class)\s+([A-Za-z_$][\w$]*)', re.M
+)
+_ICON_NAME = re.compile(r'\bfa-[a-z0-9-]+')
+_ICON_RULE = re.compile(r'^\.(fa-[a-z0-9-]+):(?:before|after)$')
+_ICON_CONTENT = re.compile(r'content:\s*"(\\[0-9a-fA-F]+|.)"')
+_CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+_BRACE = re.compile(r'[{}]')
+_STYLESHEET = re.compile(r'^[ \t]*<link rel="stylesheet" href="([^"]+)">[ \t]*\n', re.M)
+_CLASSIC_SCRIPT = re.compile(r'^[ \t]*<script src="([^"]+)"></script>[ \t]*\n', re.M)
+_MODULE_SCRIPT = re.compile(r'<script type="module" src="([^"]+)"></script>')
+
+
+class BundleError(Exception):
+    pass
+
+
+class Bundle:
+    def __init__(self, shell, service_worker):
+        self.shell = shell  # URLs the service worker precaches
+        self.service_worker = service_worker  # bytes
+
+
+def build(store, wallpaper_max_width):
+    """Builds the bundle into `store` (an AssetStore already loaded) and
+    replaces its index.html. Raises BundleError if the sources can't be
+    bundled; index.html is replaced last, so the original files are still
+    what gets served then."""
+    root = store.root
+    html = _read(root, 'index.html').decode('utf-8')
+    stylesheets = _STYLESHEET.findall(html)
+    scripts = _CLASSIC_SCRIPT.findall(html)
+    entry = _MODULE_SCRIPT.search(html)
+    if not stylesheets or entry is None or entry.group(1) != ENTRY_MODULE:
+        raise BundleError("index.html no tiene la estructura esperada")
+
+    modules = _module_graph(root, ENTRY_MODULE)
+    icons = set(_ICON_NAME.findall(html))
+    for _, source, _ in modules:
+        icons.update(_ICON_NAME.findall(source))
+
+    sources = [source for _, source, _ in modules]
+    app_js = store.built_once(_key('app.js', str(rjsmin is not None), *sources), 'app.js',
+                              lambda: _minify_js(_hoist(modules)))
+    vendor_js = b'\n;\n'.join(_read(root, name) for name in scripts)
+
+    generated = {}
+    css = []
+    for name in stylesheets:
+        text = _read(root, name).decode('utf-8')
+        if name.startswith('vendor/fontawesome/'):
+            text, codepoints = _subset_icon_css(text, icons)
+            font = store.add_generated(*_icon_font(store, root, codepoints))
+            generated[font.name] = font
+            text += _icon_font_face(font)
+        css.append(_absolute_urls(store, root, text, name, generated, wallpaper_max_width))
+    app_css = store.built_once(_key('app.css', str(rcssmin is not None), *css), 'app.css', lambda: _minify_css('\n'.join(css)))
+
+    urls = {
+        'app.css': store.add_generated('bundle/app.css', app_css, 'text/css'),
+        'app.js': store.add_generated('bundle/app.js', app_js, 'application/javascript'),
+    }
+    if scripts:
+        urls['vendor.js'] = store.add_generated('bundle/vendor.js', vendor_js, 'application/javascript')
+
+    html = _STYLESHEET.sub('', html, count=len(stylesheets) - 1)
+    html = _STYLESHEET.sub(
+        lambda m: f'    <link rel="stylesheet" href="{_url(urls["app.css"])}">\n', html, count=1)
+    if scripts:
+        html = _CLASSIC_SCRIPT.sub('', html, count=len(scripts) - 1)
+        html = _CLASSIC_SCRIPT.sub(
+            lambda m: f'    <script src="{_url(urls["vendor.js"])}"></script>\n', html, count=1)
+    html = _MODULE_SCRIPT.sub(f'<script type="module" src="{_url(urls["app.js"])}"></script>', html)
+    index = store.add_generated('index.html', html.encode('utf-8'), 'text/html')
+
+    shell = ['/'] + [f"/{_url(asset)}" for asset in list(urls.values()) + list(generated.values())]
+    version = hashlib.sha256(''.join([index.version] + shell).encode()).hexdigest()[:16]
+    return Bundle(shell, service_worker(root, version, shell))
+
+
+def service_worker(root, version='dev', shell=()):
+    """js/sw.js with its cache version and precache list filled in. An
+    empty shell (no bundle) makes it clear its caches and unregister."""
+    template = _read(root, SERVICE_WORKER_TEMPLATE).decode('utf-8')
+    return (template
+            .replace("'__VERSION__'", json.dumps(version))
+            .replace('__SHELL__', json.dumps(list(shell)))
+            .encode('utf-8'))
+
+
+def _read(root, name):
+    try:
+        with open(os.path.join(root, name), 'rb') as f:
+            return f.read()
+    except OSError as e:
+        raise BundleError(f"no se pudo leer {name}: {e}") from e
+
+
+def _key(*parts):
+    digest = hashlib.sha256(BUILD_REVISION.encode())
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:32]
+
+
+def _url(asset):
+    return f"{asset.name}?v={asset.version}"
+
+
+# --- JavaScript ---
+def _module_graph(root, entry):
+    """[(name, source, imports)] in dependency order (post-order DFS, the
+    order ES modules are evaluated in)."""
+    ordered, done = [], set()
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name in path:
+            raise BundleError(f"import circular: {' → '.join(path + (name,))}")
+        source = _read(root, name).decode('utf-8')
+        imports = []
+        for match in _IMPORT.finditer(source):
+            names = [item.strip() for item in match.group(1).split(',') if item.strip()]
+            if any(' ' in item for item in names):
+                raise BundleError(f"{name}: import con alias no soportado")
+            imports.append((posixpath.normpath(posixpath.join(posixpath.dirname(name), match.group(3))), names))
+        if len(_ANY_IMPORT.findall(source)) != len(imports):
+            raise BundleError(f"{name}: solo se soporta `import {{ ... }} from '...'`")
+        if len(_EXPORT.findall(source)) != len(_EXPORT_DECL.findall(source)):
+            raise BundleError(f"{name}: solo se soportan declaraciones exportadas (export function/const/let)")
+        for target, _ in imports:
+            visit(target, path + (name,))
+        done.add(name)
+        ordered.append((name, source, imports))
+
+    visit(entry, ())
+    return ordered
+
+
+def _hoist(modules):
+    exported, declared = {}, {}
+    for name, source, _ in modules:
+        exported[name] = {m.group(1) for m in _TOP_LEVEL_DECL.finditer(source) if m.group(0).startswith('export')}
+        for match in _TOP_LEVEL_DECL.finditer(source):
+            other = declared.setdefault(match.group(1), name)
+            if other != name:
+                raise BundleError(f"'{match.group(1)}' está declarado en {other} y en {name}")
+    parts = []
+    for name, source, imports in modules:
+        for target, names in imports:
+            missing = set(names) - exported[target]
+            if missing:
+                raise BundleError(f"{name}: {target} no exporta {', '.join(sorted(missing))}")
+        body = _EXPORT_DECL.sub('', _IMPORT.sub('', source))
+        parts.append(f"// {name}\n{body}")
+    return '\n'.join(parts)
+
+
+def _minify_js(source):
+    if rjsmin is not None:
+        source = rjsmin.jsmin(source)
+    return source.encode('utf-8')
+
+
+# --- CSS ---
+def _minify_css(source):
+    if rcssmin is not None:
+        source = rcssmin.cssmin(source, keep_bang_comments=True)
+    return source.encode('utf-8')
+
+
+def _css_blocks(text):
+    """Splits a stylesheet into its top-level blocks (a rule, or an
+    at-rule with everything nested in it)."""
+    depth, start = 0, 0
+    for brace in _BRACE.finditer(text):
+        if brace.group() == '{':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                yield text[start:brace.end()]
+                start = brace.end()
+    if text[start:].strip():
+        yield text[start:]
+
+
+def _subset_icon_css(text, icons):
+    """Drops Font Awesome's @font-face rules (build() adds one for the
+    subset font) and the glyph rules of icons nobody uses. Returns the CSS
+    and the codepoints of the icons kept."""
+    kept, codepoints = [], set()
+    for block in _css_blocks(text):
+        head, _, body = block.partition('{')
+        selector = _CSS_COMMENT.sub('', head).strip()
+        if selector.startswith('@font-face'):
+            # Keep the license banner that precedes the first rule.
+            kept.extend(_CSS_COMMENT.findall(head))
+            continue
+        selectors = [part.strip() for part in selector.split(',')]
+        matches = [_ICON_RULE.match(part) for part in selectors]
+        content = _ICON_CONTENT.search(body)
+        if content is None or not all(matches):
+            kept.append(block)
+            continue
+        used = [part for part, match in zip(selectors, matches) if match.group(1) in icons]
+        if used:
+            glyph = content.group(1)
+            codepoints.add(int(glyph[1:], 16) if glyph.startswith('\\') else ord(glyph))
+            kept.append(f"{','.join(used)}{{{body}")
+    return ''.join(kept), codepoints
+
+
+def _icon_font(store, root, codepoints):
+    """(asset name, bytes) of the icon font, subset to `codepoints` when
+    fontTools is installed (woff2 needs brotli too; else a .ttf, which
+    AssetStore precompresses)."""
+    woff2 = importlib.util.find_spec('brotli') is not None
+    if importlib.util.find_spec('fontTools') is None or not codepoints:
+        return 'bundle/icons.woff2', _read(root, f"{ICON_FONT}.woff2")
+    flavor = 'woff2' if woff2 else 'ttf'
+    source = _read(root, f"{ICON_FONT}.ttf")
+    key = _key('icons', flavor, source, ','.join(map(str, sorted(codepoints))))
+    return f'bundle/icons.{flavor}', store.built_once(
+        key, f'icons.{flavor}', lambda: _subset_font(source, codepoints, flavor))
+
+
+def _subset_font(source, codepoints, flavor):
+    from fontTools import subset
+
+    options = subset.Options()
+    options.flavor = flavor if flavor == 'woff2' else None
+    font = subset.load_font(io.BytesIO(source), options)
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=sorted(codepoints))
+    subsetter.subset(font)
+    out = io.BytesIO()
+    subset.save_font(font, out, options)
+    return out.getvalue()
+
+
+def _icon_font_face(font):
+    font_format = 'woff2' if font.name.endswith('.woff2') else 'truetype'
+    return (
+        f'@font-face{{font-family:"{ICON_FONT_FAMILY}";font-style:normal;font-weight:900;'
+        f'font-display:block;src:url(/{_url(font)}) format("{font_format}")}}'
+    )
+
+
+def _absolute_urls(store, root, text, name, generated, wallpaper_max_width):
+    """Rewrites the url()s of a stylesheet moved into bundle/ to absolute,
+    versioned URLs, swapping in the generated font and backgrounds."""
+    base = posixpath.dirname(name)
+
+    def replace(match):
+        ref = match.group(2)
+        if ref.startswith(('data:', 'http:', 'https:', '//', '#')):
+            return match.group(0)
+        if ref.startswith('/bundle/'):
+            return match.group(0)
+        path = ref.split('?')[0].split('#')[0]
+        target = path.lstrip('/') if path.startswith('/') else posixpath.normpath(posixpath.join(base, path))
+        asset = generated.get(target)
+        if asset is None and target.lower().endswith(('.jpg', '.jpeg', '.png')):
+            asset = generated[target] = _background(store, root, target, wallpaper_max_width)
+        if asset is None:
+            asset = store.get(target)
+        return f"url(/{_url(asset)})" if asset is not None else match.group(0)
+
+    return _CSS_URL.sub(replace, text)
+
+
+def _background(store, root, name, max_width):
+    """A WebP copy of a big background image, or None to keep the
+    original (small, unreadable, or Pillow without WebP)."""
+    try:
+        source = _read(root, name)
+    except BundleError:
+        return None
+    if len(source) < IMAGE_MIN_BYTES:
+        return None
+    try:
+        data = store.built_once(_key('webp', source, str(max_width)), 'webp',
+                                lambda: _to_webp(source, max_width))
+    except (ImportError, OSError, ValueError) as e:
+        print(f"BUNDLE WARNING: no se pudo convertir {name} a WebP: {e}")
+        return None
+    stem = posixpath.splitext(posixpath.basename(name))[0]
+    return store.add_generated(f"bundle/{stem}.webp", data, 'image/webp')
+
+
+def _to_webp(source, max_width):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(source))
+    if image.width > max_width:
+        height = round(image.height * max_width / image.width)
+        image = image.resize((max_width, height), Image.LANCZOS)
+    out = io.BytesIO()
+    image.convert('RGB').save(out, 'WEBP', quality=WEBP_QUALITY, method=6)
+    return out.getvalue()
@@ -0,0 +1,66 @@
+"""Monotonic version of the locker state, for conditional and delta fetches.
+
+Every change to a bay goes through server._publish_bay, which bumps the
+version here and records which bay changed: every db.py write that touches
+a bay or its pickup email (through db.add_change_listener, so none can be
+missed), a door status change seen by the poller, a deposit flagged for
+review. /api/lockers uses the version as its ETag (a refresh with nothing
+new is a bodiless 304), and /api/lockers/changes?since=<version> returns
+only the bays changed after it.
+
+Each run starts at a base stored in the database (db.claim_version_base),
+BOOT_STRIDE past the previous run's, so versions keep increasing across
+restarts even if the clock was set back: a client holding a version from
+before a restart is older than every entry here and simply gets the full
+list. Only the last `capacity` changes are kept; asking for anything older
+also falls back to the full list.
+"""
+import threading
+from collections import deque
+
+# Room for one run's versions before the next run's base.
+BOOT_STRIDE = 2 ** 32
+
+
+class StateVersion:
+    def __init__(self, capacity=1024):
+        self._lock = threading.Lock()
+        self._base = 0
+        self._version = self._base
+        self._log = deque(maxlen=capacity)  # (version, bay_id), oldest first
+
+    def start(self, base):
+        """Sets where this run's versions start (see the module docstring)."""
+        with self._lock:
+            self._base = self._version = base
+            self._log.clear()
+
+    @property
+    def version(self):
+        with self._lock:
+            return self._version
+
+    def bump(self, bay_id):
+        with self._lock:
+            self._version += 1
+            self._log.append((self._version, bay_id))
+            return self._version
+
+    def changed_since(self, since):
+        """Bay ids changed after `since`, or None if that version is too old
+        (or from another process lifetime) to answer with a delta."""
+        with self._lock:
+            if since > self._version:
+                return None
+            oldest = self._log[0][0] if self._log else self._version + 1
+            if since < self._base or since < oldest - 1:
+                return None
+            changed = set()
+            for version, bay_id in reversed(self._log):
+                if version <= since:
+                    break
+                changed.add(bay_id)
+            return changed
+
+
+state = StateVersion()
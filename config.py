@@ -6,6 +6,9 @@ of version control and out of the codebase itself.
 """
 import os
 import secrets
+import socket
+import tempfile
+from collections import namedtuple
 from pathlib import Path
 
 try:
@@ -29,16 +32,43 @@ def _parse_id_list(value):
 # sondearlos por serial.
 DISABLED_LOCKERS = _parse_id_list(os.environ.get('DISABLED_LOCKERS', ''))
 
+SERIAL_PORT = os.environ.get('SERIAL_PORT', '/dev/ttyUSB0')
+BAUD_RATE = int(os.environ.get('BAUD_RATE', 9600))
+# Dirección de la placa a la que van los casilleros que no indican una
+# propia en LOCKER_CHANNELS (la única placa, en un sitio de una sola placa).
+BOARD_ADDRESS = int(os.environ.get('BOARD_ADDRESS', 1))
+
+# Dirección física completa de una puerta: puerto serie, dirección de la
+# placa en ese puerto (varias placas pueden compartir un bus RS-485) y canal
+# dentro de la placa.
+LockerAddress = namedtuple('LockerAddress', 'port board channel')
+
+
 # Mapeo de casillero lógico (1..NUM_LOCKERS, lo que ve el admin/cliente) a
 # canal físico real en la placa. Por defecto es 1:1 (casillero 1 = canal 1),
 # pero si un puerto de la placa se daña y las puertas se recablean a otros
 # canales, esto se ajusta en .env sin tocar código. Ejemplo: si el puerto 1
 # de la placa está frito y todo se recableó un canal más adelante,
 # LOCKER_CHANNELS=2,3,4,5 hace que el casillero 1 hable con el canal 2, etc.
+#
+# Para sitios con varias placas, cada entrada puede ser también
+# "placa:canal" (otra placa en el mismo SERIAL_PORT) o "puerto:placa:canal"
+# (otra placa en otro adaptador USB), p.ej.
+# LOCKER_CHANNELS=1,2,2:1,2:2,/dev/ttyUSB1:1:1. Se parte desde la derecha,
+# así que rutas con ":" (como /dev/serial/by-path/...) funcionan igual.
+def _parse_address(value):
+    parts = value.strip().rsplit(':', 2)
+    if len(parts) == 1:
+        return LockerAddress(SERIAL_PORT, BOARD_ADDRESS, int(parts[0]))
+    if len(parts) == 2:
+        return LockerAddress(SERIAL_PORT, int(parts[0]), int(parts[1]))
+    return LockerAddress(parts[0], int(parts[1]), int(parts[2]))
+
+
 def _parse_channel_list(value, default_length):
     if not value:
-        return list(range(1, default_length + 1))
-    return [int(x.strip()) for x in value.split(',') if x.strip()]
+        return [LockerAddress(SERIAL_PORT, BOARD_ADDRESS, ch) for ch in range(1, default_length + 1)]
+    return [_parse_address(x) for x in value.split(',') if x.strip()]
 
 
 LOCKER_CHANNELS = _parse_channel_list(os.environ.get('LOCKER_CHANNELS', ''), NUM_LOCKERS)
@@ -47,15 +77,47 @@ if len(LOCKER_CHANNELS) != NUM_LOCKERS:
         f"WARNING: LOCKER_CHANNELS tiene {len(LOCKER_CHANNELS)} canal(es) pero "
         f"NUM_LOCKERS={NUM_LOCKERS}; revisa tu .env, el mapeo puede quedar incompleto."
     )
+if len(set(LOCKER_CHANNELS)) != len(LOCKER_CHANNELS):
+    print("WARNING: LOCKER_CHANNELS repite una misma puerta física en más de un casillero; revisa tu .env.")
 
-BAY_TO_CHANNEL = {bay_id: channel for bay_id, channel in enumerate(LOCKER_CHANNELS, start=1)}
+BAY_TO_ADDRESS = {bay_id: address for bay_id, address in enumerate(LOCKER_CHANNELS, start=1)}
+ADDRESS_TO_BAY = {address: bay_id for bay_id, address in BAY_TO_ADDRESS.items()}
 
 
-def channel_for(bay_id):
-    return BAY_TO_CHANNEL.get(bay_id, bay_id)
+def address_for(bay_id):
+    return BAY_TO_ADDRESS.get(bay_id) or LockerAddress(SERIAL_PORT, BOARD_ADDRESS, bay_id)
 
-SERIAL_PORT = os.environ.get('SERIAL_PORT', '/dev/ttyUSB0')
-BAUD_RATE = int(os.environ.get('BAUD_RATE', 9600))
+
+def bay_for(address):
+    return ADDRESS_TO_BAY.get(address)
+
+# Cuánto se espera la respuesta de la placa a cada comando. La apertura casi
+# nunca responde, así que se espera poco; la consulta de estado sí responde
+# (11 bytes a 9600 baud son ~12 ms más lo que tarde la placa).
+SERIAL_OPEN_REPLY_TIMEOUT_MS = int(os.environ.get('SERIAL_OPEN_REPLY_TIMEOUT_MS', 50))
+SERIAL_STATUS_REPLY_TIMEOUT_MS = int(os.environ.get('SERIAL_STATUS_REPLY_TIMEOUT_MS', 250))
+# Carpeta de los archivos de bloqueo por puerto serie (flock): impiden que
+# dos procesos (el servidor y un script de mantenimiento) mezclen
+# tramas en el mismo tty. Vacío = solo se serializa dentro del proceso.
+SERIAL_LOCK_DIR = os.environ.get('SERIAL_LOCK_DIR', tempfile.gettempdir())
+# Tras SERIAL_BREAKER_THRESHOLD fallos de comunicación seguidos en un puerto
+# (adaptador USB desconectado, tty que desapareció, consultas de estado sin
+# respuesta) se deja de usarlo: los comandos fallan al instante y el estado
+# de las puertas se responde con lo último leído, marcado como
+# desactualizado. Se vuelve a probar tras
+# SERIAL_BREAKER_BACKOFF_SECONDS, duplicando la espera en cada intento
+# fallido hasta SERIAL_BREAKER_MAX_BACKOFF_SECONDS.
+SERIAL_BREAKER_THRESHOLD = int(os.environ.get('SERIAL_BREAKER_THRESHOLD', 3))
+SERIAL_BREAKER_BACKOFF_SECONDS = float(os.environ.get('SERIAL_BREAKER_BACKOFF_SECONDS', 1))
+SERIAL_BREAKER_MAX_BACKOFF_SECONDS = float(os.environ.get('SERIAL_BREAKER_MAX_BACKOFF_SECONDS', 30))
+
+# Sondeo en segundo plano del estado de las puertas (ver poller.py). Una
+# puerta recién abierta (o que sigue abierta) se consulta cada
+# STATUS_POLL_HOT_SECONDS durante STATUS_POLL_HOT_WINDOW_SECONDS; una puerta
+# cerrada y sin actividad solo cada STATUS_POLL_IDLE_SECONDS.
+STATUS_POLL_HOT_SECONDS = float(os.environ.get('STATUS_POLL_HOT_SECONDS', 0.5))
+STATUS_POLL_IDLE_SECONDS = float(os.environ.get('STATUS_POLL_IDLE_SECONDS', 15))
+STATUS_POLL_HOT_WINDOW_SECONDS = float(os.environ.get('STATUS_POLL_HOT_WINDOW_SECONDS', 120))
 
 PICKUP_CODE_LENGTH = int(os.environ.get('PICKUP_CODE_LENGTH', 8))
 
@@ -63,10 +125,49 @@ SESSION_LIFETIME_MINUTES = int(os.environ.get('SESSION_LIFETIME_MINUTES', 30))
 
 PICKUP_RATE_LIMIT_ATTEMPTS = int(os.environ.get('PICKUP_RATE_LIMIT_ATTEMPTS', 5))
 PICKUP_RATE_LIMIT_WINDOW_SECONDS = int(os.environ.get('PICKUP_RATE_LIMIT_WINDOW_SECONDS', 60))
+ADMIN_LOGIN_RATE_LIMIT_ATTEMPTS = int(os.environ.get('ADMIN_LOGIN_RATE_LIMIT_ATTEMPTS', 5))
+ADMIN_LOGIN_RATE_LIMIT_WINDOW_SECONDS = int(os.environ.get('ADMIN_LOGIN_RATE_LIMIT_WINDOW_SECONDS', 300))
+# Límites de intentos (ver ratelimit.py): cuántas IPs se recuerdan como
+# máximo, y si se guardan en kiosk.db para sobrevivir a un reinicio.
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 10000))
+RATE_LIMIT_PERSIST = os.environ.get('RATE_LIMIT_PERSIST', '1').strip().lower() not in ('0', 'false', 'no', '')
 
 DB_PATH = os.environ.get('DB_PATH', str(BASE_DIR / 'kiosk.db'))
 LOG_FILE = os.environ.get('LOG_FILE', str(BASE_DIR / 'action_log.log'))
 
+# Servidor HTTP. `python server.py` sirve con waitress (WSGI_THREADS hilos en
+# un solo proceso); `python server.py --dev` usa el servidor de desarrollo de
+# Flask. Siempre un solo proceso por base: un segundo se niega a arrancar.
+SERVER_HOST = os.environ.get('SERVER_HOST', '127.0.0.1')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', 5000))
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 16))
+
+# Variantes gzip/brotli ya comprimidas de los archivos del frontend (ver
+# assets.py), guardadas por hash de contenido: solo el primer arranque tras
+# un cambio paga la compresión.
+ASSET_CACHE_DIR = os.environ.get('ASSET_CACHE_DIR') or str(BASE_DIR / '.asset_cache')
+# Build del frontend al arrancar (ver bundle.py): un solo JS y un solo CSS
+# minificados, la fuente de íconos recortada a los que se usan, el fondo
+# redimensionado a WebP y un service worker que sirve todo eso sin red.
+# 0 sirve los archivos sueltos, como `server.py --dev`.
+FRONTEND_BUNDLE = os.environ.get('FRONTEND_BUNDLE', '1').strip().lower() not in ('0', 'false', 'no', '')
+# Ancho máximo (px) del fondo de pantalla servido; nunca se agranda.
+WALLPAPER_MAX_WIDTH = int(os.environ.get('WALLPAPER_MAX_WIDTH', 1920))
+
+# Registro de auditoría asíncrono (ver audit.py): los eventos se encolan y un
+# hilo los escribe por lotes. Si la cola se llena se descartan (y se deja
+# constancia de cuántos) en vez de frenar los requests.
+AUDIT_QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 200))
+AUDIT_FLUSH_SECONDS = float(os.environ.get('AUDIT_FLUSH_SECONDS', 0.2))
+
+# Retención del registro de auditoría (ver retention.py): los eventos más
+# viejos que EVENT_RETENTION_DAYS salen de kiosk.db a archivos mensuales
+# comprimidos en EVENT_ARCHIVE_DIR. 0 = nunca archivar.
+EVENT_RETENTION_DAYS = int(os.environ.get('EVENT_RETENTION_DAYS', 90))
+EVENT_ARCHIVE_DIR = os.environ.get('EVENT_ARCHIVE_DIR') or str(BASE_DIR / 'archive')
+RETENTION_INTERVAL_HOURS = float(os.environ.get('RETENTION_INTERVAL_HOURS', 24))
+
 # Identidad de marca por sitio. Todo vacío por defecto = el kiosco se ve
 # exactamente como hoy (sin encabezado de logo, botón azul de siempre, sin
 # pie de página). Un cliente se personaliza completando estos valores en
@@ -87,8 +188,56 @@ SMTP_HOST = os.environ.get('SMTP_HOST', '')
 SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
 SMTP_USERNAME = os.environ.get('SMTP_USERNAME', '')
 SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
-SMTP_FROM_EMAIL = os.environ.get('SMTP_FROM_EMAIL', SMTP_USERNAME)
+SMTP_FROM_EMAIL = os.environ.get('SMTP_FROM_EMAIL') or SMTP_USERNAME
 SMTP_FROM_NAME = os.environ.get('SMTP_FROM_NAME', 'Kiosco de Paquetería')
+# STARTTLS tras conectar (0 = no, p.ej. un servidor SMTP local de pruebas).
+# Sin SMTP_USERNAME no se hace login.
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1').strip().lower() not in ('0', 'false', 'no', '')
+SMTP_TIMEOUT_SECONDS = float(os.environ.get('SMTP_TIMEOUT_SECONDS', 10))
+
+# Cola de salida de correos (ver outbox.py): el endpoint solo encola en
+# kiosk.db y un hilo envía por lotes, reusando la sesión SMTP. Un envío
+# fallido se reintenta con espera exponencial (OUTBOX_RETRY_BASE_SECONDS,
+# duplicándose hasta OUTBOX_RETRY_MAX_SECONDS) hasta OUTBOX_MAX_ATTEMPTS.
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 20))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8))
+OUTBOX_RETRY_BASE_SECONDS = float(os.environ.get('OUTBOX_RETRY_BASE_SECONDS', 30))
+OUTBOX_RETRY_MAX_SECONDS = float(os.environ.get('OUTBOX_RETRY_MAX_SECONDS', 3600))
+# PNGs de QR que mailer.py guarda en memoria (uno por código de recogida).
+QR_CACHE_SIZE = int(os.environ.get('QR_CACHE_SIZE', 128))
+
+# Estado de cada casillero en el servidor (ver baystate.py): un depósito se
+# confirma solo al cerrarse la puerta, y si sigue abierta tras
+# DEPOSIT_CLOSE_TIMEOUT_SECONDS se anula. Una recogida libera el casillero al
+# cerrarse la puerta o, si quedó abierta, tras PICKUP_CLOSE_TIMEOUT_SECONDS.
+DEPOSIT_CLOSE_TIMEOUT_SECONDS = float(os.environ.get('DEPOSIT_CLOSE_TIMEOUT_SECONDS', 300))
+PICKUP_CLOSE_TIMEOUT_SECONDS = float(os.environ.get('PICKUP_CLOSE_TIMEOUT_SECONDS', 300))
+
+# Depósitos en lote (repartos de mensajería, ver deposits.py): las puertas
+# se abren de a una, con al menos DEPOSIT_BATCH_OPEN_INTERVAL_SECONDS entre
+# aperturas y como mucho DEPOSIT_BATCH_MAX_OPEN_DOORS abiertas a la vez. Si
+# una puerta sigue abierta tras DEPOSIT_BATCH_CLOSE_TIMEOUT_SECONDS se anula
+# ese depósito, como uno individual.
+DEPOSIT_BATCH_OPEN_INTERVAL_SECONDS = float(os.environ.get('DEPOSIT_BATCH_OPEN_INTERVAL_SECONDS', 1.0))
+DEPOSIT_BATCH_MAX_OPEN_DOORS = int(os.environ.get('DEPOSIT_BATCH_MAX_OPEN_DOORS', 4))
+DEPOSIT_BATCH_CLOSE_TIMEOUT_SECONDS = float(os.environ.get('DEPOSIT_BATCH_CLOSE_TIMEOUT_SECONDS', 600))
+
+# /api/admin/metrics (formato Prometheus) pide sesión de admin; con un token
+# aquí, un Prometheus puede leerlo también con la cabecera
+# "Authorization: Bearer <token>". Vacío = solo con sesión.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Replicación a un almacén central (ver replication.py y tools/aggregator.py):
+# con REPLICATION_URL cada cambio de casillero y cada evento del registro
+# queda en una tabla de cambios de kiosk.db, y un hilo manda solo lo nuevo,
+# comprimido y en lotes de REPLICATION_BATCH_SIZE, cada
+# REPLICATION_INTERVAL_SECONDS. SITE_ID identifica a este kiosco en el
+# agregador. Vacío = sin replicación (y sin tabla de cambios que crezca).
+REPLICATION_URL = os.environ.get('REPLICATION_URL', '').rstrip('/')
+REPLICATION_TOKEN = os.environ.get('REPLICATION_TOKEN', '')
+SITE_ID = os.environ.get('SITE_ID') or socket.gethostname()
+REPLICATION_BATCH_SIZE = int(os.environ.get('REPLICATION_BATCH_SIZE', 500))
+REPLICATION_INTERVAL_SECONDS = float(os.environ.get('REPLICATION_INTERVAL_SECONDS', 30))
 
 SECRET_KEY = os.environ.get('SECRET_KEY')
 if not SECRET_KEY:
@@ -99,10 +248,12 @@ if not SECRET_KEY:
         "reinicio). Define SECRET_KEY en .env para producción."
     )
 
-ADMIN_PASSWORD_HASH = os.environ.get('ADMIN_PASSWORD_HASH')
+# Sin hash configurado, server.py compara directamente con la contraseña
+# por defecto: derivar un hash aquí costaba ~0.3 s (varios en el Pi) en cada
+# arranque, antes de poder responder el primer request.
+DEFAULT_ADMIN_PASSWORD = 'admin123'
+ADMIN_PASSWORD_HASH = os.environ.get('ADMIN_PASSWORD_HASH') or None
 if not ADMIN_PASSWORD_HASH:
-    from werkzeug.security import generate_password_hash
-    ADMIN_PASSWORD_HASH = generate_password_hash('admin123')
     print(
         "WARNING: ADMIN_PASSWORD_HASH no está configurada en el entorno; "
         "usando la contraseña por defecto 'admin123'. Genera una real con "
@@ -2,24 +2,342 @@
 
 This is the server's single source of truth for who has what package where —
 the frontend no longer keeps its own authoritative copy in localStorage.
+
+Connections are long-lived: one write connection, used only under _lock
+(SQLite allows a single writer anyway), and a small pool of read
+connections that never touch _lock. The database runs in WAL mode, so
+readers see the last committed state without waiting for a writer; a
+burst of audit-log inserts no longer stalls /api/lockers. SQL lives in
+module constants so each connection's statement cache compiles every query
+once and reuses it. Time spent waiting for a connection (the writer lock,
+the read pool) and holding it is recorded per function in metrics.py.
+
+Active pickup codes are also kept in an in-process hash index (code → bay),
+updated by the same functions that change them. /api/pickup looks a code
+up there first, so a wrong or brute-forced code is rejected in O(1) without
+touching SQLite; a unique partial index backs the SQL lookup for hits.
+
+With fleet replication on (REPLICATION_URL set), every bay mutation and
+audit event also appends a row to the `changes` table in the same
+transaction: a sequenced change feed that replication.py ships to the
+central aggregator. Bay changes are recorded as the bay's new state (minus
+the pickup code), so replaying the feed is idempotent.
+
+Deposits also leave a structured history: confirm_deposit opens a row in
+`deposits` and clear_bay closes it, updating the hourly/daily rollup tables
+in the same transaction (see rollups.py).
+
+Every write that changes what /api/lockers shows for a bay (the bay row, or
+its pickup email in the outbox) marks that bay; once the transaction
+commits, the listeners registered with add_change_listener hear which bays
+changed. server.py publishes them and advances the state version there.
 """
+import gzip
+import json
+import os
+import queue
 import sqlite3
 import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timezone
 
 import config
+import metrics
+import rollups
 
 _lock = threading.Lock()
 
+# Per-connection tuning. synchronous=NORMAL is safe with WAL (a power cut can
+# lose the last few commits, never corrupt the file) and avoids an fsync per
+# commit on the Pi's SD card.
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KIB = 8192
+STATEMENT_CACHE_SIZE = 64
+READ_POOL_SIZE = 4
+
+SQL_INSERT_EVENT = "INSERT INTO events (ts, level, message, bay_id) VALUES (?, ?, ?, ?)"
+SQL_EVENTS_TO_ARCHIVE = "SELECT id, ts, level, message, bay_id FROM events WHERE ts < ? ORDER BY ts LIMIT ?"
+SQL_DELETE_EVENT = "DELETE FROM events WHERE id = ?"
+SQL_EVENTS_FROM = (
+    "SELECT id, ts, level, message, bay_id FROM events "
+    "WHERE (ts, id) > (?, ?) AND ts < ? ORDER BY ts, id LIMIT ?"
+)
+SQL_ALL_BAYS = "SELECT * FROM bays ORDER BY id"
+SQL_BAY = "SELECT * FROM bays WHERE id = ?"
+SQL_BAY_BY_CODE = "SELECT * FROM bays WHERE pickup_code = ? AND occupied = 1"
+SQL_ACTIVE_CODES = "SELECT id, pickup_code FROM bays WHERE occupied = 1 AND pickup_code IS NOT NULL"
+SQL_BAY_CODE = "SELECT pickup_code FROM bays WHERE id = ? AND occupied = 1"
+SQL_STAGE_DEPOSIT = "UPDATE bays SET customer_email = ?, pickup_code = ?, code_created_at = ? WHERE id = ?"
+SQL_CONFIRM_DEPOSIT = "UPDATE bays SET occupied = 1 WHERE id = ?"
+SQL_FREE_BAYS = "SELECT id FROM bays WHERE occupied = 0 AND pickup_code IS NULL AND id <= ? ORDER BY id"
+SQL_CLEAR_BAY = (
+    "UPDATE bays SET occupied = 0, customer_email = NULL, pickup_code = NULL, code_created_at = NULL "
+    "WHERE id = ?"
+)
+SQL_INSERT_EMAIL = (
+    "INSERT INTO outbox (bay_id, to_email, pickup_code, status, attempts, next_attempt_at, created_at) "
+    "VALUES (?, ?, ?, 'pending', 0, ?, ?)"
+)
+SQL_PENDING_EMAIL_FOR = (
+    "SELECT id FROM outbox WHERE bay_id = ? AND pickup_code = ? AND status = 'pending'"
+)
+SQL_DUE_EMAILS = (
+    "SELECT * FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+    "ORDER BY next_attempt_at LIMIT ?"
+)
+# Claiming an entry pushes its next attempt past the send (a lease): no
+# other reader picks it up meanwhile, and if the sender dies before
+# recording a result it simply becomes due again when the lease runs out.
+SQL_CLAIM_EMAIL = (
+    "UPDATE outbox SET next_attempt_at = ? WHERE id = ? AND status = 'pending' AND next_attempt_at <= ?"
+)
+SQL_NEXT_EMAIL_DUE = "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'"
+# A result only lands on the claim it belongs to: still pending (not
+# cancelled meanwhile by clearing the bay) and still under the same lease.
+SQL_EMAIL_SENT = (
+    "UPDATE outbox SET status = 'sent', attempts = attempts + 1, sent_at = ?, last_error = NULL "
+    "WHERE id = ? AND status = 'pending' AND next_attempt_at = ?"
+)
+SQL_EMAIL_FAILED = (
+    "UPDATE outbox SET status = ?, attempts = attempts + 1, "
+    "next_attempt_at = COALESCE(?, next_attempt_at), last_error = ? "
+    "WHERE id = ? AND status = 'pending' AND next_attempt_at = ?"
+)
+SQL_CANCEL_EMAILS = "UPDATE outbox SET status = 'cancelled' WHERE bay_id = ? AND status = 'pending'"
+SQL_EMAIL_BAY = "SELECT bay_id FROM outbox WHERE id = ?"
+SQL_GET_META = "SELECT value FROM meta WHERE key = ?"
+SQL_SET_META = (
+    "INSERT INTO meta (key, value) VALUES (?, ?) "
+    "ON CONFLICT (key) DO UPDATE SET value = excluded.value"
+)
+SQL_SAVE_RATE_LIMIT = (
+    "INSERT INTO rate_limits (name, key, window_start, current, previous) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT (name, key) DO UPDATE SET "
+    "window_start = excluded.window_start, current = excluded.current, previous = excluded.previous"
+)
+SQL_DELETE_RATE_LIMIT = "DELETE FROM rate_limits WHERE name = ? AND key = ?"
+SQL_EXPIRE_RATE_LIMITS = "DELETE FROM rate_limits WHERE name = ? AND window_start < ?"
+SQL_LOAD_RATE_LIMITS = (
+    "SELECT key, window_start, current, previous FROM rate_limits WHERE name = ? "
+    "ORDER BY window_start DESC LIMIT ?"
+)
+# Change feed (fleet replication). A bay change is a snapshot of the row
+# after the mutation, built by SQLite in the same statement; the pickup
+# code itself never leaves the kiosk.
+SQL_RECORD_BAY_CHANGE = """
+    INSERT INTO changes (ts, kind, bay_id, data)
+    SELECT ?, 'bay', id, json_object(
+        'occupied', occupied, 'email', customer_email,
+        'staged', pickup_code IS NOT NULL, 'since', code_created_at)
+    FROM bays WHERE id = ?
+"""
+SQL_RECORD_EVENT_CHANGE = "INSERT INTO changes (ts, kind, bay_id, data) VALUES (?, 'event', ?, json_array(?, ?))"
+SQL_CHANGES_AFTER = "SELECT seq, ts, kind, bay_id, data FROM changes WHERE seq > ? ORDER BY seq LIMIT ?"
+SQL_PRUNE_CHANGES = "DELETE FROM changes WHERE seq <= ?"
+SQL_FEED_HIGH_WATER = "SELECT seq FROM sqlite_sequence WHERE name = 'changes'"
+# Deposit history and its rollups (rollups.py). At most one open deposit
+# per bay (idx_deposits_open), so confirming twice records it once.
+SQL_OPEN_DEPOSIT = (
+    "INSERT OR IGNORE INTO deposits (bay_id, customer_email, staged_at, deposited_at) "
+    "SELECT id, customer_email, code_created_at, ? FROM bays WHERE id = ? AND occupied = 1"
+)
+SQL_OPEN_DEPOSIT_FOR = "SELECT id, deposited_at FROM deposits WHERE bay_id = ? AND picked_up_at IS NULL"
+SQL_CLOSE_DEPOSIT = "UPDATE deposits SET picked_up_at = ?, ended_by = ?, dwell_seconds = ? WHERE id = ?"
+SQL_OPEN_DEPOSITS = "SELECT bay_id, deposited_at FROM deposits WHERE picked_up_at IS NULL ORDER BY bay_id"
+SQL_DEPOSITS_FROM = (
+    "SELECT id, bay_id, customer_email, staged_at, deposited_at, picked_up_at, ended_by, dwell_seconds "
+    "FROM deposits WHERE (deposited_at, id) > (?, ?) AND deposited_at < ? ORDER BY deposited_at, id LIMIT ?"
+)
+SQL_ROLLUP_DEPOSIT = (
+    "INSERT INTO deposit_rollups (period, start, deposits, pickups, dwell_sum) VALUES (?, ?, 1, 0, 0) "
+    "ON CONFLICT (period, start) DO UPDATE SET deposits = deposits + 1"
+)
+SQL_ROLLUP_PICKUP = (
+    "INSERT INTO deposit_rollups (period, start, deposits, pickups, dwell_sum) VALUES (?, ?, 0, 1, ?) "
+    "ON CONFLICT (period, start) DO UPDATE SET pickups = pickups + 1, dwell_sum = dwell_sum + excluded.dwell_sum"
+)
+SQL_ROLLUP_DWELL = (
+    "INSERT INTO deposit_dwell (period, start, bucket, count) VALUES (?, ?, ?, 1) "
+    "ON CONFLICT (period, start, bucket) DO UPDATE SET count = count + 1"
+)
+SQL_ROLLUP_BAY_DEPOSIT = (
+    "INSERT INTO bay_rollups (period, start, bay_id, deposits, occupied_seconds) VALUES (?, ?, ?, 1, 0) "
+    "ON CONFLICT (period, start, bay_id) DO UPDATE SET deposits = deposits + 1"
+)
+SQL_ROLLUP_BAY_OCCUPIED = (
+    "INSERT INTO bay_rollups (period, start, bay_id, deposits, occupied_seconds) VALUES (?, ?, ?, 0, ?) "
+    "ON CONFLICT (period, start, bay_id) DO UPDATE SET "
+    "occupied_seconds = occupied_seconds + excluded.occupied_seconds"
+)
+SQL_ROLLUPS = (
+    "SELECT start, deposits, pickups, dwell_sum FROM deposit_rollups "
+    "WHERE period = ? AND start >= ? AND start < ? ORDER BY start"
+)
+SQL_ROLLUP_DWELLS = (
+    "SELECT start, bucket, count FROM deposit_dwell WHERE period = ? AND start >= ? AND start < ?"
+)
+SQL_BAY_UTILIZATION = (
+    "SELECT bay_id, SUM(deposits) AS deposits, SUM(occupied_seconds) AS occupied_seconds "
+    "FROM bay_rollups WHERE period = ? AND start >= ? AND start < ? GROUP BY bay_id"
+)
+# Latest email per bay, for the code that bay holds right now.
+SQL_EMAIL_STATUSES = """
+    SELECT o.bay_id, o.status, o.attempts, o.last_error, o.sent_at
+    FROM outbox o JOIN bays b ON b.id = o.bay_id AND b.pickup_code = o.pickup_code
+    WHERE o.id = (SELECT MAX(id) FROM outbox WHERE bay_id = o.bay_id)
+"""
+
 
 def get_connection():
-    conn = sqlite3.connect(config.DB_PATH)
+    """Opens a new, tuned connection. Server code goes through the shared
+    reader pool / writer below; this is for one-off scripts."""
+    conn = sqlite3.connect(
+        config.DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000.0,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False,
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
     return conn
 
 
+_readers = queue.LifoQueue()
+_writer = None
+
+# Bays changed by the write transaction in progress (guarded by _lock),
+# handed to the change listeners once it commits.
+_touched = set()
+_change_listeners = []
+
+# code → bay_id for every occupied bay, plus the reverse map so a bay's old
+# code can be dropped without scanning. Guarded by _index_lock; writers
+# update it right after their transaction commits.
+_code_index = {}
+_bay_codes = {}
+_index_lock = threading.Lock()
+_index_loaded = False
+
+
+@contextmanager
+def _read(function):
+    """Borrows a pooled read connection. Never waits on _lock. `function`
+    labels the time spent in metrics (the calling function's name)."""
+    started = time.perf_counter()
+    try:
+        conn = _readers.get_nowait()
+    except queue.Empty:
+        conn = get_connection()
+    acquired = time.perf_counter()
+    metrics.sqlite_wait_seconds.observe(acquired - started, 'read')
+    try:
+        yield conn
+    finally:
+        metrics.sqlite_query_seconds.observe(time.perf_counter() - acquired, 'read', function)
+        # A read never leaves a transaction open; end it anyway so this
+        # connection doesn't pin an old WAL snapshot while idle in the pool.
+        if conn.in_transaction:
+            conn.rollback()
+        if _readers.qsize() < READ_POOL_SIZE:
+            _readers.put(conn)
+        else:
+            conn.close()
+
+
+@contextmanager
+def _write(function):
+    """Runs a write transaction on the shared write connection: commits on
+    success, rolls back on error. `function` labels it as in _read()."""
+    global _writer
+    started = time.perf_counter()
+    changed = None
+    with _lock:
+        acquired = time.perf_counter()
+        metrics.sqlite_wait_seconds.observe(acquired - started, 'write')
+        try:
+            if _writer is None:
+                _writer = get_connection()
+            with _writer:
+                yield _writer
+            changed = set(_touched)
+        finally:
+            _touched.clear()
+            metrics.sqlite_query_seconds.observe(time.perf_counter() - acquired, 'write', function)
+    # Outside _lock: a listener may read (or write) the database itself.
+    if changed:
+        for callback in _change_listeners:
+            try:
+                callback(changed)
+            except Exception as e:
+                print(f"DB ERROR: listener de cambios falló: {e}")
+
+
+def add_change_listener(callback):
+    """callback(bay_ids) runs after every committed write that changed a
+    bay or its pickup email, on the thread that wrote it."""
+    _change_listeners.append(callback)
+
+
+def _touch(bay_ids):
+    # Only from inside _write().
+    _touched.update(bay_ids)
+
+
+def close_connections():
+    """Closes every pooled connection (tests/tools that switch DB_PATH)."""
+    global _writer
+    with _lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+    while True:
+        try:
+            _readers.get_nowait().close()
+        except queue.Empty:
+            break
+
+
+def _ensure_column(conn, table, column, decl):
+    """Adds a column to a table created by an older version of this file."""
+    columns = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+# Bump whenever init_db's schema changes (a table, index or column added).
+# A database already at this version, with every bay row present, skips the
+# DDL on startup: one read instead of a write transaction and its commit.
+SCHEMA_VERSION = 4
+SQL_BAY_ROWS = "SELECT COUNT(*) FROM bays WHERE id <= ?"
+
+
+def _schema_current():
+    with _read('_schema_current') as conn:
+        if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            return False
+        return conn.execute(SQL_BAY_ROWS, (config.NUM_LOCKERS,)).fetchone()[0] == config.NUM_LOCKERS
+
+
 def init_db():
-    with _lock, get_connection() as conn:
+    if not _schema_current():
+        _migrate()
+    _load_code_index()
+
+
+def _migrate():
+    with _write('_migrate') as conn:
+        # WAL is a property of the database file: set once, it sticks.
+        conn.execute("PRAGMA journal_mode = WAL")
+        # Incremental auto-vacuum lets the retention job hand freed pages
+        # back to the filesystem a bit at a time. Switching an existing file
+        # over needs one full VACUUM, done only the first time.
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
         conn.execute("""
             CREATE TABLE IF NOT EXISTS bays (
                 id INTEGER PRIMARY KEY,
@@ -29,14 +347,135 @@ def init_db():
                 code_created_at TEXT
             )
         """)
+        try:
+            # Unique live codes, and an index search instead of a table scan
+            # (rows without a code stay out of the index).
+            conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_bays_pickup_code "
+                "ON bays (pickup_code) WHERE pickup_code IS NOT NULL"
+            )
+        except sqlite3.IntegrityError:
+            print("WARNING: hay códigos de recogida duplicados en 'bays'; no se creó el índice único.")
         conn.execute("""
             CREATE TABLE IF NOT EXISTS events (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 ts TEXT NOT NULL,
                 level TEXT NOT NULL,
-                message TEXT NOT NULL
+                message TEXT NOT NULL,
+                bay_id INTEGER
             )
         """)
+        _ensure_column(conn, 'events', 'bay_id', 'INTEGER')
+        # Supports /api/admin/events: keyset pagination walks id, the
+        # filters narrow by time range, level or bay first.
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_events_ts ON events (ts)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_events_level ON events (level, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_events_bay ON events (bay_id, id)")
+        # Pickup emails waiting for (or done with) the background SMTP worker.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bay_id INTEGER NOT NULL,
+                to_email TEXT NOT NULL,
+                pickup_code TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TEXT NOT NULL,
+                last_error TEXT,
+                created_at TEXT NOT NULL,
+                sent_at TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_bay ON outbox (bay_id, id)")
+        # Sliding-window rate-limit counters (see ratelimit.py), persisted
+        # across restarts.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                window_start REAL NOT NULL,
+                current INTEGER NOT NULL,
+                previous INTEGER NOT NULL,
+                PRIMARY KEY (name, key)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("DROP TABLE IF EXISTS rate_limit_hits")
+        # Small key/value settings the server keeps across restarts.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value
+            ) WITHOUT ROWID
+        """)
+        # Change feed for fleet replication (see replication.py). Rows are
+        # deleted once the aggregator has acknowledged them.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                bay_id INTEGER,
+                data TEXT NOT NULL
+            )
+        """)
+        # Deposit history (one row per package, open until it is picked
+        # up) and the rollups kept from it; see rollups.py.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS deposits (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bay_id INTEGER NOT NULL,
+                customer_email TEXT,
+                staged_at TEXT,
+                deposited_at TEXT NOT NULL,
+                picked_up_at TEXT,
+                ended_by TEXT,
+                dwell_seconds REAL
+            )
+        """)
+        conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_deposits_open "
+            "ON deposits (bay_id) WHERE picked_up_at IS NULL"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_deposits_deposited ON deposits (deposited_at)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS deposit_rollups (
+                period TEXT NOT NULL,
+                start TEXT NOT NULL,
+                deposits INTEGER NOT NULL,
+                pickups INTEGER NOT NULL,
+                dwell_sum REAL NOT NULL,
+                PRIMARY KEY (period, start)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS deposit_dwell (
+                period TEXT NOT NULL,
+                start TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (period, start, bucket)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS bay_rollups (
+                period TEXT NOT NULL,
+                start TEXT NOT NULL,
+                bay_id INTEGER NOT NULL,
+                deposits INTEGER NOT NULL,
+                occupied_seconds REAL NOT NULL,
+                PRIMARY KEY (period, start, bay_id)
+            ) WITHOUT ROWID
+        """)
+        # Packages already in a bay when history starts: opened (from when
+        # their code was made) so their pickup is recorded, but not counted
+        # as deposits in any rollup — that happened before there were any.
+        conn.execute(
+            "INSERT OR IGNORE INTO deposits (bay_id, customer_email, staged_at, deposited_at) "
+            "SELECT id, customer_email, code_created_at, COALESCE(code_created_at, ?) "
+            "FROM bays WHERE occupied = 1",
+            (datetime.now(timezone.utc).isoformat(),),
+        )
         # Idempotent: adds any bays missing up to NUM_LOCKERS without
         # touching existing rows, so bumping the locker count for a bigger
         # site is just a config change.
@@ -44,59 +483,452 @@ def init_db():
             "INSERT OR IGNORE INTO bays (id, occupied) VALUES (?, 0)",
             [(i,) for i in range(1, config.NUM_LOCKERS + 1)],
         )
-        conn.commit()
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
 
-def log_event(level, message):
-    with _lock, get_connection() as conn:
-        conn.execute(
-            "INSERT INTO events (ts, level, message) VALUES (?, ?, ?)",
-            (datetime.now(timezone.utc).isoformat(), level, message),
-        )
-        conn.commit()
+def _load_code_index():
+    global _index_loaded
+    with _read('_load_code_index') as conn:
+        rows = conn.execute(SQL_ACTIVE_CODES).fetchall()
+    with _index_lock:
+        _code_index.clear()
+        _bay_codes.clear()
+        for row in rows:
+            _code_index[row['pickup_code']] = row['id']
+            _bay_codes[row['id']] = row['pickup_code']
+        _index_loaded = True
+
+
+def _index_set(bay_id, code):
+    with _index_lock:
+        old = _bay_codes.pop(bay_id, None)
+        if old is not None:
+            _code_index.pop(old, None)
+        if code is not None:
+            _code_index[code] = bay_id
+            _bay_codes[bay_id] = code
+
+
+def _record_bays(conn, bay_ids, now):
+    _touch(bay_ids)
+    if config.REPLICATION_URL:
+        conn.executemany(SQL_RECORD_BAY_CHANGE, [(now, bay_id) for bay_id in bay_ids])
+
+
+def _record_events(conn, events):
+    if config.REPLICATION_URL:
+        conn.executemany(SQL_RECORD_EVENT_CHANGE, [
+            (ts, bay_id, level, message) for ts, level, message, bay_id in events
+        ])
+
+
+def log_event(level, message, bay_id=None):
+    event = (datetime.now(timezone.utc).isoformat(), level, message, bay_id)
+    with _write('log_event') as conn:
+        conn.execute(SQL_INSERT_EVENT, event)
+        _record_events(conn, [event])
+
+
+def log_events(events):
+    """Inserts many (ts, level, message, bay_id) rows in one transaction —
+    used by the background audit writer to group-commit a batch."""
+    with _write('log_events') as conn:
+        conn.executemany(SQL_INSERT_EVENT, events)
+        _record_events(conn, events)
+
+
+def get_events(before_id=None, limit=100, levels=None, since=None, until=None, bay_id=None):
+    """One page of the audit log, newest first (keyset pagination on id:
+    pass the last id of a page as before_id to get the next one). since/
+    until are ISO timestamps in UTC, compared against events.ts."""
+    clauses, params = [], []
+    if before_id is not None:
+        clauses.append("id < ?")
+        params.append(before_id)
+    if levels:
+        clauses.append(f"level IN ({','.join('?' * len(levels))})")
+        params.extend(levels)
+    if since:
+        clauses.append("ts >= ?")
+        params.append(since)
+    if until:
+        clauses.append("ts < ?")
+        params.append(until)
+    if bay_id is not None:
+        clauses.append("bay_id = ?")
+        params.append(bay_id)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    sql = f"SELECT id, ts, level, message, bay_id FROM events {where} ORDER BY id DESC LIMIT ?"
+    with _read('get_events') as conn:
+        rows = conn.execute(sql, (*params, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+
+def archive_events(cutoff, archive_dir, chunk_size=5000):
+    """Moves events older than `cutoff` (ISO timestamp) out of SQLite into
+    gzip-compressed NDJSON files, one per month (events-YYYY-MM.ndjson.gz,
+    appended to if it already exists), then returns freed pages to the
+    filesystem. Works in chunks so memory stays flat however much history
+    there is. Returns the number of events archived."""
+    os.makedirs(archive_dir, exist_ok=True)
+    archived = 0
+    while True:
+        with _read('archive_events') as conn:
+            rows = conn.execute(SQL_EVENTS_TO_ARCHIVE, (cutoff, chunk_size)).fetchall()
+        if not rows:
+            break
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row['ts'][:7], []).append(dict(row))
+        # Written (and closed) before the rows are deleted: a crash between
+        # the two can only duplicate a chunk in the archive, never lose it.
+        for month, events in by_month.items():
+            path = os.path.join(archive_dir, f"events-{month}.ndjson.gz")
+            with gzip.open(path, 'at', encoding='utf-8') as f:
+                for event in events:
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        with _write('archive_events') as conn:
+            conn.executemany(SQL_DELETE_EVENT, [(row['id'],) for row in rows])
+        archived += len(rows)
+    if archived:
+        with _write('archive_events') as conn:
+            # Each step of incremental_vacuum frees one page and execute()
+            # only steps once; executescript runs it to completion.
+            conn.executescript("PRAGMA incremental_vacuum;")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return archived
+
+
+def iter_events(since=None, until=None, chunk_size=1000):
+    """Yields the audit log oldest first, optionally limited to
+    since <= ts < until, for exports. Reads in keyset chunks on (ts, id)
+    (idx_events_ts) and gives the connection back between chunks, so memory
+    stays flat and a slow download never pins a WAL snapshot."""
+    last_ts, last_id = since or '', 0
+    until = until or '\uffff'
+    while True:
+        with _read('iter_events') as conn:
+            rows = conn.execute(SQL_EVENTS_FROM, (last_ts, last_id, until, chunk_size)).fetchall()
+        for row in rows:
+            yield dict(row)
+        if len(rows) < chunk_size:
+            return
+        last_ts, last_id = rows[-1]['ts'], rows[-1]['id']
+
+
+def iter_archived_events(archive_dir, since=None, until=None):
+    """Yields the events archive_events moved out of SQLite, month file by
+    month file, optionally limited to since <= ts < until. Months entirely
+    outside the range are skipped without opening their file."""
+    try:
+        names = sorted(os.listdir(archive_dir))
+    except FileNotFoundError:
+        return
+    for name in names:
+        if not (name.startswith('events-') and name.endswith('.ndjson.gz')):
+            continue
+        month = name[len('events-'):-len('.ndjson.gz')]
+        if (since and month < since[:7]) or (until and month > until[:7]):
+            continue
+        with gzip.open(os.path.join(archive_dir, name), 'rt', encoding='utf-8') as f:
+            for line in f:
+                event = json.loads(line)
+                if (since and event['ts'] < since) or (until and event['ts'] >= until):
+                    continue
+                yield event
 
 
 def get_all_bays():
-    with get_connection() as conn:
-        rows = conn.execute("SELECT * FROM bays ORDER BY id").fetchall()
+    with _read('get_all_bays') as conn:
+        rows = conn.execute(SQL_ALL_BAYS).fetchall()
         return [dict(row) for row in rows]
 
 
 def get_bay(bay_id):
-    with get_connection() as conn:
-        row = conn.execute("SELECT * FROM bays WHERE id = ?", (bay_id,)).fetchone()
+    with _read('get_bay') as conn:
+        row = conn.execute(SQL_BAY, (bay_id,)).fetchone()
         return dict(row) if row else None
 
 
 def get_bay_by_code(code):
-    with get_connection() as conn:
-        row = conn.execute(
-            "SELECT * FROM bays WHERE pickup_code = ? AND occupied = 1", (code,)
-        ).fetchone()
+    """Occupied bay holding this pickup code, or None. Unknown codes are
+    answered from the in-memory index without a query."""
+    if not _index_loaded:
+        _load_code_index()
+    with _index_lock:
+        bay_id = _code_index.get(code)
+    if bay_id is None:
+        return None
+    with _read('get_bay_by_code') as conn:
+        row = conn.execute(SQL_BAY_BY_CODE, (code,)).fetchone()
         return dict(row) if row else None
 
 
 def stage_deposit(bay_id, email, pickup_code):
     """Records a pending deposit (door opened, not yet confirmed closed)."""
-    with _lock, get_connection() as conn:
-        conn.execute(
-            "UPDATE bays SET customer_email = ?, pickup_code = ?, code_created_at = ? WHERE id = ?",
-            (email, pickup_code, datetime.now(timezone.utc).isoformat(), bay_id),
-        )
-        conn.commit()
+    now = datetime.now(timezone.utc).isoformat()
+    with _write('stage_deposit') as conn:
+        conn.execute(SQL_STAGE_DEPOSIT, (email, pickup_code, now, bay_id))
+        _record_bays(conn, [bay_id], now)
+    # The code only becomes redeemable once the deposit is confirmed; any
+    # code the bay had before is dead from here on.
+    _index_set(bay_id, None)
+
+
+def allocate_deposits(entries, max_bay_id, exclude=()):
+    """Stages one deposit per (email, pickup_code) on the lowest-numbered
+    free bays (not occupied, no pending deposit, not in `exclude`), all in
+    one write transaction so a concurrent deposit can't take the same bay.
+    Returns [(bay_id, email, pickup_code)] — shorter than `entries` if
+    there weren't enough free bays."""
+    now = datetime.now(timezone.utc).isoformat()
+    with _write('allocate_deposits') as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        free = [row['id'] for row in conn.execute(SQL_FREE_BAYS, (max_bay_id,)) if row['id'] not in exclude]
+        allocated = [(bay_id, email, code) for bay_id, (email, code) in zip(free, entries)]
+        conn.executemany(SQL_STAGE_DEPOSIT, [(email, code, now, bay_id) for bay_id, email, code in allocated])
+        _record_bays(conn, [bay_id for bay_id, _, _ in allocated], now)
+    for bay_id, _, _ in allocated:
+        _index_set(bay_id, None)
+    return allocated
 
 
 def confirm_deposit(bay_id):
     """Marks a staged deposit as occupied once the door is confirmed closed."""
-    with _lock, get_connection() as conn:
-        conn.execute("UPDATE bays SET occupied = 1 WHERE id = ?", (bay_id,))
-        conn.commit()
+    now = datetime.now(timezone.utc)
+    with _write('confirm_deposit') as conn:
+        conn.execute(SQL_CONFIRM_DEPOSIT, (bay_id,))
+        _record_bays(conn, [bay_id], now.isoformat())
+        if conn.execute(SQL_OPEN_DEPOSIT, (now.isoformat(), bay_id)).rowcount:
+            for period in rollups.PERIODS:
+                key = rollups.period_key(period, now)
+                conn.execute(SQL_ROLLUP_DEPOSIT, (period, key))
+                conn.execute(SQL_ROLLUP_BAY_DEPOSIT, (period, key, bay_id))
+        row = conn.execute(SQL_BAY_CODE, (bay_id,)).fetchone()
+    _index_set(bay_id, row['pickup_code'] if row else None)
 
 
-def clear_bay(bay_id):
-    with _lock, get_connection() as conn:
-        conn.execute(
-            "UPDATE bays SET occupied = 0, customer_email = NULL, pickup_code = NULL, code_created_at = NULL WHERE id = ?",
-            (bay_id,),
-        )
-        conn.commit()
+def clear_bay(bay_id, ended_by='pickup'):
+    """Frees a bay. If it held a package, its deposit is closed in the
+    history: `ended_by` is 'pickup' (the customer took it) or 'admin'
+    (removed by hand); only pickups count towards dwell statistics."""
+    now = datetime.now(timezone.utc)
+    with _write('clear_bay') as conn:
+        conn.execute(SQL_CLEAR_BAY, (bay_id,))
+        _record_bays(conn, [bay_id], now.isoformat())
+        # The code is dead: don't email it to anyone after the fact.
+        conn.execute(SQL_CANCEL_EMAILS, (bay_id,))
+        deposit = conn.execute(SQL_OPEN_DEPOSIT_FOR, (bay_id,)).fetchone()
+        if deposit:
+            _close_deposit(conn, bay_id, deposit, now, ended_by)
+    _index_set(bay_id, None)
+
+
+def _close_deposit(conn, bay_id, deposit, now, ended_by):
+    deposited_at = rollups.parse_ts(deposit['deposited_at'])
+    dwell = max(0.0, (now - deposited_at).total_seconds())
+    conn.execute(SQL_CLOSE_DEPOSIT, (now.isoformat(), ended_by, dwell, deposit['id']))
+    if ended_by == 'pickup':
+        bucket = rollups.dwell_bucket(dwell)
+        for period in rollups.PERIODS:
+            key = rollups.period_key(period, now)
+            conn.execute(SQL_ROLLUP_PICKUP, (period, key, dwell))
+            conn.execute(SQL_ROLLUP_DWELL, (period, key, bucket))
+    conn.executemany(SQL_ROLLUP_BAY_OCCUPIED, [
+        (period, key, bay_id, seconds)
+        for period, key, seconds in rollups.occupancy_segments(deposited_at, now)
+    ])
+
+
+def get_rollups(period, since, until):
+    """Rollup rows of one period kind with since <= start < until, plus
+    their dwell histograms as {start: {bucket: count}}."""
+    with _read('get_rollups') as conn:
+        rows = [dict(row) for row in conn.execute(SQL_ROLLUPS, (period, since, until))]
+        dwells = {}
+        for row in conn.execute(SQL_ROLLUP_DWELLS, (period, since, until)):
+            dwells.setdefault(row['start'], {})[row['bucket']] = row['count']
+    return rows, dwells
+
+
+def get_bay_utilization(period, since, until):
+    """Deposits and occupied seconds per bay, summed over the closed
+    occupancies recorded in [since, until)."""
+    with _read('get_bay_utilization') as conn:
+        return [dict(row) for row in conn.execute(SQL_BAY_UTILIZATION, (period, since, until))]
+
+
+def get_open_deposits():
+    """Packages still in a bay: [{bay_id, deposited_at}]."""
+    with _read('get_open_deposits') as conn:
+        return [dict(row) for row in conn.execute(SQL_OPEN_DEPOSITS)]
+
+
+def iter_deposits(since=None, until=None, chunk_size=1000):
+    """Yields the deposit history in deposit order, optionally limited to
+    since <= deposited_at < until, in keyset chunks like iter_events."""
+    last_ts, last_id = since or '', 0
+    until = until or '\uffff'
+    while True:
+        with _read('iter_deposits') as conn:
+            rows = conn.execute(SQL_DEPOSITS_FROM, (last_ts, last_id, until, chunk_size)).fetchall()
+        for row in rows:
+            yield dict(row)
+        if len(rows) < chunk_size:
+            return
+        last_ts, last_id = rows[-1]['deposited_at'], rows[-1]['id']
+
+
+def start_change_feed():
+    """Seeds an empty change feed with the current state of every bay, so
+    an aggregator that starts from it sees the whole site and not just
+    what changes after replication was turned on. No-op once the feed has
+    ever had a row (sqlite_sequence remembers it even after pruning)."""
+    now = datetime.now(timezone.utc).isoformat()
+    with _write('start_change_feed') as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        if conn.execute(SQL_FEED_HIGH_WATER).fetchone():
+            return
+        ids = [row['id'] for row in conn.execute(SQL_ALL_BAYS)]
+        conn.executemany(SQL_RECORD_BAY_CHANGE, [(now, bay_id) for bay_id in ids])
+
+
+def get_changes(after_seq, limit):
+    """Up to `limit` change-feed rows with seq > after_seq, oldest first."""
+    with _read('get_changes') as conn:
+        return conn.execute(SQL_CHANGES_AFTER, (after_seq, limit)).fetchall()
+
+
+def change_feed_high_water():
+    """The highest seq the change feed has ever handed out (0 if none)."""
+    with _read('change_feed_high_water') as conn:
+        row = conn.execute(SQL_FEED_HIGH_WATER).fetchone()
+    return row['seq'] if row else 0
+
+
+def prune_changes(up_to_seq):
+    """Drops change-feed rows the aggregator has acknowledged."""
+    with _write('prune_changes') as conn:
+        conn.execute(SQL_PRUNE_CHANGES, (up_to_seq,))
+
+
+def enqueue_email(bay_id, to_email, pickup_code):
+    """Queues the pickup email for a bay in the outbox and returns its id.
+    Asking again while the same code is still pending returns the
+    existing entry instead of queueing a duplicate."""
+    now = datetime.now(timezone.utc).isoformat()
+    with _write('enqueue_email') as conn:
+        row = conn.execute(SQL_PENDING_EMAIL_FOR, (bay_id, pickup_code)).fetchone()
+        if row:
+            return row['id']
+        _touch([bay_id])
+        return conn.execute(SQL_INSERT_EMAIL, (bay_id, to_email, pickup_code, now, now)).lastrowid
+
+
+def enqueue_emails(items):
+    """enqueue_email for many (bay_id, to_email, pickup_code) at once, in a
+    single transaction. Returns the outbox ids in the same order."""
+    now = datetime.now(timezone.utc).isoformat()
+    ids = []
+    with _write('enqueue_emails') as conn:
+        for bay_id, to_email, pickup_code in items:
+            row = conn.execute(SQL_PENDING_EMAIL_FOR, (bay_id, pickup_code)).fetchone()
+            if row:
+                ids.append(row['id'])
+            else:
+                _touch([bay_id])
+                ids.append(conn.execute(SQL_INSERT_EMAIL, (bay_id, to_email, pickup_code, now, now)).lastrowid)
+    return ids
+
+
+def claim_due_emails(now, limit, lease_until):
+    """Pending outbox entries whose next attempt is at or before `now`,
+    claimed until `lease_until` in the same transaction. An entry claimed
+    by someone else in between is left out. The entries come back with
+    next_attempt_at = lease_until: that is the claim mark_email_sent /
+    mark_email_failed have to match."""
+    with _write('claim_due_emails') as conn:
+        rows = conn.execute(SQL_DUE_EMAILS, (now, limit)).fetchall()
+        return [
+            dict(row, next_attempt_at=lease_until) for row in rows
+            if conn.execute(SQL_CLAIM_EMAIL, (lease_until, row['id'], now)).rowcount
+        ]
+
+
+def next_email_due():
+    """ISO timestamp of the earliest pending attempt, or None."""
+    with _read('next_email_due') as conn:
+        return conn.execute(SQL_NEXT_EMAIL_DUE).fetchone()[0]
+
+
+def mark_email_sent(email_id, lease_until):
+    """Records a delivered email. Returns False if the entry is no longer
+    the one claimed until lease_until (cancelled, or claimed again)."""
+    with _write('mark_email_sent') as conn:
+        if not conn.execute(SQL_EMAIL_SENT, (datetime.now(timezone.utc).isoformat(), email_id, lease_until)).rowcount:
+            return False
+        _touch_email(conn, email_id)
+    return True
+
+
+def mark_email_failed(email_id, lease_until, error, next_attempt_at=None):
+    """Records a failed attempt. With next_attempt_at the entry stays
+    pending and is retried then; without it, it is given up on. Returns
+    False, like mark_email_sent, if the claim is gone."""
+    status = 'pending' if next_attempt_at else 'failed'
+    with _write('mark_email_failed') as conn:
+        if not conn.execute(SQL_EMAIL_FAILED, (status, next_attempt_at, error, email_id, lease_until)).rowcount:
+            return False
+        _touch_email(conn, email_id)
+    return True
+
+
+def _touch_email(conn, email_id):
+    row = conn.execute(SQL_EMAIL_BAY, (email_id,)).fetchone()
+    if row:
+        _touch([row['bay_id']])
+
+
+def get_email_statuses():
+    """{bay_id: {status, attempts, last_error, sent_at}} for the latest
+    pickup email of each bay, if it still matches the bay's current code."""
+    with _read('get_email_statuses') as conn:
+        rows = conn.execute(SQL_EMAIL_STATUSES).fetchall()
+        return {row['bay_id']: dict(row) for row in rows}
+
+
+def claim_version_base(floor, stride):
+    """Start of this run's state versions (changes.py): at least `stride`
+    past the previous run's, and never below `floor`. Stored, so versions
+    keep increasing across restarts whatever the clock does."""
+    with _write('claim_version_base') as conn:
+        row = conn.execute(SQL_GET_META, ('state_version_base',)).fetchone()
+        base = max(floor, row['value'] + stride) if row else floor
+        conn.execute(SQL_SET_META, ('state_version_base', base))
+    return base
+
+
+def save_rate_limit(name, key, window_start, current, previous):
+    with _write('save_rate_limit') as conn:
+        conn.execute(SQL_SAVE_RATE_LIMIT, (name, key, window_start, current, previous))
+
+
+def delete_rate_limit(name, key):
+    with _write('delete_rate_limit') as conn:
+        conn.execute(SQL_DELETE_RATE_LIMIT, (name, key))
+
+
+def expire_rate_limits(name, expired_before):
+    with _write('expire_rate_limits') as conn:
+        conn.execute(SQL_EXPIRE_RATE_LIMITS, (name, expired_before))
+
+
+def load_rate_limits(name, expired_before, limit):
+    """Drops a limiter's expired keys, then returns up to `limit` of the
+    rest as (key, window_start, current, previous), oldest first."""
+    expire_rate_limits(name, expired_before)
+    with _read('load_rate_limits') as conn:
+        rows = conn.execute(SQL_LOAD_RATE_LIMITS, (name, limit)).fetchall()
+    return [tuple(row) for row in reversed(rows)]
@@ -0,0 +1,220 @@
+"""Batch deposits for courier delivery runs.
+
+A single deposit is one request to open a door, a wait at the kiosk until
+it closes, a confirm, and a send-email — three round-trips and a full
+refresh per package, paced by the admin. A batch takes a list of emails
+instead. server.py allocates free bays for all of them in one transaction
+(db.allocate_deposits), then a BatchDepositor thread runs the doors:
+
+- doors are opened one at a time, at least `open_interval` apart and with
+  at most `max_open` open at once, so the board never fires a burst of
+  solenoids and the courier gets the next door as soon as one is filled;
+- each opened door is handed to baystate.machine, which confirms that
+  deposit as soon as the door closes, whatever the state of the others,
+  and rolls it back if it is still open after `close_timeout`;
+- a door that fails to open frees its bay again;
+- an admin clearing a bay mid-batch ends that item as cleared (its door
+  is not opened if it hadn't been yet);
+- once every door is closed or given up on, the pickup emails of the
+  confirmed deposits are queued in one transaction, so the outbox sends
+  them over a single SMTP session.
+
+Progress lives in memory (the last few batches) and is read through
+/api/admin/deposit/batch/<id>.
+"""
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import baystate
+import config
+import db
+import hardware
+import outbox
+from poller import poller
+
+# Finished batches kept around for their status endpoint.
+MAX_KEPT_BATCHES = 20
+
+STATUS_WAITING = 'waiting'
+STATUS_OPEN = 'open'
+STATUS_DEPOSITED = 'deposited'
+STATUS_OPEN_FAILED = 'open_failed'
+STATUS_TIMEOUT = 'timeout'
+STATUS_CLEARED = 'cleared'
+
+
+class DepositItem:
+    def __init__(self, bay_id, address, email, pickup_code):
+        self.bay_id = bay_id
+        self.address = address
+        self.email = email
+        self.pickup_code = pickup_code
+        self.status = STATUS_WAITING
+        self.opened_at = None  # monotonic
+        self.email_id = None
+
+    def to_dict(self):
+        return {
+            "bayId": self.bay_id,
+            "email": self.email,
+            "pickupCode": self.pickup_code,
+            "status": self.status,
+            "emailId": self.email_id,
+        }
+
+
+class DepositBatch:
+    def __init__(self, batch_id, items, send_emails):
+        self.id = batch_id
+        self.items = items
+        self.send_emails = send_emails
+        self.created_at = datetime.now(timezone.utc).isoformat()
+        self.finished = False
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "createdAt": self.created_at,
+            "finished": self.finished,
+            "sendEmails": self.send_emails,
+            "items": [item.to_dict() for item in self.items],
+        }
+
+
+class BatchDepositor:
+    def __init__(self, open_interval, max_open, close_timeout, on_update=None):
+        self.open_interval = open_interval
+        self.max_open = max(1, max_open)
+        self.close_timeout = close_timeout
+        # on_update(batch, item) runs on the batch thread after every
+        # change of an item's status (server.py logs and publishes it), and
+        # once more with item=None when the batch is finished.
+        self.on_update = on_update
+        self._ids = itertools.count(1)
+        self._batches = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, allocated, addresses, send_emails=True):
+        """Runs a batch over already-staged deposits: allocated is
+        db.allocate_deposits' result, addresses maps bay id → door."""
+        items = [DepositItem(bay_id, addresses[bay_id], email, code) for bay_id, email, code in allocated]
+        with self._lock:
+            batch = DepositBatch(next(self._ids), items, send_emails)
+            self._batches[batch.id] = batch
+            while len(self._batches) > MAX_KEPT_BATCHES:
+                oldest = next(iter(self._batches.values()))
+                if not oldest.finished:
+                    break
+                self._batches.popitem(last=False)
+        threading.Thread(target=self._run, args=(batch,), name=f'deposit-batch-{batch.id}', daemon=True).start()
+        return batch
+
+    def get(self, batch_id):
+        with self._lock:
+            return self._batches.get(batch_id)
+
+    def busy_bays(self):
+        """Bays with a door still waiting or open in a running batch."""
+        with self._lock:
+            return {
+                item.bay_id
+                for batch in self._batches.values() if not batch.finished
+                for item in batch.items if item.status in (STATUS_WAITING, STATUS_OPEN)
+            }
+
+    def _run(self, batch):
+        wake = threading.Event()
+        settled = {}  # bay_id → status, filled in by baystate.machine
+
+        def on_settled(bay_id, state, reason):
+            if state == baystate.OCCUPIED:
+                status = STATUS_DEPOSITED
+            elif reason == baystate.REASON_CLEARED:
+                status = STATUS_CLEARED
+            else:
+                status = STATUS_TIMEOUT
+            with self._lock:
+                settled[bay_id] = status
+            wake.set()
+
+        waiting = list(batch.items)
+        open_items = []
+        last_open = 0.0
+        try:
+            while waiting or open_items:
+                wake.clear()
+                now = time.monotonic()
+                for item in list(open_items):
+                    with self._lock:
+                        status = settled.pop(item.bay_id, None)
+                    if status is not None:
+                        self._finish(batch, item, status, open_items)
+
+                if waiting and len(open_items) < self.max_open and now - last_open >= self.open_interval:
+                    item = waiting.pop(0)
+                    last_open = now
+                    self._open(batch, item, on_settled, open_items)
+                    continue
+
+                timeout = 0.5
+                if waiting and len(open_items) < self.max_open:
+                    timeout = min(timeout, max(0.0, last_open + self.open_interval - now))
+                wake.wait(timeout)
+        finally:
+            self._queue_emails(batch)
+            batch.finished = True
+            self._notify(batch, None)
+
+    def _open(self, batch, item, on_settled, open_items):
+        bay = db.get_bay(item.bay_id)
+        if not bay or bay['pickup_code'] != item.pickup_code:
+            # Cleared by the admin before its turn came: nothing to open.
+            item.status = STATUS_CLEARED
+        elif hardware.open_locker(item.address):
+            poller.note_opened(item.address)
+            item.opened_at = time.monotonic()
+            item.status = STATUS_OPEN
+            open_items.append(item)
+            baystate.machine.deposit_opened(item.bay_id, item.address, self.close_timeout, on_settled)
+        else:
+            # Nobody can put a package in a door that didn't open: give the
+            # bay back instead of leaving a deposit staged on it.
+            db.clear_bay(item.bay_id)
+            item.status = STATUS_OPEN_FAILED
+        self._notify(batch, item)
+
+    def _finish(self, batch, item, status, open_items):
+        open_items.remove(item)
+        item.status = status
+        self._notify(batch, item)
+
+    def _queue_emails(self, batch):
+        deposited = [item for item in batch.items if item.status == STATUS_DEPOSITED]
+        if not batch.send_emails or not deposited:
+            return
+        try:
+            email_ids = outbox.worker.queue_many(
+                [(item.bay_id, item.email, item.pickup_code) for item in deposited]
+            )
+        except Exception as e:
+            print(f"DEPOSIT BATCH ERROR: no se pudieron encolar los correos del lote {batch.id}: {e}")
+            return
+        for item, email_id in zip(deposited, email_ids):
+            item.email_id = email_id
+
+    def _notify(self, batch, item):
+        if self.on_update:
+            try:
+                self.on_update(batch, item)
+            except Exception as e:
+                print(f"DEPOSIT BATCH ERROR: {e}")
+
+
+depositor = BatchDepositor(
+    open_interval=config.DEPOSIT_BATCH_OPEN_INTERVAL_SECONDS,
+    max_open=config.DEPOSIT_BATCH_MAX_OPEN_DOORS,
+    close_timeout=config.DEPOSIT_BATCH_CLOSE_TIMEOUT_SECONDS,
+)
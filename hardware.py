@@ -2,19 +2,76 @@
 
 Binary framing confirmed working against the real board — kept as-is, just
 moved out of server.py so the Flask routes stay focused on HTTP concerns.
+
+The port itself is owned by a single long-lived worker thread (SerialLink):
+it is opened once, every command goes through that thread's queue, and
+callers get a Future back. Concurrent Flask requests therefore never open
+the same tty twice or interleave frames, and a dropped USB adapter is just
+reopened on the next command.
+
+Sites with several boards get one SerialLink per port (boards sharing an
+RS-485 bus share their port's link). Every function takes a
+config.LockerAddress (port, board, channel); a status sweep queues each
+door on its own port's worker, so ports are polled in parallel and a sweep
+takes as long as the busiest port, not the total door count.
+
+The worker thread only serializes commands within one process. Each
+write+read transaction additionally holds an exclusive flock on a per-port
+lock file (SERIAL_LOCK_DIR), so another process (a maintenance script run
+while the kiosk is up) can share the tty without ever interleaving frames.
+
+A dead port (USB adapter unplugged, tty gone) must not cost every caller a
+failed open: each SerialLink has a CircuitBreaker that opens after a few
+consecutive comms failures — an error on the port, or a status query with
+no readable reply (a powered board that stopped answering, an open
+line). While it is open, commands fail at once
+without touching the port, and status reads answer with the last state
+read from each door, marked stale. Every so often (exponential backoff)
+one command goes through as a probe; the first that succeeds closes the
+breaker again.
 """
+import atexit
+import contextlib
 import functools
+import itertools
+import os
+import queue
+import threading
 import time
+from concurrent.futures import Future
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Not on Linux/macOS: in-process serialization only.
+    fcntl = None
 
 import serial
 
 import config
+import metrics
 
 HEADER = b'\x57\x4B\x4C\x59'  # "WKLY"
-BOARD_ADDR = b'\x01'
+BOARD_ADDR = b'\x01'  # Default board; others come from config.LockerAddress
 CMD_BYTE_OPEN = b'\x82'
 CMD_BYTE_CHECK = b'\x83'
 RESPONSE_LENGTH = 11
+# Smallest well-formed frame: header + length + one payload byte + checksum.
+MIN_FRAME_LENGTH = 4 + 1 + 1 + 1
+# Granularity of a blocking read while waiting for a reply; the per-command
+# deadline (SERIAL_*_REPLY_TIMEOUT_MS) is what actually bounds the wait.
+READ_POLL_SECONDS = 0.01
+
+# Upper bound a caller waits on a queued command (queue wait + round-trip)
+# before giving up on it — the serial read timeout bounds each transaction,
+# so this only trips if the queue is badly backed up.
+COMMAND_WAIT_SECONDS = 10.0
+
+# Queue priorities: an open command jumps ahead of queued background status
+# sweeps, so a customer never waits behind a full poll of every door.
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
 
 
 def _calculate_checksum(payload):
@@ -22,57 +79,522 @@ def _calculate_checksum(payload):
     return bytes([checksum])
 
 
-def _build_command(cmd_byte, channel, data_bytes=b''):
+def _build_command(cmd_byte, channel, data_bytes=b'', board=BOARD_ADDR[0]):
     channel_byte = bytes([channel])
-    payload = BOARD_ADDR + cmd_byte + channel_byte + data_bytes
+    payload = bytes([board]) + cmd_byte + channel_byte + data_bytes
     length = 4 + 1 + len(payload) + 1
     length_byte = bytes([length])
     checksum = _calculate_checksum(payload)
     return HEADER + length_byte + payload + checksum
 
 
-def _send_serial_command(command):
-    try:
-        with serial.Serial(config.SERIAL_PORT, config.BAUD_RATE, timeout=1.0) as ser:
-            ser.flushInput()
-            ser.flushOutput()
-            ser.write(command)
-            time.sleep(0.1)
-            return ser.read(RESPONSE_LENGTH)
-    except serial.SerialException as e:
-        print(f"SERIAL ERROR: {e}")
+class FrameDecoder:
+    """Incremental parser for board frames.
+
+    Bytes are fed in as they arrive; complete frames come out. The decoder
+    resyncs on the WKLY header, uses the length byte to know when a frame
+    is complete, and drops frames whose XOR checksum (same rule as
+    _build_command) doesn't match — so line noise or a half-read reply
+    from a previous command never gets mistaken for an answer.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self.checksum_errors = 0
+
+    def reset(self):
+        self._buf.clear()
+
+    def feed(self, data):
+        """Adds bytes to the buffer and returns every complete frame in it."""
+        self._buf += data
+        frames = []
+        while True:
+            start = self._buf.find(HEADER)
+            if start < 0:
+                # Keep a possible partial header at the tail for the next feed.
+                del self._buf[:max(0, len(self._buf) - (len(HEADER) - 1))]
+                return frames
+            del self._buf[:start]
+            if len(self._buf) <= len(HEADER):
+                return frames
+            length = self._buf[len(HEADER)]
+            if length < MIN_FRAME_LENGTH:
+                del self._buf[:1]
+                continue
+            if len(self._buf) < length:
+                return frames
+            frame = bytes(self._buf[:length])
+            if _calculate_checksum(frame[5:-1]) != frame[-1:]:
+                self.checksum_errors += 1
+                del self._buf[:1]
+                continue
+            del self._buf[:length]
+            frames.append(frame)
+
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half_open'
+
+
+def _reply_matches(command, frame):
+    """A reply answers a command if board address, command byte and channel
+    all match (command payload is addr/cmd/channel at offsets 5..7; reply
+    carries addr at 5, cmd at 6 and channel at 8)."""
+    return (len(frame) >= RESPONSE_LENGTH and
+            frame[5] == command[5] and
+            frame[6] == command[6] and
+            frame[8] == command[7])
+
+
+class CircuitBreaker:
+    """Failure gate for one port.
+
+    closed → open after `threshold` consecutive comms failures. While open,
+    allow() refuses everything until the backoff has passed; then a single
+    command is let through as a probe (half_open). If it succeeds the
+    breaker closes, if not it reopens with the backoff doubled, up to
+    max_backoff. Only the link's worker thread calls allow()/record();
+    other threads just read the state.
+    """
+
+    def __init__(self, threshold, base_backoff, max_backoff):
+        self.threshold = max(1, threshold)
+        self.base_backoff = base_backoff
+        self.max_backoff = max(base_backoff, max_backoff)
+        self.state = BREAKER_CLOSED
+        self._failures = 0
+        self._backoff = base_backoff
+        self._retry_at = 0.0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def rejecting(self):
+        """True if a new command would be refused: the breaker is open and
+        no probe is due yet (or one is already running)."""
+        with self._lock:
+            if self.state == BREAKER_OPEN:
+                return time.monotonic() < self._retry_at
+            return self.state == BREAKER_HALF_OPEN
+
+    def allow(self):
+        with self._lock:
+            if self.state == BREAKER_CLOSED:
+                return True
+            if self.state == BREAKER_OPEN and time.monotonic() >= self._retry_at:
+                self.state = BREAKER_HALF_OPEN
+                return True
+            return False
+
+    def record(self, ok):
+        """Feeds one transaction's outcome. Returns the new state if this
+        changed whether the port is usable (opened/closed), else None.
+        ok=None means the outcome says nothing (an open with no reply, as
+        usual): it counts neither way, and a probe that ends like that
+        leaves the breaker open for another round of the same backoff."""
+        with self._lock:
+            if ok is None:
+                if self.state == BREAKER_HALF_OPEN:
+                    self.state = BREAKER_OPEN
+                    self._retry_at = time.monotonic() + self._backoff
+                return None
+            if ok:
+                self._failures = 0
+                if self.state == BREAKER_CLOSED:
+                    return None
+                self.state = BREAKER_CLOSED
+                self._backoff = self.base_backoff
+                self._opened_at = None
+                return BREAKER_CLOSED
+            self._failures += 1
+            if self.state == BREAKER_HALF_OPEN:
+                self._backoff = min(self._backoff * 2, self.max_backoff)
+            elif self._failures < self.threshold:
+                return None
+            previous = self.state
+            self.state = BREAKER_OPEN
+            self._retry_at = time.monotonic() + self._backoff
+            if previous == BREAKER_CLOSED:
+                self._opened_at = datetime.now(timezone.utc).isoformat()
+                return BREAKER_OPEN
+            return None
+
+    def snapshot(self):
+        with self._lock:
+            retry_in = None
+            if self.state == BREAKER_OPEN:
+                retry_in = round(max(0.0, self._retry_at - time.monotonic()), 1)
+            return {
+                "state": self.state,
+                "failures": self._failures,
+                "openSince": self._opened_at,
+                "retryIn": retry_in,
+            }
+
+
+class SerialLink:
+    """Single owner of one serial port: a worker thread plus a command queue.
+
+    The port stays open between commands. If a transaction fails (adapter
+    unplugged, tty gone) the port is closed and reopened on the next
+    command, so callers never have to manage reconnection themselves.
+    If it keeps failing, the breaker stops trying except for the odd probe.
+    """
+
+    def __init__(self, port, baudrate):
+        self.port = port
+        self.baudrate = baudrate
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._ser = None
+        self._decoder = FrameDecoder()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._latency = {}
+        self._lock_path = _lock_path(port)
+        self._lock_fd = None
+        self._last_error = None
+        self.breaker = CircuitBreaker(
+            config.SERIAL_BREAKER_THRESHOLD,
+            config.SERIAL_BREAKER_BACKOFF_SECONDS,
+            config.SERIAL_BREAKER_MAX_BACKOFF_SECONDS,
+        )
+
+    def submit(self, command, priority=PRIORITY_NORMAL):
+        """Queues a raw frame for the worker. Returns a Future resolving to
+        the reply bytes (possibly empty), or None on a comms failure — at
+        once, without queueing, while the breaker is open."""
+        future = Future()
+        if self.breaker.rejecting():
+            metrics.serial_results.inc(self.port, _command_name(command), "breaker_open")
+            future.set_result(None)
+            return future
+        self._ensure_started()
+        self._queue.put((priority, next(self._seq), future, command))
+        return future
+
+    def close(self):
+        if self._thread and self._thread.is_alive():
+            self._queue.put((PRIORITY_URGENT, -1, None, None))
+            self._thread.join(timeout=2.0)
+        self._close_port()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    @property
+    def checksum_errors(self):
+        return self._decoder.checksum_errors
+
+    def latency_stats(self):
+        """Round-trip latency per command byte, in milliseconds."""
+        with self._stats_lock:
+            return {name: dict(stats) for name, stats in self._latency.items()}
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name=f'serial-link:{self.port}', daemon=True,
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            _, _, future, command = self._queue.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            # Queued before the breaker opened (or behind the probe that
+            # just failed): fail it without touching the port.
+            if not self.breaker.allow():
+                metrics.serial_results.inc(self.port, _command_name(command), "breaker_open")
+                future.set_result(None)
+                continue
+            started = time.monotonic()
+            checksum_errors = self._decoder.checksum_errors
+            response = self._transact(command)
+            elapsed = time.monotonic() - started
+            self._record_latency(command, elapsed, response is not None)
+            self._record_metrics(command, elapsed, response, self._decoder.checksum_errors - checksum_errors)
+            self._record_outcome(self._outcome(command, response))
+            future.set_result(response)
+
+    def _outcome(self, command, response):
+        """For the breaker: a status query always gets a reply from a
+        working board, so none (or one that can't be read) is a failure —
+        a powered board that stopped answering, or an open line. An open
+        usually gets no reply; that alone says nothing."""
+        if response is None:
+            return False
+        if _command_name(command) != "check":
+            return True if response else None
+        if _status_byte(response) is None:
+            self._last_error = "sin respuesta a la consulta de estado"
+            return False
+        return True
+
+    def _record_outcome(self, ok):
+        transition = self.breaker.record(ok)
+        if transition == BREAKER_OPEN:
+            retry_in = self.breaker.snapshot()["retryIn"]
+            print(f"SERIAL ERROR: {self.port} falló {self.breaker.threshold} veces seguidas "
+                  f"({self._last_error}); se deja de usar, reintento en {retry_in:g}s")
+        elif transition == BREAKER_CLOSED:
+            print(f"SERIAL: {self.port} responde de nuevo")
+        if transition:
+            _notify_breaker(self.port, self.breaker.snapshot())
+
+    def _open_port(self):
+        if self._ser is None or not self._ser.is_open:
+            self._ser = serial.Serial(self.port, self.baudrate, timeout=READ_POLL_SECONDS)
+        return self._ser
+
+    def _close_port(self):
+        if self._ser is not None:
+            try:
+                self._ser.close()
+            except Exception:
+                pass
+        self._ser = None
+
+    @contextlib.contextmanager
+    def _port_lock(self):
+        """Exclusive, cross-process hold on the port for one transaction.
+        Held only for the write+read, so the wait for another process is
+        bounded by its reply deadline."""
+        if fcntl is None or not self._lock_path:
+            yield
+            return
+        if self._lock_fd is None:
+            self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _transact(self, command):
+        """Writes one frame and waits for its reply, but only until the
+        command's own deadline. Returns the reply frame, b'' if none came
+        in time (normal for 'open'), or None on a comms failure."""
+        try:
+            with self._port_lock():
+                ser = self._open_port()
+                # Anything already buffered was read by no one: either line
+                # noise or a reply another process gave up on.
+                ser.reset_input_buffer()
+                self._decoder.reset()
+                ser.write(command)
+                deadline = time.monotonic() + _reply_timeout(command)
+                while time.monotonic() < deadline:
+                    chunk = ser.read(max(1, ser.in_waiting))
+                    if not chunk:
+                        continue
+                    for frame in self._decoder.feed(chunk):
+                        if _reply_matches(command, frame):
+                            return frame
+                return b''
+        except serial.SerialException as e:
+            self._last_error = e
+            # Con el circuito abierto solo corren sondeos: su fallo ya se
+            # sabe y no hace falta repetirlo en el log.
+            if self.breaker.state == BREAKER_CLOSED:
+                print(f"SERIAL ERROR: {e}")
+        except Exception as e:
+            self._last_error = e
+            if self.breaker.state == BREAKER_CLOSED:
+                print(f"GENERAL ERROR: {e}")
+        # Whatever went wrong, the handle is suspect: drop it so the next
+        # command reopens the port (e.g. the USB adapter was re-plugged).
+        self._close_port()
+        return None
+
+    def _record_latency(self, command, elapsed, ok):
+        name = _command_name(command)
+        elapsed_ms = elapsed * 1000.0
+        with self._stats_lock:
+            stats = self._latency.setdefault(name, {
+                "count": 0, "failures": 0, "lastMs": 0.0, "avgMs": 0.0, "maxMs": 0.0,
+            })
+            stats["count"] += 1
+            if not ok:
+                stats["failures"] += 1
+            stats["lastMs"] = round(elapsed_ms, 2)
+            stats["maxMs"] = round(max(stats["maxMs"], elapsed_ms), 2)
+            stats["avgMs"] = round(stats["avgMs"] + (elapsed_ms - stats["avgMs"]) / stats["count"], 2)
+
+    def _record_metrics(self, command, elapsed, response, checksum_errors):
+        name = _command_name(command)
+        board, channel = str(command[5]), str(command[7])
+        metrics.serial_roundtrip_seconds.observe(elapsed, self.port, name)
+        if response is None:
+            result = "error"
+        elif response:
+            result = "ok"
+        else:
+            result = "no_reply"
+            # An open usually gets no reply; a status query always should.
+            if name == "check":
+                metrics.serial_timeouts.inc(self.port, board, channel)
+        metrics.serial_results.inc(self.port, name, result)
+        if checksum_errors:
+            # A corrupted frame can't say which door it was for; it's
+            # counted against the door whose reply was being awaited.
+            metrics.serial_checksum_errors.inc(self.port, board, channel, amount=checksum_errors)
+
+
+def _lock_path(port):
+    if not config.SERIAL_LOCK_DIR:
         return None
+    name = port.strip('/').replace('/', '_') or 'serial'
+    return os.path.join(config.SERIAL_LOCK_DIR, f"kiosk-{name}.lock")
+
+
+def _reply_timeout(command):
+    if command[6:7] == CMD_BYTE_OPEN:
+        return config.SERIAL_OPEN_REPLY_TIMEOUT_MS / 1000.0
+    return config.SERIAL_STATUS_REPLY_TIMEOUT_MS / 1000.0
+
+
+def _command_name(command):
+    cmd_byte = command[6:7] if len(command) > 6 else b''
+    if cmd_byte == CMD_BYTE_OPEN:
+        return "open"
+    if cmd_byte == CMD_BYTE_CHECK:
+        return "check"
+    return "other"
+
+
+_links = {}
+_links_lock = threading.Lock()
+_breaker_listeners = []
+# Last state read from each door, answered (marked stale) while its port
+# can't be reached.
+_last_known = {}
+
+
+def add_breaker_listener(callback):
+    """callback(port, breaker_snapshot) runs on the port's worker thread
+    whenever its breaker opens or closes."""
+    _breaker_listeners.append(callback)
+
+
+def _notify_breaker(port, snapshot):
+    for callback in _breaker_listeners:
+        try:
+            callback(port, snapshot)
+        except Exception as e:
+            print(f"SERIAL ERROR: listener del circuito falló para {port}: {e}")
+
+
+def get_link(port=None):
+    port = port or config.SERIAL_PORT
+    with _links_lock:
+        link = _links.get(port)
+        if link is None:
+            link = _links[port] = SerialLink(port, config.BAUD_RATE)
+        return link
+
+
+@atexit.register
+def _close_links():
+    with _links_lock:
+        links = list(_links.values())
+    for link in links:
+        link.close()
+
+
+def _wait(future):
+    try:
+        return future.result(timeout=COMMAND_WAIT_SECONDS)
     except Exception as e:
-        print(f"GENERAL ERROR: {e}")
+        print(f"SERIAL ERROR: comando sin respuesta del hilo serie ({e})")
         return None
 
 
-def open_locker(channel):
+def _send_serial_command(command, port=None):
+    return _wait(get_link(port).submit(command))
+
+
+def _as_address(address):
+    """Accepts a bare channel number (single-board sites, quick manual
+    tests) as shorthand for that channel on the default port and board."""
+    if isinstance(address, config.LockerAddress):
+        return address
+    return config.LockerAddress(config.SERIAL_PORT, config.BOARD_ADDRESS, int(address))
+
+
+def submit_open(address):
+    address = _as_address(address)
+    command = _build_command(CMD_BYTE_OPEN, address.channel, board=address.board)
+    return get_link(address.port).submit(command, PRIORITY_URGENT)
+
+
+def submit_status(address, priority=PRIORITY_NORMAL):
+    address = _as_address(address)
+    command = _build_command(CMD_BYTE_CHECK, address.channel, board=address.board)
+    return get_link(address.port).submit(command, priority)
+
+
+def _status_byte(response):
+    """The door state byte of a status reply, or None if there is no
+    readable reply."""
+    if response and response[0:4] == HEADER and len(response) > 9 and response[9] in (0x00, 0x01):
+        return response[9]
+    return None
+
+
+def _parse_status(address, response):
+    state_byte = None
+    if (response and len(response) > 8 and response[5] == address.board and
+            response[6] == CMD_BYTE_CHECK[0] and response[8] == address.channel):
+        state_byte = _status_byte(response)
+    if state_byte is None:
+        # No (readable) reply, a comms failure or the breaker refused the
+        # command: nothing new is known about the door, so answer what was
+        # last read.
+        return {"address": address, "channel": address.channel,
+                "status": _last_known.get(address, "UNKNOWN"), "stale": True}
+    status = "LOCKED" if state_byte == 0x01 else "UNLOCKED"
+    _last_known[address] = status
+    return {"address": address, "channel": address.channel, "status": status, "stale": False}
+
+
+def open_locker(address):
     """Sends the open command. Returns True if the board acknowledged (or
     sent no reply, which is normal for 'open'), False on a comms failure."""
-    command = _build_command(CMD_BYTE_OPEN, channel)
-    response = _send_serial_command(command)
+    response = _wait(submit_open(address))
     return response is not None
 
 
-def get_lock_status(channel):
-    command = _build_command(CMD_BYTE_CHECK, channel)
-    response = _send_serial_command(command)
-    status = {"channel": channel, "status": "UNKNOWN"}
-    if response:
-        try:
-            if (response[0:4] == HEADER and
-                    response[6] == CMD_BYTE_CHECK[0] and
-                    response[8] == channel):
-                state_byte = response[9]
-                if state_byte == 0x01:
-                    status["status"] = "LOCKED"
-                elif state_byte == 0x00:
-                    status["status"] = "UNLOCKED"
-        except IndexError:
-            pass
-    return status
-
-
-def get_all_statuses(channels):
-    return [get_lock_status(channel) for channel in channels]
+def get_lock_status(address):
+    address = _as_address(address)
+    return _parse_status(address, _wait(submit_status(address)))
+
+
+def get_all_statuses(addresses, priority=PRIORITY_NORMAL):
+    # Queue every poll up front: each port's worker runs its share back to
+    # back, and different ports run at the same time.
+    addresses = [_as_address(address) for address in addresses]
+    futures = [(address, submit_status(address, priority)) for address in addresses]
+    return [_parse_status(address, _wait(future)) for address, future in futures]
+
+
+def latency_stats():
+    return {port: link.latency_stats() for port, link in list(_links.items())}
+
+
+def checksum_errors():
+    return {port: link.checksum_errors for port, link in list(_links.items())}
+
+
+def breaker_states():
+    """Breaker snapshot per port that has been used so far."""
+    return {port: link.breaker.snapshot() for port, link in list(_links.items())}
@@ -76,9 +76,24 @@ async function openAdmin() {
     showAdminLogin();
 }
 
+// --- SERVICE WORKER: la interfaz se pinta desde caché aunque el servidor se esté reiniciando ---
+function registerServiceWorker() {
+    if (!('serviceWorker' in navigator)) return;
+    const hadController = Boolean(navigator.serviceWorker.controller);
+    navigator.serviceWorker.addEventListener('controllerchange', () => {
+        // Llegó un frontend nuevo: se recarga solo si nadie está usando el
+        // kiosco (sin modal abierto); si no, se verá en el próximo refresco.
+        if (hadController && !document.getElementById('modal-backdrop')) location.reload();
+    });
+    navigator.serviceWorker.register('/sw.js').catch(e => {
+        console.warn('No se pudo registrar el service worker', e);
+    });
+}
+
 // --- INICIALIZACIÓN ---
 async function initialize() {
     applyStoredTheme();
+    registerServiceWorker();
 
     await loadRemoteConfig();
     applyBranding();
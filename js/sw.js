@@ -0,0 +1,66 @@
+// Service worker del kiosco: guarda la interfaz (index.html y los bundles
+// que arma bundle.py) para que un location.reload() o un reinicio de
+// Chromium la pinten al instante, aunque Flask se esté reiniciando. La API
+// nunca pasa por la caché: los datos siempre vienen del servidor.
+//
+// No se sirve tal cual: server.py lo entrega en /sw.js con VERSION y SHELL
+// rellenados. Cada build nuevo cambia VERSION, el navegador instala este
+// worker otra vez y descarta la caché anterior.
+const VERSION = '__VERSION__';
+const SHELL = __SHELL__;
+const CACHE = `kiosk-shell-${VERSION}`;
+
+self.addEventListener('install', event => {
+    event.waitUntil(
+        caches.open(CACHE)
+            .then(cache => cache.addAll(SHELL))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil((async () => {
+        const names = await caches.keys();
+        await Promise.all(names.filter(name => name !== CACHE).map(name => caches.delete(name)));
+        if (SHELL.length === 0) {
+            // Sin bundle (server.py --dev o FRONTEND_BUNDLE=0): no hay nada
+            // que servir sin red, así que este worker se retira.
+            await caches.delete(CACHE);
+            await self.registration.unregister();
+            return;
+        }
+        await self.clients.claim();
+    })());
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (SHELL.length === 0 || request.method !== 'GET' || url.origin !== self.location.origin
+        || url.pathname.startsWith('/api/') || url.pathname === '/sw.js') {
+        return;
+    }
+    if (request.mode === 'navigate') {
+        // La página es siempre la misma: la guardada, sin esperar a la red.
+        event.respondWith(caches.match('/', { cacheName: CACHE }).then(cached => cached || fetch(request)));
+        return;
+    }
+    event.respondWith((async () => {
+        const cached = await caches.match(request, { cacheName: CACHE });
+        if (cached) return cached;
+        // Lo que no está en el shell (logos de marca, imágenes) se pide a la
+        // red y se guarda, para tenerlo también la próxima vez sin servidor.
+        try {
+            const response = await fetch(request);
+            if (response.ok) {
+                const cache = await caches.open(CACHE);
+                await cache.put(request, response.clone());
+            }
+            return response;
+        } catch (error) {
+            const fallback = await caches.match(request, { cacheName: CACHE, ignoreSearch: true });
+            if (fallback) return fallback;
+            throw error;
+        }
+    })());
+});
@@ -1,26 +1,26 @@
-// Exporta un reporte de solo lectura del estado de los casilleros.
+// Descarga reportes de solo lectura generados por el servidor.
 // La importación de CSV se eliminó: el servidor (SQLite) es ahora la única
 // fuente de verdad del estado, así que "importar" un CSV arbitrario ya no
 // tenía sentido y era una superficie de ataque innecesaria.
-import { bays } from './state.js';
+//
+// El archivo ya no se arma en el navegador a partir de la foto de `bays`:
+// /api/admin/export lo genera en streaming desde SQLite (incluido el
+// historial de eventos), y el navegador lo guarda a medida que llega.
+import { API_BASE } from './config.js';
 
-export function exportToCSV() {
-    const headers = "id,occupied,customerEmail,pickupCode,hardwareStatus";
-    const csvContent = bays.map(bay =>
-        `${bay.id},${bay.occupied},${bay.customerEmail || ''},${bay.pickupCode || ''},${bay.hardwareStatus || ''}`
-    ).join('\n');
+// dataset: 'bays' | 'events' | 'deposits'; format: 'csv' | 'ndjson'; since/until:
+// fechas ISO (until exclusivo); gzip: descarga comprimida (.gz).
+export function downloadExport({ dataset, format = 'csv', since = '', until = '', gzip = false }) {
+    const params = new URLSearchParams({ format });
+    if (since) params.set('since', since);
+    if (until) params.set('until', until);
+    if (gzip) params.set('gzip', '1');
 
-    const fullCsv = `${headers}\n${csvContent}`;
-    const blob = new Blob([fullCsv], { type: 'text/csv;charset=utf-8;' });
-    const link = document.createElement("a");
-    if (link.download !== undefined) {
-        const url = URL.createObjectURL(blob);
-        link.setAttribute("href", url);
-        link.setAttribute("download", `locker_report_${new Date().toISOString().slice(0, 10)}.csv`);
-        link.style.visibility = 'hidden';
-        document.body.appendChild(link);
-        link.click();
-        document.body.removeChild(link);
-        URL.revokeObjectURL(url);
-    }
+    const link = document.createElement('a');
+    link.setAttribute('href', `${API_BASE}/api/admin/export/${dataset}?${params}`);
+    link.setAttribute('download', '');
+    link.style.visibility = 'hidden';
+    document.body.appendChild(link);
+    link.click();
+    document.body.removeChild(link);
 }
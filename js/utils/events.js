@@ -0,0 +1,67 @@
+// Suscripción a los eventos en vivo del servidor (/api/events/stream, SSE).
+// Una sola conexión EventSource compartida por toda la app: el servidor
+// empuja cada cambio de casillero (puerta abierta/cerrada, ocupado/libre) en
+// cuanto lo ve, en vez de que el navegador tenga que sondear.
+import { API_BASE } from './config.js';
+
+const listeners = new Set();
+let source = null;
+
+function connect() {
+    if (source || typeof EventSource === 'undefined') return;
+    source = new EventSource(`${API_BASE}/api/events/stream`);
+
+    source.addEventListener('bay', (e) => {
+        let bay;
+        try {
+            bay = JSON.parse(e.data);
+        } catch (err) {
+            console.error('Evento de casillero inválido:', err);
+            return;
+        }
+        listeners.forEach(listener => listener({ type: 'bay', bay }));
+    });
+
+    // Un puerto serie dejó de responder (o volvió): estado de los puertos,
+    // igual que el campo `hardware` de /api/lockers.
+    source.addEventListener('hardware', (e) => {
+        let hardware;
+        try {
+            hardware = JSON.parse(e.data);
+        } catch (err) {
+            console.error('Evento de hardware inválido:', err);
+            return;
+        }
+        listeners.forEach(listener => listener({ type: 'hardware', hardware }));
+    });
+
+    // El servidor pide un estado completo (nos quedamos atrás), y lo mismo
+    // al (re)conectar: pudimos perdernos eventos mientras no había conexión.
+    source.addEventListener('resync', () => {
+        listeners.forEach(listener => listener({ type: 'resync' }));
+    });
+    source.addEventListener('open', () => {
+        listeners.forEach(listener => listener({ type: 'resync' }));
+    });
+    // EventSource reintenta solo tras un error; no hace falta hacer nada aquí.
+}
+
+/**
+ * Registra un oyente de eventos en vivo. Devuelve una función para
+ * cancelar la suscripción.
+ * @param {function} listener - Recibe `{ type: 'bay', bay }`, `{ type: 'hardware', hardware }`
+ *   o `{ type: 'resync' }`.
+ */
+export function subscribeLockerEvents(listener) {
+    connect();
+    listeners.add(listener);
+    return () => listeners.delete(listener);
+}
+
+/**
+ * true si la conexión de eventos está abierta ahora mismo. Si no lo está,
+ * quien dependa de ella debe caer al sondeo de siempre.
+ */
+export function isLive() {
+    return source !== null && source.readyState === EventSource.OPEN;
+}
@@ -2,10 +2,13 @@
 // como esperar a que se cierre una puerta.
 import { showModal, closeModal } from '../widgets/modal.js';
 import { API_BASE } from './config.js';
+import { subscribeLockerEvents, isLive } from './events.js';
 
 /**
- * Muestra un modal y sondea el estado de un casillero hasta que se cierra.
- * @param {number} bayId - El ID del casillero que se está sondeando.
+ * Muestra un modal y espera a que un casillero se cierre. El aviso llega
+ * por el stream de eventos del servidor en cuanto la puerta se cierra; si
+ * esa conexión no está disponible, se cae al sondeo de siempre cada 2 s.
+ * @param {number} bayId - El ID del casillero que se está esperando.
  * @param {function} onClosedCallback - La función a llamar cuando se confirma el cierre.
  */
 export function waitForDoorClose(bayId, onClosedCallback) {
@@ -25,29 +28,50 @@ export function waitForDoorClose(bayId, onClosedCallback) {
         0 // No autocerrar
     );
 
-    // 2. Inicia el sondeo (polling)
-    const poller = setInterval(async () => {
+    let done = false;
+    let unsubscribe = () => {};
+    let poller = null;
+
+    const finish = () => {
+        if (done) return;
+        done = true;
+        console.log(`Casillero ${bayId} confirmado como CERRADO.`);
+        unsubscribe();
+        clearInterval(poller);
+        closeModal(); // Cierra el modal de "espere"
+        onClosedCallback(); // Ejecuta la acción final (marcar como disponible)
+    };
+
+    const checkStatus = async () => {
         try {
             const response = await fetch(`${API_BASE}/api/lockers/${bayId}/status`);
             if (!response.ok) {
                 console.error("Error de red al sondear el casillero.");
                 return; // Intenta de nuevo en el próximo intervalo
             }
-            
             const data = await response.json();
-            
-            if (data.success && data.status === "LOCKED") {
-                // 3. ¡Éxito! La puerta está cerrada.
-                console.log(`Casillero ${bayId} confirmado como CERRADO.`);
-                clearInterval(poller); // Detiene el sondeo
-                closeModal(); // Cierra el modal de "espere"
-                onClosedCallback(); // Ejecuta la acción final (marcar como disponible)
-            }
-            // Si es "UNLOCKED", no hace nada y espera al próximo sondeo
-            
+            if (data.success && data.status === "LOCKED") finish();
+            // Si es "UNLOCKED", no hace nada y espera al próximo aviso/sondeo
         } catch (e) {
             console.error(`Fallo en el sondeo del casillero ${bayId}:`, e);
             // Sigue intentando
         }
-    }, 2000); // Comprueba cada 2 segundos
-}
\ No newline at end of file
+    };
+
+    // 2. Aviso en vivo del servidor
+    unsubscribe = subscribeLockerEvents((event) => {
+        if (event.type === 'bay' && event.bay.id === bayId && event.bay.hardwareStatus === "LOCKED") {
+            finish();
+        } else if (event.type === 'resync') {
+            checkStatus(); // Pudimos perdernos el cierre mientras no había conexión
+        }
+    });
+
+    // 3. Respaldo: sondeo cada 2 s, solo mientras el stream no está conectado.
+    // La primera consulta es inmediata por si la puerta se cerró antes de
+    // suscribirnos.
+    checkStatus();
+    poller = setInterval(() => {
+        if (!isLive()) checkStatus();
+    }, 2000);
+}
@@ -3,6 +3,7 @@
 // guardamos una copia en memoria para dibujar la UI.
 import { showModal } from '../widgets/modal.js';
 import { API_BASE } from './config.js';
+import { subscribeLockerEvents } from './events.js';
 
 export let bays = [];
 
@@ -11,6 +12,7 @@ export let bays = [];
  * combina la base de datos con el estado físico real del hardware.
  */
 export async function initializeState() {
+    subscribeLockerEvents(handleLockerEvent);
     try {
         await refreshState(true);
     } catch (e) {
@@ -24,20 +26,38 @@ export async function initializeState() {
     }
 }
 
+// Versión del estado que refleja `bays` (la manda el servidor). Con ella,
+// un refresco pide solo los casilleros que cambiaron desde entonces.
+let stateVersion = null;
+
 /**
  * Vuelve a pedir el estado más reciente al servidor. Se llama después de
  * cualquier acción de admin/cliente para que la UI refleje lo que el
  * servidor realmente aprobó, no lo que el cliente asumió.
+ *
+ * Si ya se tiene una versión, solo se piden los cambios posteriores
+ * (/api/lockers/changes); `full` fuerza la lista completa, p.ej. al entrar
+ * como admin, cuando cambian los campos visibles de todos los casilleros.
  */
-export async function refreshState(throwOnError = false) {
+export async function refreshState(throwOnError = false, full = false) {
     try {
-        const response = await fetch(`${API_BASE}/api/lockers`);
+        const useDelta = stateVersion !== null && !full;
+        const url = useDelta
+            ? `${API_BASE}/api/lockers/changes?since=${stateVersion}`
+            : `${API_BASE}/api/lockers`;
+        const response = await fetch(url);
         if (!response.ok) throw new Error(`Error de red: ${response.statusText}`);
 
         const data = await response.json();
         if (!data.success) throw new Error('El servidor falló al obtener el estado');
 
-        bays = data.bays;
+        if (useDelta && !data.full) {
+            mergeBays(data.bays);
+        } else {
+            bays = data.bays;
+        }
+        stateVersion = data.version;
+        if (data.hardware) showHardwareStatus(data.hardware);
         cacheSnapshot();
     } catch (e) {
         if (throwOnError) throw e;
@@ -45,6 +65,51 @@ export async function refreshState(throwOnError = false) {
     }
 }
 
+function mergeBays(changed) {
+    for (const bay of changed) {
+        const index = bays.findIndex(existing => existing.id === bay.id);
+        if (index === -1) {
+            bays.push(bay);
+            bays.sort((a, b) => a.id - b.id);
+        } else {
+            bays[index] = bay;
+        }
+    }
+}
+
+/**
+ * Aplica un cambio empujado por el servidor (/api/events/stream) sobre la
+ * copia en memoria, sin volver a pedir la lista completa. Si el servidor
+ * pide resincronizar (o la conexión se rehízo), se hace un refresco normal.
+ */
+function handleLockerEvent(event) {
+    if (event.type === 'resync') {
+        refreshState();
+        return;
+    }
+    if (event.type === 'hardware') {
+        showHardwareStatus(event.hardware);
+        return;
+    }
+    const index = bays.findIndex(bay => bay.id === event.bay.id);
+    if (index === -1) return;
+    // El evento nunca trae pickupCode (el stream es público): se conserva el
+    // que ya tuviera un admin hasta el próximo refresco completo.
+    bays[index] = { ...bays[index], ...event.bay };
+    cacheSnapshot();
+}
+
+// --- Aviso de falla de hardware ---
+// El servidor deja de usar un puerto serie que falla una y otra vez (ver
+// hardware.py): mientras tanto las puertas muestran su último estado
+// conocido y no se pueden abrir. Se avisa en la pantalla principal en vez
+// de dejar que el cliente lo descubra al intentar recoger su paquete.
+function showHardwareStatus(hardware) {
+    const banner = document.getElementById('hardware-banner');
+    if (!banner) return;
+    banner.classList.toggle('hidden-input', !hardware.fault);
+}
+
 // --- Copia de respaldo NO autoritativa ---
 // Solo se usa para mostrar algo razonable si el servidor no responde por un
 // instante. Nunca se usa para decidir si un casillero puede abrirse: esa
@@ -4,7 +4,7 @@
 // solo pide acciones y refleja lo que el servidor confirma.
 import { showModal, closeModal } from './modal.js';
 import { bays, refreshState } from '../utils/state.js';
-import { exportToCSV } from '../utils/csv.js';
+import { downloadExport } from '../utils/csv.js';
 import { waitForDoorClose } from '../utils/hardware.js';
 import { API_BASE } from '../utils/config.js';
 
@@ -33,6 +33,8 @@ async function verifyAdminPassword() {
         const result = await response.json();
         if (response.ok && result.success) {
             await showAdminPanel();
+        } else if (response.status === 429) {
+            showModal('Error', `<p class="text-red-500">${result.error}</p>`, 5000);
         } else {
             showModal('Error', '<p class="text-red-500">Contraseña incorrecta. Por favor, inténtalo de nuevo.</p>', 3000);
         }
@@ -46,19 +48,20 @@ async function verifyAdminPassword() {
  * Muestra el panel de control del administrador.
  */
 export async function showAdminPanel() {
-    await refreshState(); // Trae el estado más reciente (incluye códigos, porque ya hay sesión de admin)
+    await refreshState(false, true); // Lista completa: con sesión de admin incluye los códigos
 
     const content = `
         <div class="mb-6">
             <h3 class="text-xl font-semibold mb-4 text-gray-700 dark:text-gray-200">Estado de los Casilleros</h3>
             <div id="admin-bays-container" class="bay-grid"></div>
         </div>
-        <div class="grid grid-cols-2 gap-4 mb-6">
+        <div class="grid grid-cols-3 gap-4 mb-6">
             <button id="deposit-package-btn" class="bg-indigo-600 text-white p-3 rounded-lg hover:bg-indigo-700 transition">Depositar Paquete</button>
+            <button id="batch-deposit-btn" class="bg-indigo-500 text-white p-3 rounded-lg hover:bg-indigo-600 transition">Reparto Múltiple</button>
             <button id="manage-bays-btn" class="bg-gray-600 text-white p-3 rounded-lg hover:bg-gray-700 transition">Gestionar Casilleros</button>
         </div>
         <div class="grid grid-cols-2 gap-4">
-            <button id="export-csv-btn" class="bg-green-600 text-white p-3 rounded-lg hover:bg-green-700 transition">Exportar Reporte CSV</button>
+            <button id="export-csv-btn" class="bg-green-600 text-white p-3 rounded-lg hover:bg-green-700 transition">Exportar Reporte</button>
             <button id="admin-logout-btn" class="bg-red-600 text-white p-3 rounded-lg hover:bg-red-700 transition">Cerrar Sesión</button>
         </div>
     `;
@@ -66,8 +69,9 @@ export async function showAdminPanel() {
     renderAdminBays();
 
     document.getElementById('deposit-package-btn').addEventListener('click', showDepositScreen);
+    document.getElementById('batch-deposit-btn').addEventListener('click', showBatchDepositScreen);
     document.getElementById('manage-bays-btn').addEventListener('click', showManageBaysScreen);
-    document.getElementById('export-csv-btn').addEventListener('click', exportToCSV);
+    document.getElementById('export-csv-btn').addEventListener('click', showExportScreen);
     document.getElementById('admin-logout-btn').addEventListener('click', handleLogout);
 }
 
@@ -94,6 +98,16 @@ function renderAdminBays() {
         } else if (bay.hardwareStatus === "UNLOCKED") {
             statusText = "PUERTA ABIERTA";
             statusColor = "yellow";
+        } else if (bay.needsReview) {
+            // Depósito pendiente de antes de un reinicio, con la puerta ya
+            // cerrada: el servidor no sabe si entró el paquete.
+            statusText = "Revisar";
+            statusColor = "yellow";
+            details = `
+                <p class="text-sm text-gray-600 dark:text-gray-300 font-medium">Para: <span class="font-normal break-all">${bay.customerEmail}</span></p>
+                <p class="text-sm text-gray-600 dark:text-gray-300 font-medium mt-1">Código: <span class="font-mono text-blue-600 bg-blue-100 dark:text-blue-300 dark:bg-blue-900/50 px-2 py-1 rounded">${bay.pickupCode}</span></p>
+                <p class="text-sm text-gray-500 dark:text-gray-400 mt-1">Depósito sin confirmar tras un reinicio: confírmalo o libéralo en Gestionar Casilleros.</p>
+            `;
         } else if (bay.hardwareStatus === "UNKNOWN") {
             statusText = "DESCONOCIDO";
             statusColor = "gray";
@@ -103,6 +117,7 @@ function renderAdminBays() {
             details = `
                 <p class="text-sm text-gray-600 dark:text-gray-300 font-medium">Para: <span class="font-normal break-all">${bay.customerEmail}</span></p>
                 <p class="text-sm text-gray-600 dark:text-gray-300 font-medium mt-1">Código: <span class="font-mono text-blue-600 bg-blue-100 dark:text-blue-300 dark:bg-blue-900/50 px-2 py-1 rounded">${bay.pickupCode}</span></p>
+                ${emailStatusLine(bay.emailStatus)}
             `;
         } else {
             statusText = "Disponible";
@@ -134,7 +149,7 @@ function renderAdminBays() {
  */
 function showDepositScreen() {
     const availableBays = bays.filter(bay =>
-        bay.hardwareStatus === "LOCKED" && !bay.occupied
+        bay.hardwareStatus === "LOCKED" && !bay.occupied && bay.state === "IDLE"
     );
 
     if (availableBays.length === 0) {
@@ -154,6 +169,25 @@ function showDepositScreen() {
     document.getElementById('submit-deposit').addEventListener('click', handleDeposit);
 }
 
+function emailStatusLine(emailStatus) {
+    if (!emailStatus) return '';
+    let text, color;
+    if (emailStatus.status === 'sent') {
+        text = 'Enviado';
+        color = 'text-green-600 dark:text-green-300';
+    } else if (emailStatus.status === 'pending') {
+        text = emailStatus.attempts > 0 ? `En cola (reintento ${emailStatus.attempts})` : 'En cola';
+        color = 'text-yellow-600 dark:text-yellow-300';
+    } else if (emailStatus.status === 'failed') {
+        text = 'Falló';
+        color = 'text-red-600 dark:text-red-300';
+    } else {
+        return '';
+    }
+    const title = emailStatus.error ? ` title="${emailStatus.error.replace(/"/g, '&quot;')}"` : '';
+    return `<p class="text-sm text-gray-600 dark:text-gray-300 font-medium mt-1">Correo: <span class="font-normal ${color}"${title}>${text}</span></p>`;
+}
+
 async function handleDeposit() {
     const selectedBayId = parseInt(document.getElementById('bay-select').value);
     const email = document.getElementById('customer-email').value;
@@ -181,34 +215,51 @@ async function handleDeposit() {
         return;
     }
 
-    // La puerta se abrió. Espera a que el operador la cierre para confirmar el depósito.
+    // La puerta se abrió. El servidor confirma el depósito solo en cuanto la
+    // puerta se cierra (ver baystate.py), o lo anula si tarda demasiado: al
+    // cerrarse se le pregunta en qué terminó antes de dar el código por bueno.
     waitForDoorClose(selectedBayId, async () => {
-        try {
-            const confirmResponse = await fetch(`${API_BASE}/api/admin/deposit/confirm`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ bayId: selectedBayId }),
-            });
-            const confirmResult = await confirmResponse.json();
-            if (!confirmResponse.ok || !confirmResult.success) {
-                throw new Error(confirmResult.error || 'Fallo al confirmar el depósito');
-            }
-        } catch (error) {
-            console.error('Falló al confirmar el depósito:', error);
-            showModal('Error', `<p class="text-red-500">El casillero se cerró pero no se pudo confirmar el depósito: ${error.message}</p>`, 5000);
-            return;
-        }
-
+        const confirmed = await confirmDeposit(selectedBayId, pickupCode);
         await refreshState();
+        if (!confirmed) return;
 
         const emailSent = await sendPickupEmail(selectedBayId, email);
         showQRCodeModal(pickupCode, email, emailSent);
     });
 }
 
+async function confirmDeposit(bayId, pickupCode) {
+    let response, result;
+    try {
+        response = await fetch(`${API_BASE}/api/admin/deposit/confirm`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ bayId, pickupCode }),
+        });
+        result = await response.json();
+    } catch (error) {
+        console.error('Falló al confirmar el depósito:', error);
+        showModal('Error', `<p class="text-red-500">El casillero se cerró pero no se pudo confirmar el depósito. Revisa el Casillero ${bayId} en el panel antes de entregar el código.</p>`, 0);
+        return false;
+    }
+    if (response.ok && result.success) return true;
+
+    // El servidor lo anuló: el código no abre nada, así que no se muestra ni
+    // se envía, y el paquete no debe quedar en un casillero libre.
+    console.error('Depósito anulado:', result.error);
+    showModal(
+        'Depósito Anulado',
+        `<p class="text-red-500">${result.error || 'El depósito se anuló'}. El código ya no es válido: retira el paquete del Casillero ${bayId} y vuelve a depositarlo.</p>`,
+        0
+    );
+    return false;
+}
+
 async function sendPickupEmail(bayId, toEmail) {
-    showModal("Enviando...", `<p class="dark:text-gray-300">Enviando código de recogida a ${toEmail}</p>`, 0);
+    showModal("Enviando...", `<p class="dark:text-gray-300">Encolando código de recogida para ${toEmail}</p>`, 0);
     try {
+        // El servidor solo lo encola: el envío real (con reintentos) ocurre
+        // en segundo plano y su estado aparece en el panel de casilleros.
         const response = await fetch(`${API_BASE}/api/admin/deposit/send-email`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
@@ -216,12 +267,12 @@ async function sendPickupEmail(bayId, toEmail) {
         });
         const result = await response.json();
         if (!response.ok || !result.success) {
-            console.error('Falló al enviar el correo:', result.error);
+            console.error('Falló al encolar el correo:', result.error);
             return false;
         }
         return true;
     } catch (error) {
-        console.error('Falló al enviar el correo:', error);
+        console.error('Falló al encolar el correo:', error);
         return false;
     }
 }
@@ -229,7 +280,7 @@ async function sendPickupEmail(bayId, toEmail) {
 function showQRCodeModal(pickupCode, email, isConfirmation = false) {
     const title = isConfirmation ? 'Confirmación de Depósito' : 'Código de Recogida de Respaldo';
     const message = isConfirmation
-        ? `Los siguientes detalles de recogida se enviaron con éxito a ${email}.`
+        ? `Los siguientes detalles de recogida quedaron en cola para enviarse a ${email}. El estado del envío aparece en el panel de casilleros.`
         : 'Como el correo no pudo ser enviado, por favor muestra este código QR al cliente o proporciónale el código manual.';
 
     const content = `
@@ -248,6 +299,163 @@ function showQRCodeModal(pickupCode, email, isConfirmation = false) {
     });
 }
 
+// --- Reparto múltiple (mensajería) ---
+// Un solo request asigna casilleros a toda la lista; el servidor abre las
+// puertas de a poco, confirma cada una al cerrarse y encola todos los
+// correos al final. Aquí solo se muestra el avance.
+const BATCH_POLL_MS = 1000;
+const BATCH_STATUS_TEXT = {
+    waiting: ['En espera', 'text-gray-600 dark:text-gray-300'],
+    open: ['Puerta abierta: deposita y cierra', 'text-yellow-600 dark:text-yellow-300'],
+    deposited: ['Depositado', 'text-green-600 dark:text-green-300'],
+    open_failed: ['No se pudo abrir', 'text-red-600 dark:text-red-300'],
+    timeout: ['No se cerró a tiempo', 'text-red-600 dark:text-red-300'],
+    cleared: ['Liberado por el admin', 'text-gray-600 dark:text-gray-300'],
+};
+
+function showBatchDepositScreen() {
+    const content = `
+        <p class="mb-4 text-gray-600 dark:text-gray-400">Un correo por línea, uno por paquete. Se asignan los casilleros libres y se abren de a poco; cada uno se confirma solo al cerrar la puerta.</p>
+        <textarea id="batch-emails" rows="8" class="w-full p-3 border rounded-lg mb-4 font-mono text-sm" placeholder="cliente1@example.com&#10;cliente2@example.com"></textarea>
+        <button id="submit-batch-deposit" class="w-full bg-blue-600 text-white p-3 rounded-lg mb-4">Abrir Casilleros y Enviar Códigos</button>
+    `;
+    showModal('Reparto Múltiple', content, 0, '#batch-emails');
+    document.getElementById('batch-emails').focus();
+    document.getElementById('submit-batch-deposit').addEventListener('click', handleBatchDeposit);
+}
+
+async function handleBatchDeposit() {
+    const emails = document.getElementById('batch-emails').value
+        .split(/[\s,;]+/)
+        .map(email => email.trim())
+        .filter(Boolean);
+    const invalid = emails.find(email => !/^\S+@\S+\.\S+$/.test(email));
+    if (emails.length === 0 || invalid) {
+        showModal('Correo Inválido', `<p class="text-red-500">${invalid ? `Correo inválido: ${invalid}` : 'Introduce al menos un correo.'}</p>`, 3000);
+        return;
+    }
+
+    let result;
+    try {
+        const response = await fetch(`${API_BASE}/api/admin/deposit/batch`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ emails }),
+        });
+        result = await response.json();
+        if (!response.ok || !result.success) throw new Error(result.error || 'Fallo en la comunicación');
+    } catch (error) {
+        console.error('Falló el reparto múltiple:', error);
+        showModal('Error', `<p class="text-red-500">${error.message}</p>`, 5000);
+        return;
+    }
+    trackBatch(result.batch, result.unassigned || []);
+}
+
+function renderBatch(batch, unassigned) {
+    const rows = batch.items.map(item => {
+        const [text, color] = BATCH_STATUS_TEXT[item.status] || [item.status, ''];
+        return `
+            <tr class="border-b dark:border-gray-600">
+                <td class="py-2 pr-2 font-bold dark:text-gray-100">${item.bayId}</td>
+                <td class="py-2 pr-2 break-all dark:text-gray-300">${item.email}</td>
+                <td class="py-2 pr-2 font-mono dark:text-gray-300">${item.pickupCode}</td>
+                <td class="py-2 ${color}">${text}</td>
+            </tr>`;
+    }).join('');
+    const leftover = unassigned.length
+        ? `<p class="mt-4 text-sm text-red-600 dark:text-red-300">Sin casillero libre (${unassigned.length}): ${unassigned.join(', ')}</p>`
+        : '';
+    const footer = batch.finished
+        ? `<p class="mt-4 text-sm text-gray-600 dark:text-gray-400">Listo. Los códigos de los paquetes depositados quedaron en cola para enviarse por correo.</p>
+           <button id="batch-close-btn" class="w-full mt-4 bg-gray-500 text-white p-2 rounded-lg">Cerrar y Ver Panel</button>`
+        : '';
+    return `
+        <div id="batch-progress">
+            <table class="w-full text-left text-sm">
+                <thead><tr class="text-gray-500 dark:text-gray-400"><th>Casillero</th><th>Correo</th><th>Código</th><th>Estado</th></tr></thead>
+                <tbody>${rows}</tbody>
+            </table>
+            ${leftover}
+            ${footer}
+        </div>
+    `;
+}
+
+async function trackBatch(batch, unassigned) {
+    showModal(`Reparto Múltiple #${batch.id}`, renderBatch(batch, unassigned), 0);
+    while (!batch.finished) {
+        await new Promise(resolve => setTimeout(resolve, BATCH_POLL_MS));
+        // Si el admin cerró o cambió de pantalla, deja de seguir el lote
+        // (el servidor lo termina igual).
+        if (!document.getElementById('batch-progress')) return;
+        try {
+            const response = await fetch(`${API_BASE}/api/admin/deposit/batch/${batch.id}`);
+            const result = await response.json();
+            if (response.ok && result.success) batch = result.batch;
+        } catch (e) {
+            console.error('Falló al consultar el lote:', e);
+        }
+        if (!document.getElementById('batch-progress')) return;
+        showModal(`Reparto Múltiple #${batch.id}`, renderBatch(batch, unassigned), 0);
+    }
+    await refreshState();
+    document.getElementById('batch-close-btn')?.addEventListener('click', () => {
+        closeModal();
+        showAdminPanel();
+    });
+}
+
+function showExportScreen() {
+    const content = `
+        <label class="flex mb-2 text-gray-600 dark:text-gray-400" for="export-dataset">Datos</label>
+        <select id="export-dataset" class="w-full p-3 border rounded-lg mb-4">
+            <option value="bays">Estado actual de los casilleros</option>
+            <option value="events">Historial de eventos</option>
+            <option value="deposits">Historial de depósitos</option>
+        </select>
+        <div id="export-range" class="grid grid-cols-2 gap-4 mb-4 hidden">
+            <div>
+                <label class="flex mb-2 text-gray-600 dark:text-gray-400" for="export-since">Desde</label>
+                <input id="export-since" type="date" class="w-full p-3 border rounded-lg">
+            </div>
+            <div>
+                <label class="flex mb-2 text-gray-600 dark:text-gray-400" for="export-until">Hasta (incluido)</label>
+                <input id="export-until" type="date" class="w-full p-3 border rounded-lg">
+            </div>
+        </div>
+        <div class="flex items-center gap-4 mb-4 text-gray-600 dark:text-gray-400">
+            <label><input type="radio" name="export-format" value="csv" checked> CSV</label>
+            <label><input type="radio" name="export-format" value="ndjson"> NDJSON</label>
+            <label><input id="export-gzip" type="checkbox"> Comprimir (.gz)</label>
+        </div>
+        <button id="submit-export" class="w-full bg-green-600 text-white p-3 rounded-lg mb-4">Descargar</button>
+    `;
+    showModal('Exportar Reporte', content, 0);
+    const dataset = document.getElementById('export-dataset');
+    dataset.addEventListener('change', () => {
+        document.getElementById('export-range').classList.toggle('hidden', dataset.value === 'bays');
+    });
+    document.getElementById('submit-export').addEventListener('click', handleExport);
+}
+
+function handleExport() {
+    const dataset = document.getElementById('export-dataset').value;
+    const since = document.getElementById('export-since').value;
+    const until = document.getElementById('export-until').value;
+    // Las fechas del formulario son días locales; el servidor compara en
+    // UTC y trata `until` como exclusivo, así que se manda el día siguiente.
+    const untilDate = until ? new Date(`${until}T00:00`) : null;
+    if (untilDate) untilDate.setDate(untilDate.getDate() + 1);
+    downloadExport({
+        dataset,
+        format: document.querySelector('input[name="export-format"]:checked').value,
+        since: dataset !== 'bays' && since ? new Date(`${since}T00:00`).toISOString() : '',
+        until: dataset !== 'bays' && untilDate ? untilDate.toISOString() : '',
+        gzip: document.getElementById('export-gzip').checked,
+    });
+}
+
 function showManageBaysScreen() {
     const baysContent = bays.map(bay => {
         let statusText, statusColor;
@@ -257,6 +465,9 @@ function showManageBaysScreen() {
         } else if (bay.hardwareStatus === "UNLOCKED") {
             statusText = "PUERTA ABIERTA";
             statusColor = "text-yellow-600 bg-yellow-100";
+        } else if (bay.needsReview) {
+            statusText = "Revisar";
+            statusColor = "text-yellow-600 bg-yellow-100";
         } else if (bay.hardwareStatus === "LOCKED") {
             statusText = bay.occupied ? "Ocupado" : "Disponible (Cerrado)";
             statusColor = bay.occupied ? "text-red-600 bg-red-100" : "text-green-600 bg-green-100";
@@ -275,7 +486,8 @@ function showManageBaysScreen() {
             ${isDisabled ? '' : `
             <div class="flex space-x-2">
                <button data-bay-id="${bay.id}" class="open-door-btn flex-1 bg-yellow-500 text-black p-2 rounded-lg text-sm">Abrir Puerta</button>
-               ${bay.occupied ? `<button data-bay-id="${bay.id}" class="clear-bay-btn flex-1 bg-red-600 text-white p-2 rounded-lg text-sm">Liberar</button>` : ''}
+               ${bay.needsReview ? `<button data-bay-id="${bay.id}" class="confirm-deposit-btn flex-1 bg-green-600 text-white p-2 rounded-lg text-sm">Confirmar</button>` : ''}
+               ${bay.occupied || bay.needsReview ? `<button data-bay-id="${bay.id}" class="clear-bay-btn flex-1 bg-red-600 text-white p-2 rounded-lg text-sm">Liberar</button>` : ''}
             </div>
             `}
         </div>
@@ -314,6 +526,23 @@ function showManageBaysScreen() {
     document.querySelectorAll('.clear-bay-btn').forEach(button => {
         button.addEventListener('click', (e) => confirmClearBay(parseInt(e.currentTarget.dataset.bayId)));
     });
+
+    document.querySelectorAll('.confirm-deposit-btn').forEach(button => {
+        button.addEventListener('click', (e) => handleReviewedDeposit(parseInt(e.currentTarget.dataset.bayId)));
+    });
+}
+
+// El admin revisó el casillero y el paquete está: se confirma el depósito y,
+// como el correo nunca llegó a encolarse, se envía ahora.
+async function handleReviewedDeposit(bayId) {
+    const bay = bays.find(b => b.id === bayId);
+    if (!bay) return;
+    const confirmed = await confirmDeposit(bayId, bay.pickupCode);
+    await refreshState();
+    if (!confirmed) return;
+
+    const emailSent = await sendPickupEmail(bayId, bay.customerEmail);
+    showQRCodeModal(bay.pickupCode, bay.customerEmail, emailSent);
 }
 
 function confirmClearBay(bayId) {
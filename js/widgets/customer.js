@@ -60,23 +60,11 @@ async function verifyCode() {
             const bayId = result.bayId;
             showModal('¡Éxito!', `<p class="dark:text-gray-300">Casillero ${bayId} abierto.</p><p class="dark:text-gray-300">Por favor, recoge tu paquete y <strong>CIERRA LA PUERTA</strong>.</p>`, 0);
 
+            // El servidor libera el casillero al cerrarse la puerta (ver
+            // baystate.py); aquí solo se espera para cerrar el aviso.
             waitForDoorClose(bayId, async () => {
-                try {
-                    const confirmResponse = await fetch(`${API_BASE}/api/pickup/confirm`, {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ bayId, code }),
-                    });
-                    const confirmResult = await confirmResponse.json();
-                    if (!confirmResponse.ok || !confirmResult.success) {
-                        console.error('Falló al confirmar la recogida:', confirmResult.error);
-                    }
-                } catch (e) {
-                    console.error('Falló al confirmar la recogida:', e);
-                } finally {
-                    await refreshState();
-                    closeModal();
-                }
+                await refreshState();
+                closeModal();
             });
             return;
         }
@@ -3,66 +3,137 @@
 Reemplaza el envío anterior desde el navegador (EmailJS): ahora el servidor
 genera el QR y manda el correo, así que un fallo queda en los mismos logs
 que todo lo demás en vez de desaparecer en la consola del kiosco.
+
+Este módulo solo arma el mensaje y abre la sesión SMTP; quien envía es el
+hilo de outbox.py, que reutiliza una sesión para todo un lote y reintenta.
+
+Armar el mensaje es barato a propósito: las plantillas se compilan una vez
+al importar y el PNG del QR (lo caro en el Pi) sale de una caché LRU por
+código. Al depositar se genera de antemano en un hilo aparte, así que
+cuando el correo se envía (o se reintenta) el QR ya está hecho.
+
+qrcode (y con él PIL) se importa recién la primera vez que hace falta un
+QR, no al arrancar: es lo más pesado de importar de todo el servidor y
+retrasaba la primera respuesta. warm_up() lo importa en el hilo de QRs un
+rato después del arranque, para que el primer depósito no lo pague.
 """
+import functools
+import html
 import io
 import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-
-import qrcode
+from string import Template
 
 import config
 
+SUBJECT = 'Tu código de recogida de paquete'
+
+_TEXT_TEMPLATE = Template(
+    "Tu paquete está listo para recoger en el Casillero $bay_id.\n"
+    "Código de recogida: $pickup_code\n\n"
+    "Escanea el código QR adjunto en el kiosco, o introduce el código manualmente."
+)
 
+_HTML_TEMPLATE = Template("""
+    <div style="font-family: sans-serif; text-align: center;">
+        <h2>Tu paquete está listo</h2>
+        <p>Casillero <strong>$bay_id</strong></p>
+        <img src="cid:qrcode" alt="Código QR" width="200" height="200">
+        <p style="font-size: 24px; font-family: monospace; letter-spacing: 2px;">$pickup_code</p>
+        <p>Escanea el código QR en el kiosco, o introduce el código manualmente.</p>
+    </div>
+    """)
+
+# Un solo hilo: pre-generar QRs nunca compite por CPU con más de un núcleo.
+_qr_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='qr-render')
+
+
+def _qrcode():
+    import qrcode
+    return qrcode
+
+
+@functools.lru_cache(maxsize=config.QR_CACHE_SIZE)
 def _build_qr_png(pickup_code):
-    img = qrcode.make(pickup_code)
+    img = _qrcode().make(pickup_code)
     buf = io.BytesIO()
     img.save(buf, format='PNG')
     return buf.getvalue()
 
 
-def send_pickup_email(to_email, pickup_code, bay_id):
-    """Devuelve (enviado: bool, error: str|None)."""
-    if not config.SMTP_HOST or not config.SMTP_USERNAME or not config.SMTP_PASSWORD:
-        return False, "SMTP no configurado (revisa SMTP_* en .env)"
+def prerender_qr(pickup_code):
+    """Genera el QR de un código en segundo plano y lo deja en la caché.
+    No bloquea; se llama al abrir el casillero para depositar."""
+    _qr_executor.submit(_build_qr_png, pickup_code)
+
+
+def warm_up(delay):
+    """Importa qrcode en el hilo de QRs dentro de `delay` segundos, sin
+    bloquear a quien llama ni competir con el arranque."""
+    timer = threading.Timer(delay, _qr_executor.submit, args=(_qrcode,))
+    timer.daemon = True
+    timer.start()
+
+
+def is_configured():
+    return bool(config.SMTP_HOST)
+
+
+def build_pickup_message(to_email, pickup_code, bay_id):
+    values = {"bay_id": bay_id, "pickup_code": pickup_code}
 
     msg = MIMEMultipart('related')
-    msg['Subject'] = 'Tu código de recogida de paquete'
+    msg['Subject'] = SUBJECT
     msg['From'] = f"{config.SMTP_FROM_NAME} <{config.SMTP_FROM_EMAIL}>"
     msg['To'] = to_email
 
     alt = MIMEMultipart('alternative')
     msg.attach(alt)
-
-    text = (
-        f"Tu paquete está listo para recoger en el Casillero {bay_id}.\n"
-        f"Código de recogida: {pickup_code}\n\n"
-        "Escanea el código QR adjunto en el kiosco, o introduce el código manualmente."
-    )
-    alt.attach(MIMEText(text, 'plain'))
-
-    html = f"""
-    <div style="font-family: sans-serif; text-align: center;">
-        <h2>Tu paquete está listo</h2>
-        <p>Casillero <strong>{bay_id}</strong></p>
-        <img src="cid:qrcode" alt="Código QR" width="200" height="200">
-        <p style="font-size: 24px; font-family: monospace; letter-spacing: 2px;">{pickup_code}</p>
-        <p>Escanea el código QR en el kiosco, o introduce el código manualmente.</p>
-    </div>
-    """
-    alt.attach(MIMEText(html, 'html'))
+    alt.attach(MIMEText(_TEXT_TEMPLATE.substitute(values), 'plain'))
+    alt.attach(MIMEText(_HTML_TEMPLATE.substitute(
+        {key: html.escape(str(value)) for key, value in values.items()}
+    ), 'html'))
 
     image = MIMEImage(_build_qr_png(pickup_code), name='qrcode.png')
     image.add_header('Content-ID', '<qrcode>')
     image.add_header('Content-Disposition', 'inline', filename='qrcode.png')
     msg.attach(image)
+    return msg
+
 
+def render_pickup_messages(items):
+    """Arma de una pasada los correos de un lote (p.ej. un reparto de
+    varios paquetes). items: dicts con to_email, pickup_code y bay_id.
+    Devuelve los mensajes ya serializados, en el mismo orden; un código
+    repetido en el lote genera su QR una sola vez."""
+    for code in {item['pickup_code'] for item in items}:
+        _build_qr_png(code)
+    return [
+        build_pickup_message(item['to_email'], item['pickup_code'], item['bay_id']).as_string()
+        for item in items
+    ]
+
+
+def open_session():
+    """Abre y autentica una conexión SMTP. STARTTLS y login son opcionales
+    (SMTP_STARTTLS, SMTP_USERNAME vacío) para poder probar contra un
+    servidor SMTP local de depuración."""
+    server = smtplib.SMTP(config.SMTP_HOST, config.SMTP_PORT, timeout=config.SMTP_TIMEOUT_SECONDS)
     try:
-        with smtplib.SMTP(config.SMTP_HOST, config.SMTP_PORT, timeout=10) as server:
+        if config.SMTP_STARTTLS:
             server.starttls()
+        if config.SMTP_USERNAME:
             server.login(config.SMTP_USERNAME, config.SMTP_PASSWORD)
-            server.sendmail(config.SMTP_FROM_EMAIL, [to_email], msg.as_string())
-        return True, None
-    except Exception as e:
-        return False, str(e)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+def send(server, to_email, message):
+    """Envía un mensaje ya serializado (ver render_pickup_messages)."""
+    server.sendmail(config.SMTP_FROM_EMAIL, [to_email], message)
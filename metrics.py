@@ -0,0 +1,138 @@
+"""In-process latency histograms and counters, rendered as Prometheus text.
+
+Instrumentation points (server.py request hooks, the SerialLink worker in
+hardware.py, db.py's _read/_write) call observe()/inc() on the module-level
+metrics below; /api/admin/metrics renders them all. Histograms use fixed
+buckets, so recording a sample is a bisect plus a few integer updates under
+a per-metric lock — cheap enough to leave on in production. Label values
+are passed positionally, in the order of the metric's labelnames, and must
+come from a bounded set (route templates, not raw paths).
+"""
+import bisect
+import threading
+import time
+
+_registry = []
+
+# Upper bounds, in seconds.
+HTTP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SERIAL_BUCKETS = (0.005, 0.01, 0.015, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0, 2.5)
+SQLITE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=HTTP_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values → [count per bucket..., +Inf count], sum
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        for labelvalues, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = bound if bound == '+Inf' else repr(float(bound))
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), labelvalues + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {total:.9g}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labelvalues, value in values:
+            lines.append(f"{self.name}{_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+_started = time.time()
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = [
+        "# HELP kiosk_start_time_seconds Unix time the server process started.",
+        "# TYPE kiosk_start_time_seconds gauge",
+        f"kiosk_start_time_seconds {_started:.3f}",
+    ]
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+http_request_seconds = Histogram(
+    'kiosk_http_request_duration_seconds',
+    'Time to handle an HTTP request, by route template, method and status.',
+    ('route', 'method', 'status'), HTTP_BUCKETS,
+)
+serial_roundtrip_seconds = Histogram(
+    'kiosk_serial_roundtrip_seconds',
+    'Serial command round-trip (write until reply or deadline), by port and command.',
+    ('port', 'command'), SERIAL_BUCKETS,
+)
+serial_results = Counter(
+    'kiosk_serial_commands_total',
+    'Serial commands by port, command and result (ok, no_reply, error, breaker_open).',
+    ('port', 'command', 'result'),
+)
+serial_timeouts = Counter(
+    'kiosk_serial_status_timeouts_total',
+    'Status queries the board never answered before the deadline, per door.',
+    ('port', 'board', 'channel'),
+)
+serial_checksum_errors = Counter(
+    'kiosk_serial_checksum_errors_total',
+    'Frames dropped for a bad XOR checksum while waiting on a door\'s reply.',
+    ('port', 'board', 'channel'),
+)
+sqlite_wait_seconds = Histogram(
+    'kiosk_sqlite_wait_seconds',
+    'Time waiting for a connection: the writer lock (write) or the read pool (read).',
+    ('mode',), SQLITE_BUCKETS,
+)
+sqlite_query_seconds = Histogram(
+    'kiosk_sqlite_query_seconds',
+    'Time holding a connection (queries and commit), by mode and db.py function.',
+    ('mode', 'function'), SQLITE_BUCKETS,
+)
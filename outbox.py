@@ -0,0 +1,181 @@
+"""Durable outbox for pickup emails, drained by a background SMTP worker.
+
+/api/admin/deposit/send-email used to connect, STARTTLS, log in and send
+while the admin waited at the kiosk, and a failed send was simply lost.
+Now the request only inserts a row into the outbox table in kiosk.db and
+returns; this worker picks up everything that is due, sends the whole
+batch over one authenticated SMTP session, and records the result per
+message. A failed send stays pending and is retried with exponential
+backoff (OUTBOX_RETRY_BASE_SECONDS, doubling up to OUTBOX_RETRY_MAX_SECONDS)
+until OUTBOX_MAX_ATTEMPTS, then marked failed. Pending emails survive a
+restart; clearing a bay cancels any email still pending for its code.
+
+Each batch is claimed in the database before it is sent (a lease of
+CLAIM_LEASE_SECONDS), so an entry is never picked up twice while a send is
+in progress. Delivery is at-least-once: a crash between the SMTP server
+accepting a message and the row being marked sent means it is sent again
+once the lease runs out. A result is only recorded against its own claim:
+an entry cancelled while it was being sent (the bay was cleared or picked
+up) stays cancelled, and a failure never brings it back for a retry.
+"""
+import smtplib
+import threading
+from datetime import datetime, timedelta, timezone
+
+import config
+import db
+import mailer
+
+# How long the worker sleeps when nothing is pending; queue() wakes it
+# early, so this only bounds how late a retry can be noticed.
+IDLE_WAIT_SECONDS = 60.0
+# How long a claimed batch is kept from being picked up again; a batch of
+# OUTBOX_BATCH_SIZE sends finishes well within it.
+CLAIM_LEASE_SECONDS = 600.0
+
+
+class OutboxWorker:
+    def __init__(self, batch_size, max_attempts, retry_base, retry_max, on_result=None):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        # on_result(item, error, final): error is None once sent; final is
+        # True when no further attempt will be made.
+        self.on_result = on_result
+        self._wake = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='email-outbox', daemon=True)
+            self._thread.start()
+
+    def queue(self, bay_id, to_email, pickup_code):
+        """Stores the pickup email and wakes the worker. Returns the
+        outbox id; never touches the network."""
+        email_id = db.enqueue_email(bay_id, to_email, pickup_code)
+        self._wake.set()
+        return email_id
+
+    def queue_many(self, items):
+        """queue() for a list of (bay_id, to_email, pickup_code), stored in
+        one transaction and sent together in the next batch."""
+        email_ids = db.enqueue_emails(items)
+        self._wake.set()
+        return email_ids
+
+    def run_once(self):
+        """Sends every email that is due right now, a batch at a time.
+        Returns how many were attempted."""
+        attempted = 0
+        while True:
+            now = datetime.now(timezone.utc)
+            lease_until = (now + timedelta(seconds=CLAIM_LEASE_SECONDS)).isoformat()
+            batch = db.claim_due_emails(now.isoformat(), self.batch_size, lease_until)
+            if not batch:
+                return attempted
+            self._send_batch(batch)
+            attempted += len(batch)
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                if mailer.is_configured():
+                    self.run_once()
+            except Exception as e:
+                print(f"OUTBOX ERROR: {e}")
+            self._wake.wait(self._seconds_until_next_due())
+
+    def _seconds_until_next_due(self):
+        try:
+            next_due = db.next_email_due()
+        except Exception:
+            next_due = None
+        if not next_due:
+            return IDLE_WAIT_SECONDS
+        delay = (datetime.fromisoformat(next_due) - datetime.now(timezone.utc)).total_seconds()
+        return min(max(delay, 0.0), IDLE_WAIT_SECONDS)
+
+    def _send_batch(self, batch):
+        # Rendered up front, before the SMTP session opens, so the session
+        # isn't left idle while QR codes are generated.
+        try:
+            messages = mailer.render_pickup_messages(batch)
+        except Exception as e:
+            for item in batch:
+                self._failed(item, e)
+            return
+        session = None
+        try:
+            for index, (item, message) in enumerate(zip(batch, messages)):
+                try:
+                    if session is None:
+                        session = mailer.open_session()
+                except Exception as e:
+                    # Can't reach or log into the server: the rest of the
+                    # batch would fail the same way, so retry them all later.
+                    for pending in batch[index:]:
+                        self._failed(pending, e)
+                    return
+                try:
+                    mailer.send(session, item['to_email'], message)
+                except smtplib.SMTPRecipientsRefused as e:
+                    self._failed(item, e, permanent=True)
+                    continue
+                except smtplib.SMTPResponseException as e:
+                    # The server answered (e.g. 451 try later): the session
+                    # is still good for the rest of the batch.
+                    self._failed(item, e)
+                    continue
+                except Exception as e:
+                    self._failed(item, e)
+                    # The session may be half-broken; the next item opens a
+                    # fresh one.
+                    _close(session)
+                    session = None
+                    continue
+                if db.mark_email_sent(item['id'], item['next_attempt_at']):
+                    self._notify(item, None, True)
+        finally:
+            if session is not None:
+                _close(session)
+
+    def _failed(self, item, error, permanent=False):
+        attempts = item['attempts'] + 1
+        final = permanent or attempts >= self.max_attempts
+        next_attempt_at = None
+        if not final:
+            delay = min(self.retry_max, self.retry_base * (2 ** (attempts - 1)))
+            next_attempt_at = (datetime.now(timezone.utc) + timedelta(seconds=delay)).isoformat()
+        if db.mark_email_failed(item['id'], item['next_attempt_at'], str(error), next_attempt_at):
+            self._notify(item, str(error), final)
+
+    def _notify(self, item, error, final):
+        if self.on_result:
+            try:
+                self.on_result(item, error, final)
+            except Exception as e:
+                print(f"OUTBOX ERROR: {e}")
+
+
+def _close(session):
+    try:
+        session.quit()
+    except Exception:
+        try:
+            session.close()
+        except Exception:
+            pass
+
+
+worker = OutboxWorker(
+    batch_size=config.OUTBOX_BATCH_SIZE,
+    max_attempts=config.OUTBOX_MAX_ATTEMPTS,
+    retry_base=config.OUTBOX_RETRY_BASE_SECONDS,
+    retry_max=config.OUTBOX_RETRY_MAX_SECONDS,
+)
@@ -0,0 +1,231 @@
+"""Background door-status poller with an in-memory snapshot.
+
+/api/lockers used to poll every enabled channel inside the HTTP request.
+Instead, one thread keeps a snapshot of every door current and requests
+just read it. Doors that were just opened (or are still open) are polled
+often; closed, idle doors only every so often.
+
+Like hardware.py, this only knows about physical addresses (port, board,
+channel — see config.LockerAddress), not lockers. A sweep over doors on
+several ports runs on every port's serial worker at once.
+
+A pass reads every open door that is due — someone is waiting for it to
+close — but at most CLOSED_PER_PASS closed ones per port (idle, or still
+in their hot window), the most overdue first; the rest go in the next
+passes, which run back to back while anything is due. An open door is
+never stuck behind a sweep of every closed door, which at 200 lockers
+took seconds.
+
+When a read fails (or a port's circuit breaker is open, see hardware.py)
+the door keeps its last known status, flagged as degraded so it reads as
+stale right away; the next good read clears the flag. When a port's
+breaker closes again, every door on it is polled at once.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+import config
+import hardware
+
+# Closed doors read per port and pass. A status read is ~15-25 ms on the
+# board, so a pass stays well under the hot interval; the sweep itself is
+# no slower, the port is just as busy.
+CLOSED_PER_PASS = 2
+
+
+class StatusPoller:
+    def __init__(self, addresses, hot_interval, idle_interval, hot_window):
+        self.addresses = list(dict.fromkeys(addresses))
+        self._known = set(self.addresses)
+        self.hot_interval = hot_interval
+        self.idle_interval = idle_interval
+        self.hot_window = hot_window
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._ready = threading.Event()
+        self._snapshot = {}
+        self._hot_until = {}
+        self._opened_at = {}
+        self._next_due = {address: 0.0 for address in self.addresses}
+        self._unswept = set(self.addresses)  # not read yet since start
+        self._listeners = []
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='status-poller', daemon=True)
+        self._thread.start()
+
+    def add_listener(self, callback):
+        """callback(address, status) runs on every status change (outside
+        the snapshot lock, on whichever thread saw the change)."""
+        self._listeners.append(callback)
+
+    def wait_ready(self, timeout):
+        """Blocks until every door has been read once (or timeout)."""
+        return self._ready.wait(timeout)
+
+    def mark_hot(self, address):
+        """Polls this door at the fast rate for the next hot_window seconds.
+        Addresses the poller doesn't sweep are ignored: they would never
+        come due and would keep the loop from ever sleeping."""
+        if address not in self._known:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._hot_until[address] = now + self.hot_window
+            self._next_due[address] = now
+        self._wake.set()
+
+    def note_opened(self, address):
+        """Called right after an open command was accepted. The door is
+        assumed UNLOCKED until the next (hot) poll says otherwise, so a
+        reader never sees the pre-open LOCKED state as "already closed"."""
+        if address not in self._known:
+            return
+        with self._lock:
+            self._opened_at[address] = time.monotonic()
+            changed = self._store(address, "UNLOCKED")
+        self.mark_hot(address)
+        if changed:
+            self._notify(address)
+
+    def get(self, address):
+        with self._lock:
+            entry = self._snapshot.get(address)
+            return self._public(entry)
+
+    def snapshot(self):
+        with self._lock:
+            return {address: self._public(entry) for address, entry in self._snapshot.items()}
+
+    def _public(self, entry):
+        if entry is None:
+            return {"status": "UNKNOWN", "checkedAt": None, "stale": True}
+        age = time.monotonic() - entry["mono"]
+        return {
+            "status": entry["status"],
+            "checkedAt": entry["checkedAt"],
+            # Más viejo que dos ciclos lentos = el sondeo se está atrasando
+            # (o el hardware no responde); la UI puede marcarlo.
+            "stale": entry["degraded"] or age > 2 * self.idle_interval,
+        }
+
+    def _store(self, address, status):
+        """Updates the snapshot; returns True if the status changed (or
+        stopped being degraded)."""
+        previous = self._snapshot.get(address)
+        self._snapshot[address] = {
+            "status": status,
+            "checkedAt": datetime.now(timezone.utc).isoformat(),
+            "mono": time.monotonic(),
+            "degraded": False,
+        }
+        return previous is None or previous["status"] != status or previous["degraded"]
+
+    def _degrade(self, address):
+        """Keeps the last known status but flags it stale; returns True if
+        it wasn't flagged already."""
+        entry = self._snapshot.get(address)
+        if entry is None or entry["degraded"]:
+            return False
+        entry["degraded"] = True
+        return True
+
+    def on_breaker_change(self, port, breaker):
+        """hardware breaker listener: a port that went down makes all its
+        doors stale at once; one that came back is swept right away."""
+        now = time.monotonic()
+        with self._lock:
+            on_port = [address for address in self.addresses if address.port == port]
+            if breaker["state"] == hardware.BREAKER_CLOSED:
+                for address in on_port:
+                    self._next_due[address] = now
+                changed = []
+            else:
+                changed = [address for address in on_port if self._degrade(address)]
+        self._wake.set()
+        for address in changed:
+            self._notify(address)
+
+    def _notify(self, address):
+        status = self.get(address)
+        for callback in self._listeners:
+            try:
+                callback(address, status)
+            except Exception as e:
+                print(f"POLLER ERROR: listener falló para {address}: {e}")
+
+    def _is_hot(self, address, now):
+        hot_until = self._hot_until.get(address)
+        if hot_until is not None:
+            if hot_until > now:
+                return True
+            del self._hot_until[address]
+        # Una puerta abierta se sigue sondeando rápido hasta que se cierre.
+        return self._is_open(address)
+
+    def _is_open(self, address):
+        entry = self._snapshot.get(address)
+        return entry is not None and entry["status"] == "UNLOCKED"
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            with self._lock:
+                opened, closed = [], []
+                for addr in self.addresses:
+                    if self._next_due[addr] <= now:
+                        (opened if self._is_open(addr) else closed).append(addr)
+                closed.sort(key=self._next_due.get)
+                due, taken = opened, {}
+                for addr in closed:
+                    if taken.get(addr.port, 0) < CLOSED_PER_PASS:
+                        taken[addr.port] = taken.get(addr.port, 0) + 1
+                        due.append(addr)
+            if due:
+                changed = []
+                for result in hardware.get_all_statuses(due, priority=hardware.PRIORITY_BACKGROUND):
+                    address = result["address"]
+                    with self._lock:
+                        # Una lectura encolada antes de una apertura no debe
+                        # pisar el UNLOCKED optimista de note_opened().
+                        if result["stale"]:
+                            # Sin respuesta: se conserva lo último que se
+                            # supo (p.ej. el UNLOCKED de note_opened()).
+                            if self._degrade(address):
+                                changed.append(address)
+                        elif self._opened_at.get(address, 0.0) <= now:
+                            if self._store(address, result["status"]):
+                                changed.append(address)
+                        done = time.monotonic()
+                        interval = self.hot_interval if self._is_hot(address, done) else self.idle_interval
+                        self._next_due[address] = done + interval
+                        self._unswept.discard(address)
+                if not self._unswept:
+                    self._ready.set()
+                for address in changed:
+                    self._notify(address)
+            with self._lock:
+                next_due = min(self._next_due.values(), default=time.monotonic() + self.idle_interval)
+            self._wake.wait(max(0.0, next_due - time.monotonic()))
+
+
+def enabled_addresses():
+    return [
+        config.address_for(bay_id)
+        for bay_id in range(1, config.NUM_LOCKERS + 1)
+        if bay_id not in config.DISABLED_LOCKERS
+    ]
+
+
+poller = StatusPoller(
+    enabled_addresses(),
+    hot_interval=config.STATUS_POLL_HOT_SECONDS,
+    idle_interval=config.STATUS_POLL_IDLE_SECONDS,
+    hot_window=config.STATUS_POLL_HOT_WINDOW_SECONDS,
+)
+hardware.add_breaker_listener(poller.on_breaker_change)
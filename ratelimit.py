@@ -0,0 +1,130 @@
+"""Bounded sliding-window rate limiter (pickup codes, admin login).
+
+Each key (an IP) keeps just three numbers: the start of the current fixed
+window, the count in it and the count in the previous one. The sliding
+estimate is previous * (fraction of the previous window still in range) +
+current — the usual sliding-window counter: O(1) per attempt, no list of
+timestamps to rebuild.
+
+Keys live in an LRU map capped at max_keys; the least recently seen key is
+dropped first, and keys idle for two windows (whose counts can no longer
+matter) are expired on the way. With persist=True every recorded attempt
+is also written to SQLite and the map is reloaded at startup, so a restart
+of server.py doesn't reset anyone's limit.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import config
+import db
+
+
+def _advance(state, now, window):
+    """Rolls (window_start, current, previous) forward to the window that
+    contains `now`."""
+    window_start, current, previous = state
+    elapsed_windows = int((now - window_start) // window)
+    if elapsed_windows <= 0:
+        return state
+    if elapsed_windows == 1:
+        return (window_start + window, 0, current)
+    return (window_start + elapsed_windows * window, 0, 0)
+
+
+def _estimate(state, now, window):
+    window_start, current, previous = state
+    overlap = 1.0 - (now - window_start) / window
+    return previous * max(overlap, 0.0) + current
+
+
+class SlidingWindowLimiter:
+    def __init__(self, name, limit, window, max_keys=10000, persist=False):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.persist = persist
+        self._entries = OrderedDict()  # key → (window_start, current, previous)
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def check(self, key, now=None):
+        """True if `key` is over the limit right now. Records nothing."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._ensure_loaded(now)
+            state = self._entries.get(key)
+            if state is None:
+                return False
+            return _estimate(_advance(state, now, self.window), now, self.window) >= self.limit
+
+    def hit(self, key, now=None):
+        """Counts one attempt for `key`. Returns True — without counting it —
+        if the limit was already reached."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._ensure_loaded(now)
+            limited, state = self._apply(self._entries.get(key), now)
+            # Stored either way: a rejected key was still just seen (LRU).
+            self._store(key, state, now)
+            # Only counted attempts are written, so a flood of rejected
+            # ones never turns into a flood of SQLite writes.
+            if not limited and self.persist:
+                db.save_rate_limit(self.name, key, *state)
+        return limited
+
+    def reset(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.persist:
+            db.delete_rate_limit(self.name, key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _apply(self, state, now):
+        """(limited, new_state) for one attempt against `state`."""
+        if state is None:
+            state = (now - now % self.window, 0, 0)
+        state = _advance(state, now, self.window)
+        if _estimate(state, now, self.window) >= self.limit:
+            return True, state
+        window_start, current, previous = state
+        return False, (window_start, current + 1, previous)
+
+    def _store(self, key, state, now):
+        self._entries[key] = state
+        self._entries.move_to_end(key)
+        self._evict(now)
+
+    def _evict(self, now):
+        expired_before = now - 2 * self.window
+        while self._entries:
+            key, (window_start, _, _) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_keys and window_start >= expired_before:
+                break
+            self._entries.popitem(last=False)
+
+    def _ensure_loaded(self, now):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.persist:
+            return
+        expired_before = now - 2 * self.window
+        for key, *state in db.load_rate_limits(self.name, expired_before, self.max_keys):
+            self._entries[key] = tuple(state)
+
+
+def _limiter(name, limit, window):
+    return SlidingWindowLimiter(
+        name, limit, window,
+        max_keys=config.RATE_LIMIT_MAX_KEYS,
+        persist=config.RATE_LIMIT_PERSIST,
+    )
+
+
+pickup = _limiter('pickup', config.PICKUP_RATE_LIMIT_ATTEMPTS, config.PICKUP_RATE_LIMIT_WINDOW_SECONDS)
+admin_login = _limiter('admin_login', config.ADMIN_LOGIN_RATE_LIMIT_ATTEMPTS,
+                       config.ADMIN_LOGIN_RATE_LIMIT_WINDOW_SECONDS)
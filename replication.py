@@ -0,0 +1,146 @@
+"""Incremental replication of the change feed to the fleet aggregator.
+
+Each kiosk keeps its own kiosk.db. With REPLICATION_URL set, db.py appends
+every bay mutation and audit event to the `changes` table (same
+transaction as the change itself), and this exporter ships what the
+aggregator (tools/aggregator.py) hasn't seen yet:
+
+- on start it asks the aggregator for this site's cursor (the last seq it
+  stored), so a restart, a lost response or a wiped kiosk.db resumes from
+  the right place instead of from a local bookmark that may be stale;
+- rows after the cursor go out REPLICATION_BATCH_SIZE at a time as
+  gzip-compressed NDJSON, one compact JSON array per change;
+- the aggregator answers with the new cursor, and everything up to it is
+  pruned from kiosk.db, so the feed only holds what is still unsent.
+
+Applying a batch is idempotent on the aggregator side (changes are keyed
+by site and seq, bay rows only move forward), so a resend after a timeout
+or two server processes exporting at once is harmless. Failures back off
+exponentially, from REPLICATION_INTERVAL_SECONDS up to MAX_RETRY_SECONDS.
+"""
+import gzip
+import json
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import config
+import db
+
+REQUEST_TIMEOUT_SECONDS = 15
+MAX_RETRY_SECONDS = 3600
+
+
+class ReplicationError(Exception):
+    pass
+
+
+class ChangeExporter:
+    def __init__(self, url, site_id, token, batch_size, interval_seconds, on_error=None):
+        self.url = url
+        self.site_id = site_id
+        self.token = token
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        # on_error(error) runs on the exporter thread after a failed sync.
+        self.on_error = on_error
+        self._cursor = None  # last seq the aggregator acknowledged
+        self._failures = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not self.url or (self._thread and self._thread.is_alive()):
+            return
+        db.start_change_feed()
+        self._thread = threading.Thread(target=self._run, name='change-exporter', daemon=True)
+        self._thread.start()
+
+    def run_once(self):
+        """Ships every pending change now, a batch at a time. Returns how
+        many were sent."""
+        with self._lock:
+            reset = False
+            if self._cursor is None:
+                self._cursor = self._fetch_cursor()
+                # The aggregator is ahead of anything this database ever
+                # wrote: kiosk.db was replaced. Start the site over.
+                reset = self._cursor > db.change_feed_high_water()
+                if reset:
+                    self._cursor = 0
+            sent = 0
+            while True:
+                rows = db.get_changes(self._cursor, self.batch_size)
+                if not rows and not reset:
+                    return sent
+                acked = self._post(rows, reset)
+                if rows and acked < rows[-1]['seq']:
+                    raise ReplicationError(f"el agregador solo confirmó hasta {acked}")
+                reset = False
+                self._cursor = acked
+                db.prune_changes(acked)
+                sent += len(rows)
+                if len(rows) < self.batch_size:
+                    return sent
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+                self._failures = 0
+            except Exception as e:
+                # Ask again next time: the aggregator may have moved on (or
+                # lost data) while we couldn't reach it.
+                self._cursor = None
+                self._failures += 1
+                if self.on_error:
+                    try:
+                        self.on_error(e)
+                    except Exception:
+                        pass
+                else:
+                    print(f"REPLICATION ERROR: {e}")
+            self._wake.wait(min(MAX_RETRY_SECONDS, self.interval_seconds * 2 ** self._failures))
+            self._wake.clear()
+
+    def _site_url(self, path):
+        return f"{self.url}/api/sites/{urllib.parse.quote(self.site_id, safe='')}/{path}"
+
+    def _request(self, url, data=None, headers=()):
+        request = urllib.request.Request(url, data=data, headers=dict(headers))
+        if self.token:
+            request.add_header('Authorization', f'Bearer {self.token}')
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT_SECONDS) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise ReplicationError(f"HTTP {e.code} desde el agregador: {e.read()[:200]!r}") from e
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            raise ReplicationError(f"agregador inaccesible: {e}") from e
+
+    def _fetch_cursor(self):
+        return int(self._request(self._site_url('cursor'))['seq'])
+
+    def _post(self, rows, reset=False):
+        body = ''.join(
+            f'[{row["seq"]},{json.dumps(row["ts"])},"{row["kind"]}",'
+            f'{json.dumps(row["bay_id"])},{row["data"]}]\n'
+            for row in rows
+        ).encode('utf-8')
+        url = self._site_url('changes') + ('?reset=1' if reset else '')
+        result = self._request(url, gzip.compress(body), {
+            'Content-Type': 'application/x-ndjson',
+            'Content-Encoding': 'gzip',
+        })
+        return int(result['seq'])
+
+
+exporter = ChangeExporter(
+    url=config.REPLICATION_URL,
+    site_id=config.SITE_ID,
+    token=config.REPLICATION_TOKEN,
+    batch_size=config.REPLICATION_BATCH_SIZE,
+    interval_seconds=config.REPLICATION_INTERVAL_SECONDS,
+)
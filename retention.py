@@ -0,0 +1,56 @@
+"""Periodic retention job for the audit log.
+
+Once a day (RETENTION_INTERVAL_HOURS), events older than
+EVENT_RETENTION_DAYS are moved out of kiosk.db into compressed monthly
+archive files (see db.archive_events) and the freed space is returned to
+the SD card. The live table only ever holds the recent window that the
+admin events API browses.
+"""
+import threading
+from datetime import datetime, timedelta, timezone
+
+import config
+import db
+
+
+class RetentionJob:
+    def __init__(self, retention_days, archive_dir, interval_seconds, on_archived=None):
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.interval_seconds = interval_seconds
+        self.on_archived = on_archived
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.retention_days <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._run, name='event-retention', daemon=True)
+        self._thread.start()
+
+    def run_once(self):
+        """Archives everything past the retention window right now. Returns
+        how many events were moved out of the database."""
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=self.retention_days)).isoformat()
+        with self._lock:
+            archived = db.archive_events(cutoff, self.archive_dir)
+        if archived and self.on_archived:
+            self.on_archived(archived, cutoff)
+        return archived
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"RETENTION ERROR: {e}")
+            self._wake.wait(self.interval_seconds)
+            self._wake.clear()
+
+
+job = RetentionJob(
+    retention_days=config.EVENT_RETENTION_DAYS,
+    archive_dir=config.EVENT_ARCHIVE_DIR,
+    interval_seconds=config.RETENTION_INTERVAL_HOURS * 3600,
+)
@@ -0,0 +1,96 @@
+"""Hourly and daily deposit statistics, maintained incrementally.
+
+A finished deposit used to survive only as a free-text line in `events`;
+clear_bay wiped the row, so dwell time and utilization meant regex-scanning
+the log. Now db.confirm_deposit opens a row in the `deposits` history table
+and db.clear_bay closes it, and in the same transaction both bump a few
+rollup rows per period (an hour and a day, in UTC):
+
+- deposit_rollups: deposits, pickups and the sum of their dwell times
+  (deposit → pickup), for the average;
+- deposit_dwell: a fixed-bucket histogram of those dwell times, for p95;
+- bay_rollups: deposits and occupied seconds per bay, for utilization. An
+  occupancy is split across every hour/day it spans when it ends.
+
+/api/admin/stats reads only rollup rows for the range it is asked about,
+so its cost depends on the range, never on how much history there is.
+This module only does the arithmetic (period keys, interval splitting,
+percentiles); the SQL lives in db.py.
+"""
+import bisect
+from datetime import datetime, timedelta, timezone
+
+PERIODS = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
+
+# Upper bounds of the dwell histogram, in seconds (5 min … 2 weeks); one
+# more bucket catches everything longer.
+DWELL_BUCKETS = (
+    300, 900, 1800, 3600, 2 * 3600, 4 * 3600, 8 * 3600, 12 * 3600,
+    86400, 2 * 86400, 4 * 86400, 7 * 86400, 14 * 86400,
+)
+
+
+def period_start(period, moment):
+    """Start of the hour/day (UTC) containing `moment`, a datetime."""
+    moment = moment.astimezone(timezone.utc)
+    if period == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def period_key(period, moment):
+    """The rollup row key (ISO timestamp, comparable with events.ts)."""
+    return period_start(period, moment).isoformat()
+
+
+def dwell_bucket(seconds):
+    return bisect.bisect_left(DWELL_BUCKETS, seconds)
+
+
+def occupancy_segments(start, end):
+    """Splits the interval [start, end) across the hours and days it
+    touches. Yields (period, key, seconds)."""
+    for period, step in PERIODS.items():
+        cursor = period_start(period, start)
+        while cursor < end:
+            following = cursor + step
+            seconds = (min(end, following) - max(start, cursor)).total_seconds()
+            if seconds > 0:
+                yield period, cursor.isoformat(), seconds
+            cursor = following
+
+
+def overlap_seconds(start, end, since, until):
+    """Seconds of [start, end) that fall inside [since, until)."""
+    return max(0.0, (min(end, until) - max(start, since)).total_seconds())
+
+
+def percentile(counts, q):
+    """Estimates the q-quantile (0 < q <= 1) of a dwell histogram given as
+    {bucket: count}, interpolating linearly inside the bucket it falls in.
+    None when there are no samples."""
+    total = sum(counts.values())
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for bucket in sorted(counts):
+        count = counts[bucket]
+        if seen + count >= rank:
+            if bucket >= len(DWELL_BUCKETS):
+                return float(DWELL_BUCKETS[-1])
+            lower = DWELL_BUCKETS[bucket - 1] if bucket else 0
+            return lower + (DWELL_BUCKETS[bucket] - lower) * (rank - seen) / count
+        seen += count
+    return float(DWELL_BUCKETS[-1])
+
+
+def parse_ts(value):
+    """ISO timestamp from the database → aware datetime (UTC)."""
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
@@ -1,52 +1,204 @@
 # Save this as server.py
+import atexit
+import hmac
+import itertools
+import json
 import logging
+import os
+import queue
 import secrets
+import signal
+import sys
+import threading
 import time
-from datetime import timedelta
+import zlib
+from datetime import datetime, timedelta, timezone
 from functools import wraps
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-from flask import Flask, request, jsonify, session, send_from_directory
+try:
+    import fcntl
+except ImportError:  # Sin flock: no se puede detectar un segundo proceso.
+    fcntl = None
+
+from flask import Flask, Response, g, request, jsonify, session
 from werkzeug.security import check_password_hash
 
+import assets
+import audit
+import baystate
+import bundle
+import changes
 import config
 import db
+import deposits
+import export
 import hardware
 import mailer
+import metrics
+import outbox
+import ratelimit
+import replication
+import retention
+import rollups
+from broadcast import broadcaster
+from poller import poller
+
+# Marcas del arranque, para --profile-startup. Lo que más pesa en el Pi es
+# importar (Flask sobre todo); qrcode/PIL se cargan después (ver mailer.py).
+_boot_marks = [('imports', time.perf_counter())]
+
+
+def _mark(phase):
+    _boot_marks.append((phase, time.perf_counter()))
+
 
 app = Flask(__name__, static_folder=None)
 app.secret_key = config.SECRET_KEY
 app.permanent_session_lifetime = timedelta(minutes=config.SESSION_LIFETIME_MINUTES)
 
+
+# Latencia de cada request, por plantilla de ruta (todos los
+# /api/lockers/<id>/status son una sola serie), para /api/admin/metrics.
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _record_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_request_seconds.observe(
+            time.perf_counter() - started, route, request.method, str(response.status_code)
+        )
+    return response
+
+
+def _claim_instance():
+    """El servidor es un solo proceso (waitress con WSGI_THREADS hilos): la
+    foto de las puertas, el stream de eventos, los depósitos en curso y los
+    trabajos de fondo (cola de correo, retención, replicación) viven en su
+    memoria. Un segundo proceso sobre la misma base (otro `python
+    server.py`, gunicorn -w N) duplicaría correos, archivado y sondeo serie,
+    así que se niega a arrancar. El lock (flock) se suelta solo al morir el
+    proceso."""
+    if fcntl is None:
+        return None
+    fd = os.open(f"{config.DB_PATH}.lock", os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        sys.exit(f"ERROR: otro proceso del servidor ya está usando {config.DB_PATH}; "
+                 f"el kiosco corre en un solo proceso.")
+    return fd
+
+
+_instance_lock = _claim_instance()
 db.init_db()
+changes.state.start(db.claim_version_base(int(time.time() * 1000), changes.BOOT_STRIDE))
+_mark('init_db')
+poller.start()
 
 # --- Logging: file (for tailing on the Pi) + DB (queryable audit trail) ---
+# Ninguno de los dos escribe en el hilo del request: el archivo pasa por un
+# QueueListener y la BD por audit.writer, que agrupa los INSERT por lotes.
+class _DroppingQueueHandler(QueueHandler):
+    """Si la cola del log a archivo se llena, se descarta la línea en vez de
+    bloquear el request (el registro en BD la conserva igual)."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
 log_handler = RotatingFileHandler(config.LOG_FILE, maxBytes=1024 * 1024, backupCount=5)
 log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-app.logger.addHandler(log_handler)
+log_listener = QueueListener(queue.Queue(maxsize=config.AUDIT_QUEUE_SIZE), log_handler)
+app.logger.addHandler(_DroppingQueueHandler(log_listener.queue))
 app.logger.setLevel(logging.INFO)
+log_listener.start()
+audit.writer.start()
+# Al salir se vacían ambas colas (audit.writer registra su propio atexit).
+atexit.register(log_listener.stop)
 app.logger.info('--- Kiosk Lock Server INICIADO ---')
+_mark('logging')
 
 
-def log(level, message):
+def log(level, message, bay_id=None):
     getattr(app.logger, level)(message)
-    db.log_event(level.upper(), message)
+    audit.writer.enqueue(level.upper(), message, bay_id)
 
 
-# --- Simple in-memory rate limit for pickup-code attempts ---
-_pickup_attempts = {}
+retention.job.on_archived = lambda count, cutoff: log(
+    'info', f"Retención: {count} evento(s) anteriores a {cutoff} archivados en {config.EVENT_ARCHIVE_DIR}"
+)
+retention.job.start()
 
 
-def _is_rate_limited(ip):
-    now = time.time()
-    window = config.PICKUP_RATE_LIMIT_WINDOW_SECONDS
-    attempts = [t for t in _pickup_attempts.get(ip, []) if now - t < window]
-    if len(attempts) >= config.PICKUP_RATE_LIMIT_ATTEMPTS:
-        _pickup_attempts[ip] = attempts
-        return True
-    attempts.append(now)
-    _pickup_attempts[ip] = attempts
-    return False
+def _on_email_result(item, error, final):
+    bay_id = item['bay_id']
+    if error is None:
+        log('info', f"Correo de recogida enviado para casillero {bay_id} a {item['to_email']}", bay_id=bay_id)
+    elif final:
+        log('error', f"Fallo definitivo al enviar correo de recogida para casillero {bay_id}: {error}", bay_id=bay_id)
+    else:
+        log('warning', f"Fallo al enviar correo de recogida para casillero {bay_id} (se reintentará): {error}", bay_id=bay_id)
+
+
+outbox.worker.on_result = _on_email_result
+outbox.worker.start()
+
+
+def _on_bay_transition(bay_id, state, reason, bay):
+    # `bay` es la fila de antes del cambio: trae el correo y el código.
+    if state == baystate.OCCUPIED:
+        log('info', f"PAQUETE DEPOSITADO en casillero {bay_id} para {bay['customer_email']} (Código: {bay['pickup_code']})", bay_id=bay_id)
+    elif bay['occupied']:
+        if reason == baystate.REASON_TIMEOUT:
+            log('warning', f"Casillero {bay_id} sigue abierto tras la recogida; se da por recogido", bay_id=bay_id)
+        log('info', f"PAQUETE RECOGIDO del casillero {bay_id} (Código: {bay['pickup_code']})", bay_id=bay_id)
+    elif reason == baystate.REASON_RESTART:
+        # Sin cambio en la base: queda pendiente hasta que el admin decida.
+        log('warning', f"Depósito pendiente en casillero {bay_id} sin confirmar tras reiniciar: la puerta ya estaba cerrada. "
+                       f"Revisar el casillero y confirmar o liberar (Código: {bay['pickup_code']})", bay_id=bay_id)
+    else:
+        log('warning', f"Depósito en casillero {bay_id} anulado: la puerta no se cerró a tiempo (Código: {bay['pickup_code']})", bay_id=bay_id)
+    if reason == baystate.REASON_RESTART:
+        # Lo demás cambió la base y ya lo publicó _on_db_change.
+        _publish_bay(bay_id)
+
+
+baystate.machine.on_transition = _on_bay_transition
+
+
+def _on_batch_update(batch, item):
+    if item is None:
+        queued = sum(1 for i in batch.items if i.email_id is not None)
+        log('info', f"Lote de depósito {batch.id} terminado ({queued} correo(s) encolados)")
+        return
+    # El depósito confirmado o anulado ya lo registra _on_bay_transition.
+    bay_id = item.bay_id
+    if item.status == deposits.STATUS_OPEN:
+        log('info', f"Lote {batch.id}: comando de apertura enviado para depósito en casillero {bay_id}", bay_id=bay_id)
+    elif item.status == deposits.STATUS_OPEN_FAILED:
+        log('error', f"Lote {batch.id}: fallo al abrir casillero {bay_id} para depósito; se libera", bay_id=bay_id)
+
+
+deposits.depositor.on_update = _on_batch_update
+
+# Replicación al agregador central (solo con REPLICATION_URL).
+replication.exporter.on_error = lambda error: log('warning', f"Replicación: {error}")
+replication.exporter.start()
+# El QR del primer depósito no debería pagar el import de qrcode, pero
+# tampoco el arranque: se importa en segundo plano un rato después.
+QR_WARMUP_DELAY_SECONDS = 10
+mailer.warm_up(QR_WARMUP_DELAY_SECONDS)
+_mark('workers')
 
 
 def admin_required(f):
@@ -59,16 +211,45 @@ def admin_required(f):
 
 
 # --- Static frontend (single entrypoint: http://127.0.0.1:5000/) ---
+# Indexado una vez al arrancar (ver assets.py): ETag por contenido, 304,
+# variantes gzip/brotli ya comprimidas y caché inmutable para las URLs con
+# huella (?v=) que se escriben en index.html y en los CSS.
+STATIC_DIRS = ('css', 'js', 'images', 'vendor', 'branding', 'bundle')
+DEV_MODE = '--dev' in sys.argv
+static_assets = assets.AssetStore(config.BASE_DIR, STATIC_DIRS, config.ASSET_CACHE_DIR,
+                                  watch=DEV_MODE).load()
+# Un solo JS/CSS, íconos y fondo livianos, y el service worker que los sirve
+# sin red (ver bundle.py). En --dev se sirven los archivos sueltos, para que
+# un cambio se vea sin reiniciar.
+service_worker_js = bundle.service_worker(config.BASE_DIR)
+if config.FRONTEND_BUNDLE and not DEV_MODE:
+    try:
+        service_worker_js = bundle.build(static_assets, config.WALLPAPER_MAX_WIDTH).service_worker
+    except bundle.BundleError as e:
+        log('warning', f"No se pudo armar el bundle del frontend; se sirven los archivos sueltos: {e}")
+_mark('assets')
+
+
 @app.route('/')
 def index():
-    return send_from_directory(config.BASE_DIR, 'index.html')
+    return assets.response(static_assets.get('index.html'), request, immutable=False)
+
+
+@app.route('/sw.js')
+def service_worker():
+    # Sin caché HTTP: el navegador lo compara byte a byte para saber si hay
+    # una versión nueva del frontend.
+    return Response(service_worker_js, mimetype='application/javascript', headers={
+        "Cache-Control": "no-cache",
+    })
 
 
 @app.route('/<path:filename>')
 def static_files(filename):
-    if filename.split('/')[0] not in ('css', 'js', 'images', 'vendor', 'branding'):
+    asset = static_assets.get(filename) if filename.split('/')[0] in STATIC_DIRS else None
+    if asset is None:
         return jsonify({"success": False, "error": "No encontrado"}), 404
-    return send_from_directory(config.BASE_DIR, filename)
+    return assets.response(asset, request)
 
 
 # --- Config ---
@@ -85,55 +266,267 @@ def api_config():
 
 
 # --- Locker status (hardware + DB merged) ---
-def _merged_bays(include_pickup_code=False):
-    enabled_bay_ids = [i for i in range(1, config.NUM_LOCKERS + 1) if i not in config.DISABLED_LOCKERS]
-    channels_to_poll = [config.channel_for(bay_id) for bay_id in enabled_bay_ids]
-    hw_statuses = {s['channel']: s['status'] for s in hardware.get_all_statuses(channels_to_poll)}
+def _hardware_for(bay_id, hw_statuses=None):
+    if bay_id in config.DISABLED_LOCKERS:
+        return {"status": "DISABLED", "checkedAt": None, "stale": False}
+    address = config.address_for(bay_id)
+    if hw_statuses is not None and address in hw_statuses:
+        return hw_statuses[address]
+    return poller.get(address)
+
+
+def _email_entry(email):
+    if not email:
+        return None
+    return {
+        "status": email['status'],
+        "attempts": email['attempts'],
+        "error": email['last_error'],
+        "sentAt": email['sent_at'],
+    }
+
+
+def _bay_entry(bay, hw, include_pickup_code=False, email_statuses=None):
+    entry = {
+        "id": bay['id'],
+        "occupied": bool(bay['occupied']),
+        "customerEmail": bay['customer_email'],
+        "state": baystate.machine.state_of(bay),
+        "hardwareStatus": hw["status"],
+        "hardwareCheckedAt": hw["checkedAt"],
+        "hardwareStale": hw["stale"],
+    }
+    # El código de recogida solo se expone a un admin autenticado: es la
+    # credencial del cliente, no debe ser legible desde un GET público.
+    if include_pickup_code:
+        entry["pickupCode"] = bay['pickup_code']
+        entry["emailStatus"] = _email_entry((email_statuses or {}).get(bay['id']))
+        entry["needsReview"] = baystate.machine.needs_review(bay['id'])
+    return entry
+
+
+def _merged_bays(include_pickup_code=False, hw_statuses=None):
+    # El estado físico sale de la foto que mantiene el poller en segundo
+    # plano — ningún request espera a un sondeo serie. Solo el primer request
+    # tras arrancar espera (acotado) a que termine el primer barrido.
+    if hw_statuses is None:
+        poller.wait_ready(timeout=3.0)
+        hw_statuses = poller.snapshot()
     # Solo se muestran casilleros dentro del rango físico actual (NUM_LOCKERS)
     # — filas más allá de eso son de una configuración anterior con más
     # casilleros y ya no aplican a este sitio.
     bays = [b for b in db.get_all_bays() if b['id'] <= config.NUM_LOCKERS]
-    result = []
-    for bay in bays:
-        if bay['id'] in config.DISABLED_LOCKERS:
-            hardware_status = "DISABLED"
-        else:
-            hardware_status = hw_statuses.get(config.channel_for(bay['id']), "UNKNOWN")
-        entry = {
-            "id": bay['id'],
-            "occupied": bool(bay['occupied']),
-            "customerEmail": bay['customer_email'],
-            "hardwareStatus": hardware_status,
-        }
-        # El código de recogida solo se expone a un admin autenticado: es la
-        # credencial del cliente, no debe ser legible desde un GET público.
-        if include_pickup_code:
-            entry["pickupCode"] = bay['pickup_code']
-        result.append(entry)
-    return result
+    email_statuses = db.get_email_statuses() if include_pickup_code else None
+    return [
+        _bay_entry(bay, _hardware_for(bay['id'], hw_statuses), include_pickup_code, email_statuses)
+        for bay in bays
+    ]
+
+
+def _publish_bay(bay_id):
+    """Empuja el estado actual de un casillero a los clientes de
+    /api/events/stream. Nunca incluye el código de recogida (el stream es
+    público, igual que /api/lockers sin sesión).
+
+    Todo cambio de un casillero pasa por aquí, así que también es donde
+    avanza la versión del estado (ver changes.py). Lo que cambia en la
+    base llega solo, por _on_db_change."""
+    bay = db.get_bay(bay_id)
+    if not bay or bay_id > config.NUM_LOCKERS:
+        return
+    changes.state.bump(bay_id)
+    broadcaster.publish("bay", _bay_entry(bay, _hardware_for(bay_id)))
+
+
+def _on_hardware_change(address, status):
+    bay_id = config.bay_for(address)
+    if bay_id is not None:
+        _publish_bay(bay_id)
+
+
+def _on_db_change(bay_ids):
+    # Toda escritura de db.py que toca un casillero o su correo (depósito,
+    # recogida, liberación, cola de correo, enviado/fallido).
+    for bay_id in sorted(bay_ids):
+        _publish_bay(bay_id)
+
+
+poller.add_listener(_on_hardware_change)
+db.add_change_listener(_on_db_change)
+# Recién ahora: al adoptar los depósitos pendientes la máquina puede avisar
+# enseguida, y _on_bay_transition publica con _publish_bay.
+baystate.machine.start()
+
+
+def _hardware_summary():
+    """Estado de los puertos serie, para el aviso de falla de hardware de
+    la UI: un puerto con el circuito abierto no se está consultando y sus
+    puertas muestran el último estado conocido."""
+    ports = [
+        {"port": port, "state": breaker["state"], "since": breaker["openSince"]}
+        for port, breaker in sorted(hardware.breaker_states().items())
+    ]
+    return {
+        "fault": any(port["state"] != hardware.BREAKER_CLOSED for port in ports),
+        "ports": ports,
+    }
+
+
+def _on_breaker_change(port, breaker):
+    broadcaster.publish("hardware", _hardware_summary())
+
+
+hardware.add_breaker_listener(_on_breaker_change)
+
+
+# Último cuerpo de /api/lockers por rol, indexado por su ETag: mientras la
+# versión no cambie, los refrescos no reconstruyen ni vuelven a serializar
+# la lista.
+_lockers_body_cache = {}
+
+
+def _lockers_etag(version, hw_statuses, hw_summary, is_admin):
+    # "stale" depende de la antigüedad del último sondeo, no de un evento,
+    # así que no mueve la versión: entra en el ETag aparte, igual que el
+    # estado de los puertos.
+    stale = sorted(address for address, status in hw_statuses.items() if status["stale"])
+    crc = zlib.crc32(json.dumps([stale, hw_summary]).encode())
+    return f'"{version}-{crc:x}-{"a" if is_admin else "p"}"'
+
+
+def _etag_matches(header, etag):
+    return any(tag.strip() in (etag, 'W/' + etag, '*') for tag in header.split(','))
 
 
 @app.route('/api/lockers')
 def api_lockers():
     is_admin = bool(session.get('is_admin'))
-    return jsonify({"success": True, "bays": _merged_bays(include_pickup_code=is_admin)})
+    poller.wait_ready(timeout=3.0)
+    # La versión se lee ANTES de armar la lista: si algo cambia mientras
+    # tanto, el cliente verá una versión vieja y lo pedirá otra vez.
+    version = changes.state.version
+    hw_statuses = poller.snapshot()
+    hw_summary = _hardware_summary()
+    etag = _lockers_etag(version, hw_statuses, hw_summary, is_admin)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Cookie"}
+    if _etag_matches(request.headers.get('If-None-Match', ''), etag):
+        return Response(status=304, headers=headers)
+
+    cached = _lockers_body_cache.get(is_admin)
+    if cached and cached[0] == etag:
+        body = cached[1]
+    else:
+        body = json.dumps({
+            "success": True,
+            "version": version,
+            "bays": _merged_bays(include_pickup_code=is_admin, hw_statuses=hw_statuses),
+            "hardware": hw_summary,
+        })
+        _lockers_body_cache[is_admin] = (etag, body)
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+@app.route('/api/lockers/changes')
+def api_lockers_changes():
+    """Solo los casilleros que cambiaron después de la versión `since`
+    (la que trajo el último /api/lockers o /api/lockers/changes). Si esa
+    versión es demasiado vieja o de antes de un reinicio, devuelve la lista
+    completa con full=true."""
+    try:
+        since = int(request.args.get('since', ''))
+    except ValueError:
+        return jsonify({"success": False, "error": "Parámetro 'since' inválido"}), 400
+
+    is_admin = bool(session.get('is_admin'))
+    version = changes.state.version
+    changed = changes.state.changed_since(since)
+    if changed is None:
+        return jsonify({"success": True, "version": version, "full": True,
+                        "bays": _merged_bays(include_pickup_code=is_admin),
+                        "hardware": _hardware_summary()})
+
+    hw_statuses = poller.snapshot()
+    email_statuses = db.get_email_statuses() if is_admin and changed else None
+    bays = []
+    for bay_id in sorted(changed):
+        bay = db.get_bay(bay_id)
+        if bay and bay_id <= config.NUM_LOCKERS:
+            bays.append(_bay_entry(bay, _hardware_for(bay_id, hw_statuses), is_admin, email_statuses))
+    return jsonify({"success": True, "version": version, "full": False, "bays": bays,
+                    "hardware": _hardware_summary()})
 
 
 @app.route('/api/lockers/<int:bay_id>/status')
 def api_locker_status(bay_id):
-    status = hardware.get_lock_status(config.channel_for(bay_id))
-    return jsonify({"success": True, "status": status["status"], "channel": bay_id})
+    # Quien pregunta por una puerta concreta está esperando a que se cierre:
+    # se sondea rápido mientras tanto y se responde desde la foto.
+    if not 1 <= bay_id <= config.NUM_LOCKERS:
+        return jsonify({"success": False, "error": "Casillero no existe"}), 404
+    if bay_id not in config.DISABLED_LOCKERS:
+        poller.mark_hot(config.address_for(bay_id))
+    status = _hardware_for(bay_id)
+    return jsonify({
+        "success": True,
+        "status": status["status"],
+        "channel": bay_id,
+        "checkedAt": status["checkedAt"],
+        "stale": status["stale"],
+    })
+
+
+# --- Live locker events (Server-Sent Events) ---
+SSE_KEEPALIVE_SECONDS = 15
+
+
+@app.route('/api/events/stream')
+def api_events_stream():
+    sub = broadcaster.subscribe()
+
+    def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                if sub.overflowed:
+                    # El cliente se quedó atrás: que pida el estado completo.
+                    sub.overflowed = False
+                    yield "event: resync\ndata: {}\n\n"
+                try:
+                    event_type, data = sub.queue.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            broadcaster.unsubscribe(sub)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
 
 
 # --- Admin auth ---
+def _check_admin_password(password):
+    if config.ADMIN_PASSWORD_HASH:
+        return check_password_hash(config.ADMIN_PASSWORD_HASH, password)
+    return hmac.compare_digest(password.encode(), config.DEFAULT_ADMIN_PASSWORD.encode())
+
+
 @app.route('/api/admin/login', methods=['POST'])
 def admin_login():
+    # Solo cuentan los intentos fallidos; un login correcto borra la cuenta.
+    ip = request.remote_addr or 'unknown'
+    if ratelimit.admin_login.check(ip):
+        return jsonify({"success": False, "error": "Demasiados intentos. Espera unos minutos e intenta de nuevo."}), 429
+
     data = request.get_json(silent=True) or {}
     password = data.get('password', '')
-    if check_password_hash(config.ADMIN_PASSWORD_HASH, password):
+    if _check_admin_password(str(password)):
+        ratelimit.admin_login.reset(ip)
         session.permanent = True
         session['is_admin'] = True
         return jsonify({"success": True})
+    ratelimit.admin_login.hit(ip)
     log('warning', "Intento fallido de login de administrador")
     return jsonify({"success": False, "error": "Contraseña incorrecta"}), 401
 
@@ -170,14 +563,22 @@ def admin_deposit():
         return jsonify({"success": False, "error": "Casillero no existe"}), 404
     if bay['occupied']:
         return jsonify({"success": False, "error": "Casillero ocupado"}), 409
+    if baystate.machine.state_of(bay) != baystate.IDLE:
+        return jsonify({"success": False, "error": "Casillero con un depósito pendiente"}), 409
 
-    if not hardware.open_locker(config.channel_for(bay_id)):
-        log('error', f"Fallo al abrir casillero {bay_id} para depósito")
+    if not hardware.open_locker(config.address_for(bay_id)):
+        log('error', f"Fallo al abrir casillero {bay_id} para depósito", bay_id=bay_id)
         return jsonify({"success": False, "error": "Fallo al comunicar con el hardware"}), 500
+    poller.note_opened(config.address_for(bay_id))
 
     pickup_code = secrets.token_hex(max(config.PICKUP_CODE_LENGTH, 4) // 2).upper()
     db.stage_deposit(bay_id, email, pickup_code)
-    log('info', f"Comando de apertura enviado para depósito en casillero {bay_id}")
+    # Desde aquí el servidor sigue la puerta y confirma (o anula) el
+    # depósito solo, aunque el navegador se recargue.
+    baystate.machine.deposit_opened(bay_id, config.address_for(bay_id))
+    # El QR del correo se genera mientras el operador carga el paquete.
+    mailer.prerender_qr(pickup_code)
+    log('info', f"Comando de apertura enviado para depósito en casillero {bay_id}", bay_id=bay_id)
     return jsonify({"success": True, "pickupCode": pickup_code})
 
 
@@ -190,13 +591,82 @@ def admin_deposit_confirm():
     except (TypeError, ValueError):
         return jsonify({"success": False, "error": "Casillero inválido"}), 400
 
+    # Con `pickupCode` solo vale para ESE depósito: si se anuló (la puerta
+    # no se cerró a tiempo) y el casillero ya tiene otro, no se confunden.
+    pickup_code = data.get('pickupCode')
     bay = db.get_bay(bay_id)
-    if not bay or not bay['pickup_code'] or bay['occupied']:
-        return jsonify({"success": False, "error": "No hay un depósito pendiente para este casillero"}), 400
+    if pickup_code is not None and (
+            not bay or not hmac.compare_digest((bay['pickup_code'] or '').encode(), str(pickup_code).encode())):
+        return jsonify({"success": False, "error": "El depósito se anuló: la puerta no se cerró a tiempo"}), 409
 
-    db.confirm_deposit(bay_id)
-    log('info', f"PAQUETE DEPOSITADO en casillero {bay_id} para {bay['customer_email']} (Código: {bay['pickup_code']})")
-    return jsonify({"success": True})
+    # Normalmente ya lo confirmó el servidor al cerrarse la puerta; el
+    # frontend lo llama igual para saber en qué terminó (responde igual).
+    if baystate.machine.settle(bay_id, baystate.STAGED):
+        return jsonify({"success": True})
+    bay = db.get_bay(bay_id)
+    if bay and bay['occupied']:
+        return jsonify({"success": True})
+    return jsonify({"success": False, "error": "No hay un depósito pendiente para este casillero"}), 400
+
+
+@app.route('/api/admin/deposit/batch', methods=['POST'])
+@admin_required
+def admin_deposit_batch():
+    """Reparto de mensajería: un depósito por correo de la lista, en los
+    casilleros libres de menor número. Responde de inmediato con la
+    asignación; las puertas se abren en segundo plano (ver deposits.py) y
+    el avance se consulta en /api/admin/deposit/batch/<id>."""
+    data = request.get_json(silent=True) or {}
+    emails = data.get('emails')
+    if not isinstance(emails, list) or not emails:
+        return jsonify({"success": False, "error": "Lista de correos vacía"}), 400
+    emails = [str(email).strip() for email in emails]
+    invalid = [email for email in emails if not email or '@' not in email]
+    if invalid:
+        return jsonify({"success": False, "error": f"Correo inválido: {invalid[0] or '(vacío)'}"}), 400
+    if len(emails) > config.NUM_LOCKERS:
+        return jsonify({"success": False, "error": f"Máximo {config.NUM_LOCKERS} correos por lote"}), 400
+    send_emails = bool(data.get('sendEmails', True))
+    if send_emails and not mailer.is_configured():
+        return jsonify({"success": False, "error": "SMTP no configurado (revisa SMTP_* en .env)"}), 409
+
+    # Además de los ocupados o con depósito pendiente (eso lo filtra la BD),
+    # se saltan los fuera de servicio, los que están en otro lote y los que
+    # no se ven cerrados ahora mismo.
+    poller.wait_ready(timeout=3.0)
+    hw_statuses = poller.snapshot()
+    exclude = set(config.DISABLED_LOCKERS) | deposits.depositor.busy_bays()
+    exclude |= {
+        bay_id for bay_id in range(1, config.NUM_LOCKERS + 1)
+        if _hardware_for(bay_id, hw_statuses)["status"] != "LOCKED"
+    }
+    codes = set()
+    while len(codes) < len(emails):
+        codes.add(secrets.token_hex(max(config.PICKUP_CODE_LENGTH, 4) // 2).upper())
+    allocated = db.allocate_deposits(list(zip(emails, codes)), config.NUM_LOCKERS, exclude)
+    if not allocated:
+        return jsonify({"success": False, "error": "No hay casilleros disponibles"}), 409
+
+    for bay_id, _, pickup_code in allocated:
+        mailer.prerender_qr(pickup_code)
+    batch = deposits.depositor.start(
+        allocated, {bay_id: config.address_for(bay_id) for bay_id, _, _ in allocated}, send_emails,
+    )
+    log('info', f"Lote de depósito {batch.id}: {len(allocated)} casillero(s) asignados de {len(emails)} correo(s)")
+    return jsonify({
+        "success": True,
+        "batch": batch.to_dict(),
+        "unassigned": emails[len(allocated):],
+    })
+
+
+@app.route('/api/admin/deposit/batch/<int:batch_id>')
+@admin_required
+def admin_deposit_batch_status(batch_id):
+    batch = deposits.depositor.get(batch_id)
+    if batch is None:
+        return jsonify({"success": False, "error": "Lote no encontrado"}), 404
+    return jsonify({"success": True, "batch": batch.to_dict()})
 
 
 @app.route('/api/admin/deposit/send-email', methods=['POST'])
@@ -212,12 +682,15 @@ def admin_send_pickup_email():
     if not bay or not bay['pickup_code'] or not bay['customer_email']:
         return jsonify({"success": False, "error": "No hay un depósito para este casillero"}), 400
 
-    sent, error = mailer.send_pickup_email(bay['customer_email'], bay['pickup_code'], bay_id)
-    if sent:
-        log('info', f"Correo de recogida enviado para casillero {bay_id} a {bay['customer_email']}")
-    else:
-        log('error', f"Fallo al enviar correo de recogida para casillero {bay_id}: {error}")
-    return jsonify({"success": sent, "error": error})
+    if not mailer.is_configured():
+        log('error', f"No se encoló el correo de recogida para casillero {bay_id}: SMTP no configurado", bay_id=bay_id)
+        return jsonify({"success": False, "error": "SMTP no configurado (revisa SMTP_* en .env)"})
+
+    # Solo se encola: el envío (y sus reintentos) lo hace outbox.worker en
+    # segundo plano, así el admin no espera al servidor de correo.
+    email_id = outbox.worker.queue(bay_id, bay['customer_email'], bay['pickup_code'])
+    log('info', f"Correo de recogida encolado para casillero {bay_id} a {bay['customer_email']}", bay_id=bay_id)
+    return jsonify({"success": True, "queued": True, "emailId": email_id})
 
 
 # --- Manual maintenance (admin) ---
@@ -233,14 +706,211 @@ def admin_open():
     if bay_id in config.DISABLED_LOCKERS:
         return jsonify({"success": False, "error": "Casillero fuera de servicio"}), 409
 
-    if not hardware.open_locker(config.channel_for(bay_id)):
-        log('error', f"Fallo al abrir casillero {bay_id} manualmente")
+    if not hardware.open_locker(config.address_for(bay_id)):
+        log('error', f"Fallo al abrir casillero {bay_id} manualmente", bay_id=bay_id)
         return jsonify({"success": False, "error": "Fallo al comunicar con el hardware"}), 500
+    poller.note_opened(config.address_for(bay_id))
 
-    log('info', f"Apertura manual (admin) del casillero {bay_id}")
+    log('info', f"Apertura manual (admin) del casillero {bay_id}", bay_id=bay_id)
     return jsonify({"success": True})
 
 
+# --- Audit log browsing (admin) ---
+EVENTS_PAGE_MAX = 500
+
+
+def _parse_utc(value):
+    """ISO 8601 → ISO en UTC, comparable con events.ts. Sin zona = UTC."""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).isoformat()
+
+
+@app.route('/api/admin/events')
+@admin_required
+def admin_events():
+    args = request.args
+    try:
+        limit = min(max(int(args.get('limit', 100)), 1), EVENTS_PAGE_MAX)
+        before_id = int(args['before']) if args.get('before') else None
+        bay_id = int(args['bayId']) if args.get('bayId') else None
+        since = _parse_utc(args['since']) if args.get('since') else None
+        until = _parse_utc(args['until']) if args.get('until') else None
+    except ValueError:
+        return jsonify({"success": False, "error": "Parámetros inválidos"}), 400
+    levels = [lvl.strip().upper() for lvl in args.get('level', '').split(',') if lvl.strip()]
+
+    events = db.get_events(before_id=before_id, limit=limit, levels=levels,
+                           since=since, until=until, bay_id=bay_id)
+    next_cursor = events[-1]['id'] if len(events) == limit else None
+    return jsonify({"success": True, "events": events, "nextCursor": next_cursor})
+
+
+@app.route('/api/admin/events/archive', methods=['POST'])
+@admin_required
+def admin_events_archive():
+    if config.EVENT_RETENTION_DAYS <= 0:
+        return jsonify({"success": False, "error": "La retención está deshabilitada (EVENT_RETENTION_DAYS=0)"}), 409
+    archived = retention.job.run_once()
+    return jsonify({"success": True, "archived": archived})
+
+
+# --- Exportación (CSV/NDJSON en streaming) ---
+# Columnas de cada dataset, en orden. Los eventos se leen de SQLite por
+# tramos y de los archivos mensuales del archivo histórico, así que el
+# tamaño del rango no cambia la memoria usada.
+EXPORT_COLUMNS = {
+    'bays': ['id', 'occupied', 'state', 'customerEmail', 'pickupCode',
+             'hardwareStatus', 'hardwareCheckedAt'],
+    'events': ['id', 'ts', 'level', 'message', 'bay_id'],
+    'deposits': ['id', 'bay_id', 'customer_email', 'staged_at', 'deposited_at',
+                 'picked_up_at', 'ended_by', 'dwell_seconds'],
+}
+
+
+def _export_rows(dataset, since, until):
+    if dataset == 'bays':
+        return iter(_merged_bays(include_pickup_code=True))
+    if dataset == 'deposits':
+        return db.iter_deposits(since, until)
+    archived = db.iter_archived_events(config.EVENT_ARCHIVE_DIR, since, until)
+    return itertools.chain(archived, db.iter_events(since, until))
+
+
+@app.route('/api/admin/export/<dataset>')
+@admin_required
+def admin_export(dataset):
+    if dataset not in EXPORT_COLUMNS:
+        return jsonify({"success": False, "error": "Dataset desconocido"}), 404
+    args = request.args
+    fmt = args.get('format', 'csv')
+    if fmt not in export.MIMETYPES:
+        return jsonify({"success": False, "error": "Formato inválido (csv o ndjson)"}), 400
+    try:
+        since = _parse_utc(args['since']) if args.get('since') else None
+        until = _parse_utc(args['until']) if args.get('until') else None
+    except ValueError:
+        return jsonify({"success": False, "error": "Parámetros inválidos"}), 400
+    compress = args.get('gzip') == '1'
+
+    body = export.stream(_export_rows(dataset, since, until), EXPORT_COLUMNS[dataset], fmt, compress)
+    filename = f"{dataset}_{datetime.now(timezone.utc):%Y-%m-%d}.{fmt}" + ('.gz' if compress else '')
+    return Response(body, mimetype='application/gzip' if compress else export.MIMETYPES[fmt], headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Cache-Control": "no-store",
+        "X-Accel-Buffering": "no",
+    })
+
+
+# --- Estadísticas de uso (rollups por hora/día, ver rollups.py) ---
+STATS_DEFAULT_SPAN = {'hour': timedelta(hours=24), 'day': timedelta(days=30)}
+STATS_MAX_POINTS = 24 * 93
+
+
+def _dwell_summary(dwell_sum, pickups, histogram):
+    p95 = rollups.percentile(histogram, 0.95)
+    return {
+        "avgDwellSeconds": round(dwell_sum / pickups, 1) if pickups else None,
+        "p95DwellSeconds": round(p95, 1) if p95 is not None else None,
+    }
+
+
+@app.route('/api/admin/stats')
+@admin_required
+def admin_stats():
+    args = request.args
+    period = args.get('period', 'hour')
+    if period not in rollups.PERIODS:
+        return jsonify({"success": False, "error": "Período inválido (hour o day)"}), 400
+    step = rollups.PERIODS[period]
+    now = datetime.now(timezone.utc)
+    try:
+        until = datetime.fromisoformat(_parse_utc(args['until'])) if args.get('until') else now
+        since = datetime.fromisoformat(_parse_utc(args['since'])) if args.get('since') else until - STATS_DEFAULT_SPAN[period]
+    except ValueError:
+        return jsonify({"success": False, "error": "Parámetros inválidos"}), 400
+    # Los rollups son por período completo: el rango se amplía a horas/días
+    # enteros.
+    since = rollups.period_start(period, since)
+    if rollups.period_start(period, until) != until:
+        until = rollups.period_start(period, until) + step
+    if until <= since or (until - since) / step > STATS_MAX_POINTS:
+        return jsonify({"success": False, "error": f"Rango inválido (máx. {STATS_MAX_POINTS} períodos)"}), 400
+
+    rows, dwells = db.get_rollups(period, since.isoformat(), until.isoformat())
+    series = []
+    total_deposits = total_pickups = total_dwell = 0
+    total_histogram = {}
+    for row in rows:
+        histogram = dwells.get(row['start'], {})
+        series.append({
+            "start": row['start'],
+            "deposits": row['deposits'],
+            "pickups": row['pickups'],
+            **_dwell_summary(row['dwell_sum'], row['pickups'], histogram),
+        })
+        total_deposits += row['deposits']
+        total_pickups += row['pickups']
+        total_dwell += row['dwell_sum']
+        for bucket, count in histogram.items():
+            total_histogram[bucket] = total_histogram.get(bucket, 0) + count
+
+    # Utilización = tiempo ocupado / tiempo transcurrido del rango. Los
+    # paquetes que siguen dentro aún no están en bay_rollups (su ocupación
+    # se reparte al retirarlos), así que se suman aparte: son pocos.
+    elapsed = (min(until, now) - since).total_seconds()
+    usage = {row['bay_id']: row for row in db.get_bay_utilization(period, since.isoformat(), until.isoformat())}
+    occupied = {bay_id: row['occupied_seconds'] for bay_id, row in usage.items()}
+    open_deposits = db.get_open_deposits()
+    for deposit in open_deposits:
+        occupied[deposit['bay_id']] = occupied.get(deposit['bay_id'], 0.0) + rollups.overlap_seconds(
+            rollups.parse_ts(deposit['deposited_at']), now, since, until)
+    bays = [{
+        "bayId": bay_id,
+        "deposits": usage[bay_id]['deposits'] if bay_id in usage else 0,
+        "occupiedSeconds": round(occupied.get(bay_id, 0.0)),
+        "utilization": round(occupied.get(bay_id, 0.0) / elapsed, 4) if elapsed > 0 else None,
+    } for bay_id in range(1, config.NUM_LOCKERS + 1)]
+
+    return jsonify({
+        "success": True,
+        "period": period,
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "series": series,
+        "totals": {
+            "deposits": total_deposits,
+            "pickups": total_pickups,
+            "occupiedNow": len(open_deposits),
+            **_dwell_summary(total_dwell, total_pickups, total_histogram),
+        },
+        "bays": bays,
+    })
+
+
+@app.route('/api/admin/hardware/stats')
+@admin_required
+def admin_hardware_stats():
+    return jsonify({
+        "success": True,
+        "latency": hardware.latency_stats(),
+        "checksumErrors": hardware.checksum_errors(),
+        "breakers": hardware.breaker_states(),
+    })
+
+
+@app.route('/api/admin/metrics')
+def admin_metrics():
+    # Sin @admin_required: además de la sesión acepta METRICS_TOKEN, para
+    # que un Prometheus pueda leerlo sin hacer login.
+    token = config.METRICS_TOKEN
+    authorization = request.headers.get('Authorization', '')
+    if not session.get('is_admin') and not (token and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())):
+        return jsonify({"success": False, "error": "No autorizado"}), 401
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route('/api/admin/clear', methods=['POST'])
 @admin_required
 def admin_clear():
@@ -250,8 +920,9 @@ def admin_clear():
     except (TypeError, ValueError):
         return jsonify({"success": False, "error": "Casillero inválido"}), 400
 
-    db.clear_bay(bay_id)
-    log('info', f"Casillero {bay_id} liberado manualmente (admin)")
+    baystate.machine.forget(bay_id)
+    db.clear_bay(bay_id, ended_by='admin')
+    log('info', f"Casillero {bay_id} liberado manualmente (admin)", bay_id=bay_id)
     return jsonify({"success": True})
 
 
@@ -259,7 +930,7 @@ def admin_clear():
 @app.route('/api/pickup', methods=['POST'])
 def pickup():
     ip = request.remote_addr or 'unknown'
-    if _is_rate_limited(ip):
+    if ratelimit.pickup.hit(ip):
         return jsonify({"success": False, "error": "Demasiados intentos. Espera un momento e intenta de nuevo."}), 429
 
     data = request.get_json(silent=True) or {}
@@ -272,11 +943,13 @@ def pickup():
         log('warning', f"Intento de recogida con código inválido: {code}")
         return jsonify({"success": False, "error": "El código no es válido o ya fue usado"}), 404
 
-    if not hardware.open_locker(config.channel_for(bay['id'])):
-        log('error', f"Fallo al abrir casillero {bay['id']} para recogida")
+    if not hardware.open_locker(config.address_for(bay['id'])):
+        log('error', f"Fallo al abrir casillero {bay['id']} para recogida", bay_id=bay['id'])
         return jsonify({"success": False, "error": "Fallo al comunicar con el hardware"}), 500
+    poller.note_opened(config.address_for(bay['id']))
+    baystate.machine.pickup_opened(bay['id'], config.address_for(bay['id']))
 
-    log('info', f"Casillero {bay['id']} abierto para recogida (Código: {code})")
+    log('info', f"Casillero {bay['id']} abierto para recogida (Código: {code})", bay_id=bay['id'])
     return jsonify({"success": True, "bayId": bay['id']})
 
 
@@ -289,13 +962,14 @@ def pickup_confirm():
     except (TypeError, ValueError):
         return jsonify({"success": False, "error": "Casillero inválido"}), 400
 
+    # Como el confirm del depósito: el servidor ya libera el casillero al
+    # cerrarse la puerta, y un confirm tardío responde igual de bien.
     bay = db.get_bay(bay_id)
-    if not bay or bay['pickup_code'] != code:
-        return jsonify({"success": False, "error": "El código no coincide con el depósito pendiente"}), 400
-
-    log('info', f"PAQUETE RECOGIDO del casillero {bay_id} (Código: {code})")
-    db.clear_bay(bay_id)
-    return jsonify({"success": True})
+    if bay and bay['pickup_code'] == code and baystate.machine.settle(bay_id, baystate.PICKING_UP):
+        return jsonify({"success": True})
+    if bay and not bay['occupied'] and not bay['pickup_code']:
+        return jsonify({"success": True})
+    return jsonify({"success": False, "error": "El código no coincide con el depósito pendiente"}), 400
 
 
 # --- Frontend event logging (kept for client-side errors worth recording) ---
@@ -312,7 +986,70 @@ def handle_log_event():
     return jsonify({"success": True})
 
 
+_mark('rutas')
+
+
+# --- Perfil de arranque ---
+def _process_age():
+    """Segundos desde que se lanzó este proceso (Linux; None si no se sabe)."""
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+def _profile_startup():
+    """Espera como run_kiosk.sh a que /api/config responda, imprime cuánto
+    tardó cada fase del arranque y detiene el servidor."""
+    import urllib.request
+    host = '127.0.0.1' if config.SERVER_HOST in ('', '0.0.0.0') else config.SERVER_HOST
+    url = f"http://{host}:{config.SERVER_PORT}/api/config"
+    deadline = time.monotonic() + 30
+    ready = False
+    while not ready and time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                ready = response.status == 200
+        except OSError:
+            time.sleep(0.005)
+    _mark('primer /api/config' if ready else 'sin respuesta (30 s)')
+
+    age = _process_age()
+    # Sin /proc el origen es el fin de los imports (se pierde esa fase).
+    origin = _boot_marks[-1][1] - age if age is not None else _boot_marks[0][1]
+    print("--- Perfil de arranque (ms desde que se lanzó el proceso) ---")
+    previous = origin
+    for phase, at in _boot_marks:
+        print(f"  {phase:<22} {1000 * (at - origin):8.1f}   (+{1000 * (at - previous):.1f})")
+        previous = at
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Kiosk Lock Server")
+    parser.add_argument('--dev', action='store_true',
+                        help="servidor de desarrollo de Flask en vez de waitress")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="mide el arranque hasta el primer /api/config, lo imprime y sale")
+    args = parser.parse_args()
+
+    # run_kiosk.sh / systemd detienen el proceso con SIGTERM: convertirlo en
+    # una salida normal para que atexit vacíe los logs pendientes.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     print("--- Starting Kiosk Lock Server ---")
-    print(f"Frontend + API listos en http://127.0.0.1:5000/  ({config.NUM_LOCKERS} casilleros)")
-    app.run(host='127.0.0.1', port=5000)
+    print(f"Frontend + API listos en http://{config.SERVER_HOST}:{config.SERVER_PORT}/  ({config.NUM_LOCKERS} casilleros)")
+    if args.profile_startup:
+        threading.Thread(target=_profile_startup, name='profile-startup', daemon=True).start()
+    if args.dev:
+        app.run(host=config.SERVER_HOST, port=config.SERVER_PORT, threaded=True)
+    else:
+        from waitress import serve
+        _mark('waitress')
+        # Cada conexión SSE abierta ocupa un hilo mientras dure, de ahí el
+        # margen en WSGI_THREADS.
+        serve(app, host=config.SERVER_HOST, port=config.SERVER_PORT, threads=config.WSGI_THREADS)
@@ -0,0 +1,61 @@
+"""Test setup: a throwaway database and directories, and the board
+simulator (tools/board_sim.py) standing in for the serial port.
+
+config.py reads the environment on import, so this runs before anything
+from the kiosk is imported. SERIAL_PORT points at a symlink that is made
+to point at the simulator's pty once it's running.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'tools'))
+
+_tmp = Path(tempfile.mkdtemp(prefix='kiosk-tests-'))
+os.environ.update({
+    'DB_PATH': str(_tmp / 'kiosk.db'),
+    'LOG_FILE': str(_tmp / 'action_log.log'),
+    'EVENT_ARCHIVE_DIR': str(_tmp / 'archive'),
+    'ASSET_CACHE_DIR': str(_tmp / 'asset_cache'),
+    'SERIAL_PORT': str(_tmp / 'board'),
+    'SERIAL_LOCK_DIR': str(_tmp),
+    'SECRET_KEY': 'test',
+    'ADMIN_PASSWORD_HASH': 'pbkdf2:sha256:600000$test$test',
+    'NUM_LOCKERS': '4',
+    # Nothing listens there: emails are queued and fail, which is enough.
+    'SMTP_HOST': '127.0.0.1',
+    'SMTP_PORT': '1',
+    'STATUS_POLL_HOT_SECONDS': '0.05',
+    'DEPOSIT_BATCH_OPEN_INTERVAL_SECONDS': '0.05',
+})
+
+from board_sim import BoardSimulator  # noqa: E402
+
+board = BoardSimulator(status_latency=0.002, door_open_seconds=None)
+os.symlink(board.start(), os.environ['SERIAL_PORT'])
+# The server's threads run until the interpreter exits; the simulator has
+# to outlive them.
+atexit.register(shutil.rmtree, _tmp, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def server():
+    import server
+    from poller import poller
+    poller.wait_ready(timeout=3.0)
+    return server
+
+
+@pytest.fixture
+def admin(server):
+    client = server.app.test_client()
+    with client.session_transaction() as session:
+        session['is_admin'] = True
+    return client
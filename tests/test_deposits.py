@@ -0,0 +1,40 @@
+import time
+
+import baystate
+import config
+import db
+import deposits
+from conftest import board
+
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_admin_clear_mid_batch_finishes_the_batch(admin):
+    reply = admin.post('/api/admin/deposit/batch', json={'emails': ['a@example.com', 'b@example.com']})
+    assert reply.status_code == 200
+    batch = deposits.depositor.get(reply.get_json()['batch']['id'])
+    first, second = batch.items
+    assert _wait_for(lambda: first.status == second.status == deposits.STATUS_OPEN)
+
+    # The courier fills the second door; the admin clears the first one.
+    address = config.address_for(second.bay_id)
+    board.close_door(address.board, address.channel)
+    assert _wait_for(lambda: second.status == deposits.STATUS_DEPOSITED)
+    assert admin.post('/api/admin/clear', json={'bayId': first.bay_id}).get_json()['success']
+
+    assert _wait_for(lambda: batch.finished)
+    assert first.status == deposits.STATUS_CLEARED
+    assert second.email_id is not None
+    assert deposits.depositor.busy_bays() == set()
+    assert baystate.machine.state_of(db.get_bay(first.bay_id)) == baystate.IDLE
+
+    address = config.address_for(first.bay_id)
+    board.close_door(address.board, address.channel)
+    admin.post('/api/admin/clear', json={'bayId': second.bay_id})
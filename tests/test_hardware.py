@@ -0,0 +1,43 @@
+import time
+
+import hardware
+from board_sim import BoardSimulator
+
+
+def test_a_board_that_stops_answering_trips_the_breaker():
+    # Powered, on the line, but every status reply is lost.
+    sim = BoardSimulator(status_latency=0.0, drop_rate=1.0)
+    port = sim.start()
+    address = hardware.config.LockerAddress(port, 1, 1)
+    link = hardware.get_link(port)
+    try:
+        for _ in range(link.breaker.threshold):
+            status = hardware.get_lock_status(address)
+            assert status["stale"] and status["status"] == "UNKNOWN"
+        assert link.breaker.state == hardware.BREAKER_OPEN
+        # Refused at once, without waiting for the reply timeout.
+        assert hardware.submit_status(address).result(timeout=0.05) is None
+
+        sim.drop_rate = 0.0
+        time.sleep(link.breaker.base_backoff)
+        assert hardware.get_lock_status(address) == {
+            "address": address, "channel": 1, "status": "LOCKED", "stale": False,
+        }
+        assert link.breaker.state == hardware.BREAKER_CLOSED
+    finally:
+        link.close()
+        sim.stop()
+
+
+def test_an_open_with_no_reply_is_not_a_failure():
+    sim = BoardSimulator(status_latency=0.0, drop_rate=1.0)
+    port = sim.start()
+    address = hardware.config.LockerAddress(port, 1, 2)
+    link = hardware.get_link(port)
+    try:
+        for _ in range(link.breaker.threshold + 1):
+            assert hardware.open_locker(address)
+        assert link.breaker.state == hardware.BREAKER_CLOSED
+    finally:
+        link.close()
+        sim.stop()
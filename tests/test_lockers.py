@@ -0,0 +1,31 @@
+import changes
+import db
+
+
+def test_queueing_a_pickup_email_moves_the_etag(admin):
+    db.stage_deposit(3, 'c@example.com', 'C0DE0003')
+    db.confirm_deposit(3)
+    etag = admin.get('/api/lockers').headers['ETag']
+    since = admin.get('/api/lockers').get_json()['version']
+
+    assert admin.post('/api/admin/deposit/send-email', json={'bayId': 3}).get_json()['queued']
+
+    assert admin.get('/api/lockers', headers={'If-None-Match': etag}).status_code == 200
+    delta = admin.get(f'/api/lockers/changes?since={since}').get_json()
+    bay = next(bay for bay in delta['bays'] if bay['id'] == 3)
+    assert bay['emailStatus']['status'] in ('pending', 'failed')
+    admin.post('/api/admin/clear', json={'bayId': 3})
+
+
+def test_version_base_moves_forward_across_restarts(server):
+    first = db.claim_version_base(0, changes.BOOT_STRIDE)
+    # A clock set back doesn't matter: the stored base does.
+    assert db.claim_version_base(0, changes.BOOT_STRIDE) == first + changes.BOOT_STRIDE
+
+
+def test_metrics_token_with_non_ascii_header_is_refused(server, monkeypatch):
+    monkeypatch.setattr(server.config, 'METRICS_TOKEN', 'secret')
+    client = server.app.test_client()
+    reply = client.get('/api/admin/metrics', headers={'Authorization': 'Bearer sécret'})
+    assert reply.status_code == 401
+    assert client.get('/api/admin/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
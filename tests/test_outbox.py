@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta, timezone
+
+import db
+
+
+def _status(email_id):
+    conn = db.get_connection()
+    try:
+        return conn.execute("SELECT status FROM outbox WHERE id = ?", (email_id,)).fetchone()['status']
+    finally:
+        conn.close()
+
+
+def test_result_of_a_send_cancelled_meanwhile_is_dropped(server):
+    db.stage_deposit(4, 'd@example.com', 'C0DE0004')
+    db.confirm_deposit(4)
+    email_id = db.enqueue_email(4, 'd@example.com', 'C0DE0004')
+    now = datetime.now(timezone.utc)
+    lease = (now + timedelta(minutes=10)).isoformat()
+    [item] = [item for item in db.claim_due_emails(now.isoformat(), 100, lease) if item['id'] == email_id]
+
+    # Picked up while the SMTP send was in flight: the code is dead.
+    db.clear_bay(4)
+    assert _status(email_id) == 'cancelled'
+
+    retry_at = (now + timedelta(minutes=1)).isoformat()
+    assert not db.mark_email_failed(email_id, item['next_attempt_at'], 'timeout', retry_at)
+    assert not db.mark_email_sent(email_id, item['next_attempt_at'])
+    assert _status(email_id) == 'cancelled'
+
+
+def test_result_needs_the_current_claim(server):
+    db.stage_deposit(4, 'd@example.com', 'C0DE0005')
+    db.confirm_deposit(4)
+    email_id = db.enqueue_email(4, 'd@example.com', 'C0DE0005')
+    now = datetime.now(timezone.utc)
+    lease = (now + timedelta(minutes=10)).isoformat()
+    [item] = [item for item in db.claim_due_emails(now.isoformat(), 100, lease) if item['id'] == email_id]
+
+    assert not db.mark_email_sent(email_id, now.isoformat())
+    assert db.mark_email_sent(email_id, item['next_attempt_at'])
+    assert _status(email_id) == 'sent'
+    db.clear_bay(4)
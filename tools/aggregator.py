@@ -0,0 +1,255 @@
+"""Central store for the kiosks' replicated change feeds (replication.py).
+
+A small standalone service — stdlib HTTP server plus one SQLite file, no
+Flask — that every kiosk pushes to and fleet-wide questions are asked of:
+
+    python tools/aggregator.py [--db fleet.db] [--host 0.0.0.0] [--port 5100]
+                               [--token <shared token>]
+
+Kiosks point REPLICATION_URL at it (and REPLICATION_TOKEN at --token). It
+runs just as well on a laptop next to a test kiosk.
+
+Protocol (all JSON, Authorization: Bearer <token> when --token is set):
+
+- GET  /api/sites/<site>/cursor  → {site, seq}: last seq stored for a site;
+- POST /api/sites/<site>/changes → body: NDJSON (optionally gzip, with
+  Content-Encoding: gzip), one [seq, ts, kind, bay_id, data] per line;
+  applied in one transaction, answers the new {seq}. `?reset=1` starts the
+  site's cursor over (its kiosk.db was replaced);
+- GET  /api/sites                → every site: cursor, last sync, occupancy;
+- GET  /api/sites/<site>/bays    → the site's bays as last replicated;
+- GET  /api/events?site=&since=&limit= → replicated audit events, newest first.
+
+Applying is idempotent: events are keyed by (site, seq) and a bay row is
+only overwritten by a newer seq, so a resent batch changes nothing.
+"""
+import argparse
+import gzip
+import hmac
+import json
+import re
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+MAX_BODY_BYTES = 32 * 1024 * 1024
+EVENTS_PAGE_MAX = 1000
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sites (
+        site TEXT PRIMARY KEY,
+        seq INTEGER NOT NULL DEFAULT 0,
+        last_sync_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS bays (
+        site TEXT NOT NULL,
+        bay_id INTEGER NOT NULL,
+        occupied INTEGER NOT NULL,
+        email TEXT,
+        staged INTEGER NOT NULL,
+        since TEXT,
+        updated_at TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        PRIMARY KEY (site, bay_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS events (
+        site TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        ts TEXT NOT NULL,
+        level TEXT NOT NULL,
+        message TEXT NOT NULL,
+        bay_id INTEGER,
+        PRIMARY KEY (site, seq)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_events_ts ON events (ts);
+"""
+
+SQL_UPSERT_BAY = """
+    INSERT INTO bays (site, bay_id, occupied, email, staged, since, updated_at, seq)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (site, bay_id) DO UPDATE SET
+        occupied = excluded.occupied, email = excluded.email, staged = excluded.staged,
+        since = excluded.since, updated_at = excluded.updated_at, seq = excluded.seq
+    WHERE excluded.seq > bays.seq
+"""
+SQL_INSERT_EVENT = "INSERT OR IGNORE INTO events (site, seq, ts, level, message, bay_id) VALUES (?, ?, ?, ?, ?, ?)"
+SQL_SITE_CURSOR = "SELECT seq FROM sites WHERE site = ?"
+SQL_SAVE_CURSOR = (
+    "INSERT INTO sites (site, seq, last_sync_at) VALUES (?, ?, ?) "
+    "ON CONFLICT (site) DO UPDATE SET seq = MAX(seq, excluded.seq), last_sync_at = excluded.last_sync_at"
+)
+SQL_RESET_SITE = "UPDATE sites SET seq = 0 WHERE site = ?"
+SQL_RESET_BAYS = "UPDATE bays SET seq = 0 WHERE site = ?"
+SQL_SITES = """
+    SELECT s.site, s.seq, s.last_sync_at,
+           COUNT(b.bay_id) AS bays, COALESCE(SUM(b.occupied), 0) AS occupied
+    FROM sites s LEFT JOIN bays b ON b.site = s.site
+    GROUP BY s.site ORDER BY s.site
+"""
+SQL_SITE_BAYS = "SELECT bay_id, occupied, email, staged, since, updated_at FROM bays WHERE site = ? ORDER BY bay_id"
+
+ROUTE_SITE = re.compile(r'^/api/sites/([^/]+)/(cursor|changes|bays)$')
+
+
+class Aggregator:
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.executescript(SCHEMA)
+        # One connection, one writer: kiosks sync every few seconds at most.
+        self._lock = threading.Lock()
+
+    def cursor(self, site):
+        with self._lock:
+            row = self._conn.execute(SQL_SITE_CURSOR, (site,)).fetchone()
+        return row['seq'] if row else 0
+
+    def apply(self, site, changes, reset=False):
+        """Stores a batch of [seq, ts, kind, bay_id, data] in one
+        transaction and returns the site's new cursor."""
+        now = datetime.now(timezone.utc).isoformat()
+        bays, events, top = [], [], 0
+        for seq, ts, kind, bay_id, data in changes:
+            top = max(top, seq)
+            if kind == 'bay':
+                bays.append((site, bay_id, int(data['occupied']), data['email'],
+                             int(data['staged']), data['since'], ts, seq))
+            elif kind == 'event':
+                level, message = data
+                events.append((site, seq, ts, level, message, bay_id))
+        with self._lock, self._conn:
+            if reset:
+                self._conn.execute(SQL_RESET_SITE, (site,))
+                self._conn.execute(SQL_RESET_BAYS, (site,))
+            self._conn.executemany(SQL_UPSERT_BAY, bays)
+            self._conn.executemany(SQL_INSERT_EVENT, events)
+            self._conn.execute(SQL_SAVE_CURSOR, (site, top, now))
+            return self._conn.execute(SQL_SITE_CURSOR, (site,)).fetchone()['seq']
+
+    def sites(self):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(SQL_SITES)]
+
+    def bays(self, site):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(SQL_SITE_BAYS, (site,))]
+
+    def events(self, site=None, since=None, limit=100):
+        clauses, params = [], []
+        if site:
+            clauses.append("site = ?")
+            params.append(site)
+        if since:
+            clauses.append("ts >= ?")
+            params.append(since)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = f"SELECT site, seq, ts, level, message, bay_id FROM events {where} ORDER BY ts DESC LIMIT ?"
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, (*params, limit))]
+
+
+def make_handler(aggregator, token):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if not self._authorized():
+                return
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            if url.path == '/api/sites':
+                return self._json(200, {"sites": aggregator.sites()})
+            if url.path == '/api/events':
+                try:
+                    limit = min(int(query.get('limit', ['100'])[0]), EVENTS_PAGE_MAX)
+                except ValueError:
+                    return self._json(400, {"error": "limit inválido"})
+                return self._json(200, {"events": aggregator.events(
+                    query.get('site', [None])[0], query.get('since', [None])[0], limit)})
+            match = ROUTE_SITE.match(url.path)
+            if match and match.group(2) == 'cursor':
+                site = unquote(match.group(1))
+                return self._json(200, {"site": site, "seq": aggregator.cursor(site)})
+            if match and match.group(2) == 'bays':
+                return self._json(200, {"bays": aggregator.bays(unquote(match.group(1)))})
+            self._json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            url = urlsplit(self.path)
+            match = ROUTE_SITE.match(url.path)
+            if not match or match.group(2) != 'changes':
+                return self._json(404, {"error": "not found"})
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > MAX_BODY_BYTES:
+                return self._json(413, {"error": "lote demasiado grande"})
+            body = self.rfile.read(length)
+            try:
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                changes = [json.loads(line) for line in body.splitlines() if line.strip()]
+                reset = parse_qs(url.query).get('reset') == ['1']
+                seq = aggregator.apply(unquote(match.group(1)), changes, reset)
+            except (OSError, ValueError, TypeError, KeyError) as e:
+                return self._json(400, {"error": f"lote inválido: {e}"})
+            self._json(200, {"seq": seq})
+
+        def _authorized(self):
+            if not token:
+                return True
+            supplied = self.headers.get('Authorization', '')
+            if hmac.compare_digest(supplied.encode(), f'Bearer {token}'.encode()):
+                return True
+            self._json(401, {"error": "No autorizado"})
+            return False
+
+        def _json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(db_path, host, port, token=''):
+    """Starts the aggregator on a background thread and returns the server
+    (server.server_address has the real port when port=0)."""
+    server = ThreadingHTTPServer((host, port), make_handler(Aggregator(db_path), token))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='aggregator', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='fleet.db')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--token', default='',
+                        help="shared token the kiosks send as REPLICATION_TOKEN")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(Aggregator(args.db), args.token))
+    server.daemon_threads = True
+    print(f"Aggregator on http://{args.host}:{args.port}/  (db: {args.db})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Microbenchmark for the hot db.py calls: get_bay, get_all_bays, log_event.
+
+Runs against a throwaway database (never the site's kiosk.db):
+
+    python tools/bench_db.py [--iterations 2000] [--lockers 48]
+
+Prints per-call latency (mean / p50 / p99, in microseconds) so a change to
+db.py can be compared before/after on the same machine.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+def _measure(fn, iterations):
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        fn(i)
+        samples.append((time.perf_counter() - started) * 1e6)
+    samples.sort()
+    return {
+        "mean": statistics.fmean(samples),
+        "p50": samples[len(samples) // 2],
+        "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--lockers', type=int, default=48)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='kiosk-bench-')
+    os.environ['DB_PATH'] = str(Path(tmp) / 'bench.db')
+    os.environ['NUM_LOCKERS'] = str(args.lockers)
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.environ.setdefault('ADMIN_PASSWORD_HASH', 'bench')
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+    import db
+
+    db.init_db()
+    cases = {
+        "get_bay": lambda i: db.get_bay(i % args.lockers + 1),
+        "get_all_bays": lambda i: db.get_all_bays(),
+        "log_event": lambda i: db.log_event('INFO', f"bench event {i}"),
+    }
+    print(f"{args.iterations} iteraciones, {args.lockers} casilleros, DB en {tmp}")
+    print(f"{'llamada':<14}{'media µs':>12}{'p50 µs':>12}{'p99 µs':>12}")
+    for name, fn in cases.items():
+        stats = _measure(fn, args.iterations)
+        print(f"{name:<14}{stats['mean']:>12.1f}{stats['p50']:>12.1f}{stats['p99']:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
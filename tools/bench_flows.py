@@ -0,0 +1,338 @@
+"""End-to-end benchmark of the HTTP flows against a simulated board.
+
+    python tools/bench_flows.py [--lockers 8,48,200] [--concurrency 8]
+                                [--sweep-seconds 5] [--door-open-seconds 0.5]
+                                [--status-latency-ms 15] [--drop-rate 0]
+
+For each locker count it starts a BoardSimulator (tools/board_sim.py) and
+server.py — the production waitress server — on a throwaway database and
+a free port, then drives what the kiosk does:
+
+1. deposit → wait for the door to close → confirm, for every bay, as admin;
+2. /api/lockers sweeps for --sweep-seconds, alternating a plain GET and a
+   conditional one (If-None-Match, normally a 304);
+3. pickup → wait for the door to close → confirm, for every bay.
+
+Waiting for the door polls /api/lockers/<id>/status every 50 ms, like the
+kiosk's fallback loop does every 2 s. "close detected" is how long after
+the simulated door actually closed the server first reported LOCKED (the
+poller's hot interval plus the board round-trip, plus up to 50 ms of
+polling here). Prints p50/p99 latency and throughput per route and per
+flow, and the simulator's counters. The pickup rate limit is lifted for
+the run; nothing touches the site's kiosk.db or .env settings that matter
+here (they're all overridden).
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from werkzeug.security import generate_password_hash
+
+TOOLS_DIR = Path(__file__).resolve().parent
+ROOT = TOOLS_DIR.parent
+sys.path.insert(0, str(TOOLS_DIR))
+
+from board_sim import BoardSimulator  # noqa: E402
+
+# Channels per simulated board when spreading many lockers over several
+# boards on one RS-485 bus (a common board size).
+CHANNELS_PER_BOARD = 24
+ADMIN_PASSWORD = 'bench'
+STATUS_POLL_SECONDS = 0.05
+SERVER_START_TIMEOUT = 30.0
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.codes = defaultdict(Counter)
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, label, elapsed_ms, code=None):
+        with self._lock:
+            self.samples[label].append(elapsed_ms)
+            if code is not None:
+                self.codes[label][code] += 1
+
+    def phase(self, name, seconds):
+        self.spans[name] = seconds
+
+
+class Client:
+    """One keep-alive connection; records every request's latency."""
+
+    def __init__(self, port, recorder, cookie=None):
+        self.port = port
+        self.recorder = recorder
+        self.cookie = cookie
+        self._conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+
+    def request(self, method, path, payload=None, label=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if payload is not None:
+            body = json.dumps(payload)
+            headers['Content-Type'] = 'application/json'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        started = time.perf_counter()
+        try:
+            self._conn.request(method, path, body=body, headers=headers)
+            response = self._conn.getresponse()
+            raw = response.read()
+        except (OSError, http.client.HTTPException):
+            self._conn.close()
+            self._conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+            self.recorder.add(label or f"{method} {path}", (time.perf_counter() - started) * 1000.0, 'error')
+            return None, {}, None
+        self.recorder.add(label or f"{method} {path}", (time.perf_counter() - started) * 1000.0, response.status)
+        data = json.loads(raw) if raw and response.headers.get_content_type() == 'application/json' else None
+        return response.status, response.headers, data
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _addresses(lockers):
+    """(board, channel) per bay, and the matching LOCKER_CHANNELS value."""
+    if lockers <= CHANNELS_PER_BOARD:
+        return [(1, bay) for bay in range(1, lockers + 1)], ''
+    addresses = [(1 + i // CHANNELS_PER_BOARD, 1 + i % CHANNELS_PER_BOARD) for i in range(lockers)]
+    return addresses, ','.join(f"{board}:{channel}" for board, channel in addresses)
+
+
+def _start_server(lockers, locker_channels, serial_port, tmp):
+    port = _free_port()
+    env = dict(os.environ)
+    env.update({
+        'NUM_LOCKERS': str(lockers),
+        'LOCKER_CHANNELS': locker_channels,
+        'BOARD_ADDRESS': '1',
+        'DISABLED_LOCKERS': '',
+        'SERIAL_PORT': serial_port,
+        'SERIAL_LOCK_DIR': tmp,
+        'DB_PATH': os.path.join(tmp, 'kiosk.db'),
+        'LOG_FILE': os.path.join(tmp, 'action_log.log'),
+        'EVENT_ARCHIVE_DIR': os.path.join(tmp, 'archive'),
+        'SERVER_HOST': '127.0.0.1',
+        'SERVER_PORT': str(port),
+        'SECRET_KEY': 'bench',
+        'ADMIN_PASSWORD_HASH': generate_password_hash(ADMIN_PASSWORD, method='pbkdf2:sha256:1000'),
+        'PICKUP_RATE_LIMIT_ATTEMPTS': '1000000000',
+        'RATE_LIMIT_PERSIST': '0',
+        'SMTP_HOST': '',
+    })
+    log = open(os.path.join(tmp, 'server.out'), 'wb')
+    process = subprocess.Popen([sys.executable, 'server.py'], cwd=ROOT, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/api/config')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"server.py no arrancó; ver {os.path.join(tmp, 'server.out')}")
+
+
+def _stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def _login(port, recorder):
+    client = Client(port, recorder)
+    status, headers, _ = client.request('POST', '/api/admin/login', {"password": ADMIN_PASSWORD})
+    if status != 200:
+        raise RuntimeError(f"login de admin falló ({status})")
+    return headers['Set-Cookie'].split(';', 1)[0]
+
+
+def _wait_closed(client, bay_id, sim, address, recorder, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        _, _, data = client.request('GET', f'/api/lockers/{bay_id}/status', label='GET /api/lockers/<id>/status')
+        if data and data.get('status') == 'LOCKED':
+            closed_at = sim.closed_at(*address)
+            if closed_at is not None:
+                recorder.add('close detected', (time.monotonic() - closed_at) * 1000.0)
+            return True
+        time.sleep(STATUS_POLL_SECONDS)
+    return False
+
+
+def _deposit_flow(client, bay_id, sim, address, recorder, timeout):
+    started = time.perf_counter()
+    status, _, data = client.request('POST', '/api/admin/deposit',
+                                     {"bayId": bay_id, "email": f"bench{bay_id}@example.com"})
+    if status != 200:
+        recorder.add('deposit flow', (time.perf_counter() - started) * 1000.0, 'failed')
+        return None
+    closed = _wait_closed(client, bay_id, sim, address, recorder, timeout)
+    status, _, _ = client.request('POST', '/api/admin/deposit/confirm', {"bayId": bay_id})
+    ok = closed and status == 200
+    recorder.add('deposit flow', (time.perf_counter() - started) * 1000.0, 'ok' if ok else 'failed')
+    return data['pickupCode'] if ok else None
+
+
+def _pickup_flow(client, bay_id, code, sim, address, recorder, timeout):
+    started = time.perf_counter()
+    status, _, data = client.request('POST', '/api/pickup', {"code": code})
+    if status != 200 or data.get('bayId') != bay_id:
+        recorder.add('pickup flow', (time.perf_counter() - started) * 1000.0, 'failed')
+        return
+    closed = _wait_closed(client, bay_id, sim, address, recorder, timeout)
+    status, _, _ = client.request('POST', '/api/pickup/confirm', {"bayId": bay_id, "code": code})
+    recorder.add('pickup flow', (time.perf_counter() - started) * 1000.0,
+                 'ok' if closed and status == 200 else 'failed')
+
+
+def _run_parallel(concurrency, make_client, jobs):
+    local = threading.local()
+
+    def run(job):
+        if not hasattr(local, 'client'):
+            local.client = make_client()
+        return job(local.client)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(run, jobs))
+
+
+def _sweep(port, recorder, concurrency, seconds):
+    stop_at = time.monotonic() + seconds
+
+    def client_loop():
+        client = Client(port, recorder)
+        etag = None
+        conditional = False
+        while time.monotonic() < stop_at:
+            if conditional and etag:
+                client.request('GET', '/api/lockers', label='GET /api/lockers (If-None-Match)',
+                               headers={'If-None-Match': etag})
+            else:
+                _, headers, _ = client.request('GET', '/api/lockers')
+                etag = headers.get('ETag') if headers else None
+            conditional = not conditional
+
+    threads = [threading.Thread(target=client_loop) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def _report(lockers, recorder, sim):
+    print(f"\n=== {lockers} casilleros ===")
+    for phase, seconds in recorder.spans.items():
+        print(f"  fase {phase}: {seconds:.2f}s")
+    print(f"{'':2}{'ruta / flujo':<38}{'n':>7}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}  resultados")
+    for label in sorted(recorder.samples, key=lambda name: (name.endswith(('flow', 'detected')), name)):
+        samples = sorted(recorder.samples[label])
+        codes = ', '.join(f"{code}×{count}" for code, count in sorted(recorder.codes[label].items(), key=str))
+        span = _span_for(label, recorder)
+        rate = f"{len(samples) / span:>9.1f}" if span else f"{'-':>9}"
+        print(f"  {label:<38}{len(samples):>7}{rate}"
+              f"{_percentile(samples, 0.50):>9.1f}{_percentile(samples, 0.99):>9.1f}  {codes}")
+    print(f"  simulador: {sim.stats}")
+
+
+def _span_for(label, recorder):
+    if 'deposit' in label:
+        return recorder.spans.get('deposit')
+    if 'pickup' in label:
+        return recorder.spans.get('pickup')
+    if label.startswith('GET /api/lockers') and '<id>' not in label:
+        return recorder.spans.get('sweep')
+    return None
+
+
+def bench(lockers, args):
+    recorder = Recorder()
+    sim = BoardSimulator(
+        status_latency=args.status_latency_ms / 1000.0,
+        drop_rate=args.drop_rate,
+        door_open_seconds=args.door_open_seconds,
+        seed=1,
+    )
+    addresses, locker_channels = _addresses(lockers)
+    with tempfile.TemporaryDirectory(prefix='kiosk-bench-') as tmp:
+        serial_port = sim.start()
+        process, port = _start_server(lockers, locker_channels, serial_port, tmp)
+        try:
+            cookie = _login(port, recorder)
+            admin = lambda: Client(port, recorder, cookie)  # noqa: E731
+            public = lambda: Client(port, recorder)  # noqa: E731
+            timeout = args.door_open_seconds + 10.0
+            bays = list(range(1, lockers + 1))
+
+            started = time.monotonic()
+            codes = _run_parallel(args.concurrency, admin, [
+                (lambda client, bay=bay: _deposit_flow(client, bay, sim, addresses[bay - 1], recorder, timeout))
+                for bay in bays
+            ])
+            recorder.phase('deposit', time.monotonic() - started)
+
+            started = time.monotonic()
+            _sweep(port, recorder, args.concurrency, args.sweep_seconds)
+            recorder.phase('sweep', time.monotonic() - started)
+
+            started = time.monotonic()
+            _run_parallel(args.concurrency, public, [
+                (lambda client, bay=bay, code=code: _pickup_flow(client, bay, code, sim, addresses[bay - 1],
+                                                                  recorder, timeout))
+                for bay, code in zip(bays, codes) if code
+            ])
+            recorder.phase('pickup', time.monotonic() - started)
+        finally:
+            _stop_server(process)
+            sim.stop()
+    _report(lockers, recorder, sim)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lockers', default='8,48,200',
+                        help="comma-separated locker counts, one run each")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--sweep-seconds', type=float, default=5.0)
+    parser.add_argument('--door-open-seconds', type=float, default=0.5)
+    parser.add_argument('--status-latency-ms', type=float, default=15.0)
+    parser.add_argument('--drop-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    print(f"concurrencia {args.concurrency}, puerta abierta {args.door_open_seconds}s, "
+          f"latencia de estado {args.status_latency_ms} ms, pérdida {args.drop_rate:.0%}")
+    for lockers in (int(n) for n in args.lockers.split(',') if n.strip()):
+        bench(lockers, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""WKLY locker board simulator on a pseudo-terminal.
+
+Speaks the same framing as hardware.py (HEADER, length byte, board /
+command / channel payload, XOR checksum — the frames are parsed with
+hardware.FrameDecoder itself), so the server can run end to end without
+the physical board:
+
+    python tools/board_sim.py [--status-latency-ms 15] [--open-latency-ms 5]
+                              [--open-reply] [--drop-rate 0.01]
+                              [--door-open-seconds 2]
+
+It prints the pty path; point the server at it with SERIAL_PORT=<path>.
+Every board address answers, so LOCKER_CHANNELS with several boards
+("2:5", ...) works too.
+
+Door model: every door starts closed (LOCKED). An open command unlocks it,
+and it reports UNLOCKED until `door_open_seconds` later, when the simulated
+person closes it again (door_open_seconds=None leaves it open until
+close_door() is called). Replies are delayed by a per-command latency, as
+the board itself answers one frame at a time; with drop_rate a status
+reply is randomly never sent, the way a noisy RS-485 line loses frames.
+The open command gets no reply unless open_reply is set, like the real
+board.
+"""
+import argparse
+import os
+import random
+import select
+import sys
+import threading
+import time
+import tty
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import hardware  # noqa: E402
+
+STATE_UNLOCKED = 0x00
+STATE_LOCKED = 0x01
+
+
+class BoardSimulator:
+    def __init__(self, status_latency=0.015, open_latency=0.005, open_reply=False,
+                 drop_rate=0.0, door_open_seconds=2.0, seed=None):
+        self.status_latency = status_latency
+        self.open_latency = open_latency
+        self.open_reply = open_reply
+        self.drop_rate = drop_rate
+        self.door_open_seconds = door_open_seconds
+        self.path = None
+        self.stats = {"open": 0, "check": 0, "dropped": 0, "checksumErrors": 0}
+        self._random = random.Random(seed)
+        self._doors = {}  # (board, channel) → monotonic time it was opened
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._master = self._slave = None
+        self._thread = None
+
+    def start(self):
+        """Opens the pty and starts answering. Returns the device path."""
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.path = os.ttyname(self._slave)
+        self._thread = threading.Thread(target=self._run, name='board-sim', daemon=True)
+        self._thread.start()
+        return self.path
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2.0)
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def open_door(self, board, channel):
+        with self._lock:
+            self._doors[(board, channel)] = time.monotonic()
+
+    def close_door(self, board, channel):
+        with self._lock:
+            self._doors.pop((board, channel), None)
+
+    def closed_at(self, board, channel):
+        """Monotonic time the door closed (or will close) after its last
+        open, or None if it was never opened or waits for close_door()."""
+        with self._lock:
+            opened = self._doors.get((board, channel))
+        if opened is None or self.door_open_seconds is None:
+            return None
+        return opened + self.door_open_seconds
+
+    def door_state(self, board, channel, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            opened = self._doors.get((board, channel))
+        if opened is None:
+            return STATE_LOCKED
+        if self.door_open_seconds is not None and now - opened >= self.door_open_seconds:
+            return STATE_LOCKED
+        return STATE_UNLOCKED
+
+    def _run(self):
+        decoder = hardware.FrameDecoder()
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._master, 256)
+            except OSError:
+                return
+            for frame in decoder.feed(data):
+                self._answer(frame)
+            self.stats["checksumErrors"] = decoder.checksum_errors
+
+    def _answer(self, frame):
+        if len(frame) < 9:
+            return
+        board, cmd, channel = frame[5], frame[6], frame[7]
+        if cmd == hardware.CMD_BYTE_OPEN[0]:
+            self.stats["open"] += 1
+            self.open_door(board, channel)
+            if not self.open_reply:
+                return
+            latency, state = self.open_latency, STATE_UNLOCKED
+        elif cmd == hardware.CMD_BYTE_CHECK[0]:
+            self.stats["check"] += 1
+            if self.drop_rate and self._random.random() < self.drop_rate:
+                self.stats["dropped"] += 1
+                return
+            latency, state = self.status_latency, self.door_state(board, channel)
+        else:
+            return
+        if latency:
+            time.sleep(latency)
+        os.write(self._master, _reply(board, cmd, channel, state))
+
+
+def _reply(board, cmd, channel, state):
+    """11-byte reply: board at offset 5, command at 6, channel at 8 and
+    the door state at 9 — the layout hardware._parse_status reads."""
+    payload = bytes([board, cmd, 0x00, channel, state])
+    length = len(hardware.HEADER) + 1 + len(payload) + 1
+    return hardware.HEADER + bytes([length]) + payload + hardware._calculate_checksum(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--status-latency-ms', type=float, default=15.0)
+    parser.add_argument('--open-latency-ms', type=float, default=5.0)
+    parser.add_argument('--open-reply', action='store_true',
+                        help="reply to open commands (the real board usually doesn't)")
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help="fraction of status replies never sent (0-1)")
+    parser.add_argument('--door-open-seconds', type=float, default=2.0,
+                        help="how long a door stays open after an open command; 0 = until Ctrl-C")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    sim = BoardSimulator(
+        status_latency=args.status_latency_ms / 1000.0,
+        open_latency=args.open_latency_ms / 1000.0,
+        open_reply=args.open_reply,
+        drop_rate=args.drop_rate,
+        door_open_seconds=args.door_open_seconds or None,
+        seed=args.seed,
+    )
+    path = sim.start()
+    print(f"Simulated board on {path}  (SERIAL_PORT={path})", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+        print(f"\n{sim.stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""HTTP load test for a running kiosk server: concurrent pickup/status traffic.
+
+Start the server the way it runs in production (python server.py), then:
+
+    python tools/load_test.py [--url http://127.0.0.1:5000] [--concurrency 16]
+                              [--duration 10] [--lockers 8]
+
+Each client thread keeps one keep-alive connection and loops over a mix of
+GET /api/lockers, GET /api/lockers/<id>/status and POST /api/pickup with
+random (invalid) codes. Prints throughput, p50/p99 latency and status codes
+per route. All pickups come from one IP, so most of them are expected to be
+429: the number that got through shows whether the rate limit holds under
+concurrency (it should never exceed PICKUP_RATE_LIMIT_ATTEMPTS per window,
+however many threads serve the traffic).
+"""
+import argparse
+import http.client
+import json
+import random
+import secrets
+import threading
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlsplit
+
+# Relative weight of each kind of request in the mix.
+MIX = (
+    ('lockers', 4),
+    ('status', 4),
+    ('pickup', 2),
+)
+
+
+def _request(conn, kind, lockers):
+    if kind == 'lockers':
+        conn.request('GET', '/api/lockers')
+    elif kind == 'status':
+        conn.request('GET', f'/api/lockers/{random.randint(1, lockers)}/status')
+    else:
+        body = json.dumps({"code": secrets.token_hex(4).upper()})
+        conn.request('POST', '/api/pickup', body=body, headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    response.read()
+    return response.status
+
+
+def _client(url, lockers, stop_at, results, lock):
+    parts = urlsplit(url)
+    kinds = [kind for kind, weight in MIX for _ in range(weight)]
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+    local = defaultdict(list)
+    codes = defaultdict(Counter)
+    while time.monotonic() < stop_at:
+        kind = random.choice(kinds)
+        started = time.perf_counter()
+        try:
+            status = _request(conn, kind, lockers)
+        except (OSError, http.client.HTTPException):
+            status = 'error'
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        local[kind].append((time.perf_counter() - started) * 1000.0)
+        codes[kind][status] += 1
+    conn.close()
+    with lock:
+        for kind, samples in local.items():
+            results['latency'][kind].extend(samples)
+            results['codes'][kind].update(codes[kind])
+
+
+def _percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--lockers', type=int, default=8)
+    args = parser.parse_args()
+
+    results = {'latency': defaultdict(list), 'codes': defaultdict(Counter)}
+    lock = threading.Lock()
+    stop_at = time.monotonic() + args.duration
+    threads = [
+        threading.Thread(target=_client, args=(args.url, args.lockers, stop_at, results, lock))
+        for _ in range(args.concurrency)
+    ]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    total = sum(len(samples) for samples in results['latency'].values())
+    print(f"{args.concurrency} clients, {elapsed:.1f}s, {total} requests, {total / elapsed:.0f} req/s overall")
+    print(f"{'route':<10}{'requests':>10}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}  status codes")
+    for kind, _ in MIX:
+        samples = sorted(results['latency'].get(kind, []))
+        if not samples:
+            continue
+        codes = ', '.join(f"{code}×{count}" for code, count in sorted(results['codes'][kind].items(), key=str))
+        print(f"{kind:<10}{len(samples):>10}{len(samples) / elapsed:>9.0f}"
+              f"{_percentile(samples, 0.50):>9.1f}{_percentile(samples, 0.99):>9.1f}  {codes}")
+
+
+if __name__ == '__main__':
+    main()